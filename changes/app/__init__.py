@@ -23,15 +23,49 @@ def create_app():
     @app.cli.command("run-etl")
     @click.option("--file-date", type=click.DateTime())
     @click.option("--storage-dir", type=click.Path())
-    def run_etl(file_date, storage_dir):
+    @click.option(
+        "--stream",
+        is_flag=True,
+        help="Stream the download straight into COPY instead of saving it first",
+    )
+    @click.option(
+        "--resume",
+        is_flag=True,
+        help="Pick up a failed run after its last completed step",
+    )
+    @click.option(
+        "--delta",
+        is_flag=True,
+        help="Only load the rows that differ from the last snapshot loaded",
+    )
+    @click.option(
+        "--verify",
+        is_flag=True,
+        help="Compare every row even if PREFILTER_UPDATED_ON is set",
+    )
+    def run_etl(file_date, storage_dir, stream, resume, delta, verify):
         if not storage_dir:
             storage_dir = ""
 
+        options = dict(stream=stream, resume=resume, delta=delta, verify=verify)
         if file_date:
-            etl = ETL(storage_dir, file_date=file_date)
+            etl = ETL(storage_dir, file_date=file_date, **options)
         else:
-            etl = ETL(storage_dir)
+            etl = ETL(storage_dir, **options)
 
         etl.run()
 
+    @app.cli.command("backfill")
+    @click.option("--storage-dir", type=click.Path(exists=True), required=True)
+    @click.option("--start-date", type=click.DateTime())
+    @click.option("--end-date", type=click.DateTime())
+    def backfill(storage_dir, start_date, end_date):
+        """Replay the archived snapshots in a storage directory in date order"""
+        from app.backfill import Backfill, archived_snapshots
+
+        etl = ETL(storage_dir, backdate=True)
+        snapshots = archived_snapshots(etl.archive, start=start_date, end=end_date)
+
+        Backfill(etl, snapshots, workers=app.config["BACKFILL_WORKERS"]).run()
+
     return app
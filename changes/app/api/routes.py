@@ -1,34 +1,59 @@
 import json
 from collections import OrderedDict
-from datetime import datetime
+from datetime import date, datetime
 from itertools import groupby
 from operator import itemgetter
 
 from app.api import api
 from flask import make_response, request
-from helpers import groupedChanges
+from helpers import (
+    changedFields,
+    changeStats,
+    groupedChanges,
+    indexCodeChanges,
+    indexCodeFilters,
+    statsFilters,
+)
 
 
 def dthandler(obj):
     """Handle datetime objects in JSON serialization."""
-    return obj.isoformat() if isinstance(obj, datetime) else None
+    return obj.isoformat() if isinstance(obj, (date, datetime)) else None
 
 
 @api.route("/")
 def listing():
-    pagination_args = {}
-    for arg in ["limit", "offset", "order_by", "sort_order"]:
-        if request.args.get(arg):
-            pagination_args[arg] = request.args[arg]
+    # Pages are keyed on id, so that's the only order there is
+    if request.args.get("order_by", "id") != "id":
+        resp = {
+            "status": "error",
+            "message": "order_by is no longer supported, records are ordered by id",
+        }
+        response = make_response(json.dumps(resp), 400)
+        response.headers["Content-Type"] = "application/json"
+        return response
+
+    pagination_args = {"cursor": request.args.get("cursor")}
+    try:
+        pagination_args["limit"] = min(int(request.args.get("limit", 500)), 1000)
+    except (ValueError, TypeError):
+        pass
+    if request.args.get("sort_order") in ("asc", "desc"):
+        pagination_args["sort_order"] = request.args["sort_order"]
 
     changed_records, query, count = groupedChanges(**pagination_args)
 
-    changed_records = [OrderedDict(zip(changed_records.keys(), r)) for r in changed_records]
+    changed_records = [OrderedDict(zip(r._fields, r)) for r in changed_records]
 
     changed_records = sorted(changed_records, key=itemgetter("id"))
+    changed_fields = changedFields({r["id"] for r in changed_records})
+
     record_groups = []
     for record_id, group in groupby(changed_records, key=itemgetter("id")):
-        record_groups.append({record_id: list(group)})
+        group = list(group)
+        for record in group:
+            record["changed_fields"] = changed_fields.get(record_id, [])
+        record_groups.append({record_id: group})
 
     meta = {"total_count": count}
     meta.update(query)
@@ -43,3 +68,49 @@ def listing():
 
     response.headers["Content-Type"] = "application/json"
     return response
+
+
+@api.route("/index-code-changes/")
+def index_code_changes():
+    filters = indexCodeFilters(request.args)
+
+    try:
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except (ValueError, TypeError):
+        limit = 100
+
+    changes, total, prev_cursor, next_cursor = indexCodeChanges(
+        limit=limit, cursor=request.args.get("cursor"), count=True, **filters
+    )
+
+    meta = {"total_count": total, "limit": limit, "prev": prev_cursor, "next": next_cursor}
+    meta.update(filters)
+
+    resp = {
+        "status": "ok",
+        "meta": meta,
+        "records": [OrderedDict(zip(c._fields, c)) for c in changes],
+    }
+
+    response = make_response(json.dumps(resp, default=dthandler, sort_keys=False))
+
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+@api.route("/stats/")
+def stats():
+    filters = statsFilters(request.args)
+
+    counts = changeStats(**filters)
+
+    resp = {
+        "status": "ok",
+        "meta": filters,
+        "counts": [OrderedDict(zip(c._fields, c)) for c in counts],
+    }
+
+    response = make_response(json.dumps(resp, default=dthandler, sort_keys=False))
+
+    response.headers["Content-Type"] = "application/json"
+    return response
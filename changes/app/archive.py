@@ -0,0 +1,202 @@
+import gzip
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from app.download import DOWNLOAD_CHUNK_SIZE, file_fingerprint
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstd is optional
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+}
+
+
+class SnapshotWriter(object):
+    """
+    Compressing file-like object for a snapshot that is still arriving. Bytes
+    go to a temporary object which SnapshotArchive.commit() moves into place
+    once the snapshot is complete.
+    """
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.raw = open(path, "wb")
+
+        if compression == "zstd":
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6)
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def close(self):
+        if not self.raw.closed:
+            self.stream.close()
+            self.raw.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SnapshotArchive(object):
+    """
+    Compressed, content-addressed store for the daily snapshots.
+
+    Each distinct snapshot is stored once under objects/ named after the
+    sha256 of its uncompressed contents, and manifest.json maps snapshot
+    filenames (chicago-crime-YYYY-MM-DD.csv and friends) to those objects.
+    Days where the portal file didn't change cost a manifest entry instead of
+    another couple of gigabytes.
+
+    Uncompressed snapshots left in storage_dir by older versions are still
+    found and read as they are.
+    """
+
+    def __init__(self, storage_dir, compression="gzip", retention_days=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown archive compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd archive compression requires the zstandard package")
+
+        self.storage_dir = storage_dir
+        self.compression = compression
+        self.retention_days = retention_days
+
+        self.objects_dir = os.path.join(storage_dir, "objects")
+        self.manifest_path = os.path.join(storage_dir, "manifest.json")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def raw_path(self, filename):
+        return os.path.join(self.storage_dir, filename)
+
+    def object_path(self, fingerprint):
+        """
+        Path of the stored object for a fingerprint, whichever compression it
+        was written with, or None if we don't have it.
+        """
+        for extension in EXTENSIONS.values():
+            path = os.path.join(self.objects_dir, f"{fingerprint}{extension}")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def has(self, filename):
+        return filename in self.manifest or os.path.exists(self.raw_path(filename))
+
+    def fingerprint(self, filename):
+        if filename in self.manifest:
+            return self.manifest[filename]["fingerprint"]
+
+        return file_fingerprint(self.raw_path(filename))
+
+    def writer(self, filename):
+        path = os.path.join(self.objects_dir, f"tmp-{uuid.uuid4().hex}.part")
+        return SnapshotWriter(path, self.compression)
+
+    def commit(self, filename, writer, fingerprint, file_date):
+        """
+        Move a finished SnapshotWriter into place, unless we already have an
+        object with the same contents.
+        """
+        writer.close()
+
+        if self.object_path(fingerprint):
+            logger.info(f"{filename} is identical to an archived snapshot")
+            os.remove(writer.path)
+        else:
+            extension = EXTENSIONS[self.compression]
+            os.replace(writer.path, os.path.join(self.objects_dir, f"{fingerprint}{extension}"))
+
+        self.manifest[filename] = {
+            "fingerprint": fingerprint,
+            "file_date": file_date.strftime("%Y-%m-%d"),
+        }
+        self.save_manifest()
+
+    def add(self, filename, filepath, file_date, fingerprint=None):
+        """
+        Compress an uncompressed snapshot into the archive and remove the
+        original.
+        """
+        if not fingerprint:
+            fingerprint = file_fingerprint(filepath)
+
+        writer = self.writer(filename)
+        if not self.object_path(fingerprint):
+            with open(filepath, "rb") as f:
+                for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    writer.write(block)
+
+        self.commit(filename, writer, fingerprint, file_date)
+        os.remove(filepath)
+
+    def open(self, filename):
+        """
+        Binary file-like object with the uncompressed snapshot contents,
+        decompressed as it's read.
+        """
+        if filename not in self.manifest:
+            return open(self.raw_path(filename), "rb")
+
+        path = self.object_path(self.manifest[filename]["fingerprint"])
+        if path is None:
+            raise FileNotFoundError(f"Archived object for {filename} is missing")
+
+        if path.endswith(EXTENSIONS["zstd"]):
+            if zstandard is None:
+                raise ValueError(f"{filename} is zstd compressed but zstandard isn't installed")
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+        return gzip.open(path, "rb")
+
+    def prune(self, today=None):
+        """
+        Forget snapshots older than the retention window and delete any
+        objects that no snapshot refers to anymore.
+        """
+        if not self.retention_days:
+            return
+
+        today = today or datetime.now()
+        cutoff = (today - timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+
+        expired = [name for name, entry in self.manifest.items() if entry["file_date"] < cutoff]
+        for filename in expired:
+            del self.manifest[filename]
+
+        if expired:
+            self.save_manifest()
+            logger.info(f"Removed {len(expired)} snapshots older than {cutoff} from the archive")
+
+        referenced = {entry["fingerprint"] for entry in self.manifest.values()}
+        for name in os.listdir(self.objects_dir):
+            fingerprint = name.split(".")[0]
+            if not name.startswith("tmp-") and fingerprint not in referenced:
+                os.remove(os.path.join(self.objects_dir, name))
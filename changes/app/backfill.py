@@ -0,0 +1,182 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from app.archive import SnapshotArchive
+from app.etl import COLS, TRACKED_COLS
+from app.snapshot_diff import SnapshotDiff
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_NAME = re.compile(r"^chicago-crime-(\d{4}-\d{2}-\d{2})\.csv$")
+
+
+def archived_snapshots(archive, start=None, end=None):
+    """
+    (file_date, filename) for the crime snapshots in the archive, including
+    any uncompressed ones sitting in the storage directory, oldest first.
+    """
+    names = set(archive.manifest) | set(os.listdir(archive.storage_dir))
+
+    snapshots = []
+    for name in names:
+        match = SNAPSHOT_NAME.match(name)
+        if not match:
+            continue
+
+        file_date = datetime.strptime(match.group(1), "%Y-%m-%d")
+        if (start and file_date < start) or (end and file_date > end):
+            continue
+
+        snapshots.append((file_date, name))
+
+    return sorted(snapshots)
+
+
+def prepare_delta(storage_dir, compression, columns, tracked, base, filename, out_path):
+    """
+    Diff two archived snapshots into a delta file. Runs in a worker process,
+    so it opens its own view of the archive.
+    """
+    archive = SnapshotArchive(storage_dir, compression=compression)
+    diff = SnapshotDiff(columns, tracked, work_dir=os.path.dirname(out_path))
+
+    with open(out_path, "wb") as out, archive.open(base) as old, archive.open(filename) as new:
+        deleted, counts = diff.write_delta(old, new, out)
+
+    return deleted, counts
+
+
+class Backfill(object):
+    """
+    Replay archived snapshots through an ETL in date order to rebuild the
+    history they describe.
+
+    Working out what changed from one day to the next doesn't depend on the
+    database, so the diffs between consecutive snapshots are all worked out
+    up front by a pool of worker processes. Each day is then loaded and
+    published in order as soon as its diff is ready. Only the first day
+    needs a full load, and only if there's nothing loaded already.
+
+    The ETL should be made with backdate=True so that versions start on the
+    day of their snapshot rather than the day of the backfill.
+    """
+
+    def __init__(self, etl, snapshots, workers=4):
+        self.etl = etl
+        self.snapshots = snapshots
+        self.workers = max(1, workers)
+
+    def pending(self):
+        """
+        The snapshots newer than the last one loaded. History can only be
+        added on the end, so anything older is skipped.
+        """
+        last = self.etl.last_loaded("chicago-crime")
+        if last is None:
+            return None, self.snapshots
+
+        skipped = [s for s in self.snapshots if s[0].date() <= last.file_date]
+        if skipped:
+            logger.warning(
+                f"Skipping {len(skipped)} snapshots from on or before {last.file_date}, "
+                "which has already been loaded"
+            )
+
+        base = last.filename if self.etl.archive.has(last.filename) else None
+        return base, [s for s in self.snapshots if s[0].date() > last.file_date]
+
+    def run(self):
+        base, snapshots = self.pending()
+        if not snapshots:
+            logger.info("Nothing to backfill")
+            return
+
+        logger.info(f"Backfilling {len(snapshots)} snapshots with {self.workers} workers")
+        work_dir = tempfile.mkdtemp(dir=self.etl.storage_dir)
+        completed = False
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = []
+                previous = base
+                for file_date, filename in snapshots:
+                    if previous is None:
+                        futures.append(None)
+                    else:
+                        futures.append(
+                            pool.submit(
+                                prepare_delta,
+                                self.etl.storage_dir,
+                                self.etl.archive.compression,
+                                COLS,
+                                TRACKED_COLS,
+                                previous,
+                                filename,
+                                os.path.join(work_dir, f"{filename}.delta"),
+                            )
+                        )
+                    previous = filename
+
+                try:
+                    for (file_date, filename), future in zip(snapshots, futures):
+                        delta = future.result() if future else None
+                        if not self.apply(file_date, filename, work_dir, delta):
+                            break
+                    else:
+                        completed = True
+                finally:
+                    # Nothing after a day that failed, or raised, can be
+                    # applied, so don't wait for the diffs still queued
+                    if not completed:
+                        pool.shutdown(cancel_futures=True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if not completed:
+            return
+
+        self.etl.archive.prune()
+        logger.info("Backfill completed successfully")
+
+    def apply(self, file_date, filename, work_dir, delta):
+        """
+        Load and publish one day. Returns whether the backfill can carry on,
+        which it can't if a day fails since the next day's diff is against it.
+        """
+        etl = self.etl
+        etl.file_date = file_date
+        etl.rejected_rows = 0
+        logger.info(f"Applying {filename}")
+
+        if etl.unchanged_snapshot("chicago-crime", filename):
+            etl.update_meta_table(filename, "no-change", etl.snapshot_fingerprint(filename))
+            return True
+
+        etl.clear_checkpoints(filename)
+        etl.make_source_table()
+        start = time.time()
+
+        if delta:
+            path = os.path.join(work_dir, f"{filename}.delta")
+            with open(path, "rb") as contents:
+                proceed = etl.load_source_data(filename, contents, lambda: open(path, "rb"))
+            if proceed:
+                etl.make_removed_table(delta[0])
+        else:
+            with etl.archive.open(filename) as contents:
+                proceed = etl.load_source_data(filename, contents)
+
+        if not proceed:
+            etl.checkpoint(filename, "load", "failed", start)
+            logger.error(f"Stopping the backfill at {filename}")
+            return False
+
+        etl.checkpoint(filename, "load", "completed", start, "src_chicago_crime")
+        etl.apply_changes(filename)
+        return True
@@ -0,0 +1,325 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Byte ranges and Content-Length only line up with what we write to disk if
+# the server isn't compressing the response on the fly
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+def file_fingerprint(filepath):
+    """
+    sha256 of a file on disk, read in download sized blocks
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadError(requests.RequestException):
+    """
+    Raised when a download finishes but can't be verified, or the server
+    stops honoring the byte ranges we asked for.
+    """
+
+
+class TeeReader(io.RawIOBase):
+    """
+    File-like wrapper around a streaming HTTP response that writes every chunk
+    it hands out to an archive as well. copy_expert only ever calls read() on
+    the object it is given, so this lets COPY consume the download while it
+    is still arriving.
+
+    finish() drains whatever COPY didn't ask for into the archive, after
+    which the sha256 of the whole response is available as fingerprint.
+    """
+
+    def __init__(self, response, archive, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        super().__init__()
+        self.chunks = response.iter_content(chunk_size=chunk_size)
+        self.archive = archive
+        self.buffer = bytearray()
+        self.exhausted = False
+        self.digest = hashlib.sha256()
+        self.fingerprint = None
+
+    def _fill(self, size):
+        while not self.exhausted and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            if chunk:
+                self.archive.write(chunk)
+                self.digest.update(chunk)
+                self.buffer.extend(chunk)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def finish(self):
+        while not self.exhausted:
+            self.buffer.clear()
+            self._fill(DOWNLOAD_CHUNK_SIZE)
+        self.fingerprint = self.digest.hexdigest()
+
+
+class RangedDownloader(object):
+    """
+    Download a file into "<filepath>.part", fetching byte ranges in parallel
+    when the server advertises support for them, and only move it to filepath
+    once it is complete and verified.
+
+    Progress for each range is kept in "<filepath>.part.json" so that a run
+    that dies part way through picks up where it left off instead of starting
+    over. The progress file is only ever written after the bytes it describes
+    have been written, so at worst a resumed download fetches a few bytes
+    twice. A single stream download is resumed from the length of the .part
+    file, if the server will send the rest of an unchanged file.
+
+    Once download() returns, fingerprint holds the sha256 of the file.
+    """
+
+    def __init__(
+        self,
+        url,
+        filepath,
+        params=None,
+        workers=4,
+        timeout=30,
+        sha256=None,
+        chunk_size=DOWNLOAD_CHUNK_SIZE,
+    ):
+        self.url = url
+        self.filepath = filepath
+        self.params = params
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.sha256 = sha256
+        self.chunk_size = chunk_size
+        self.digest = None
+        self.fingerprint = None
+
+        self.part_path = f"{filepath}.part"
+        self.progress_path = f"{self.part_path}.json"
+        self.lock = threading.Lock()
+
+    def probe(self):
+        """
+        Find out how big the file is and whether we can ask for pieces of it.
+        Returns a dict describing the remote file which is also used to make
+        sure a partial download is resumed against the same version.
+        """
+        try:
+            r = requests.head(
+                self.url,
+                params=self.params,
+                headers=IDENTITY,
+                allow_redirects=True,
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+        except requests.HTTPError:
+            return {"size": None, "ranged": False, "etag": None, "last_modified": None}
+
+        size = r.headers.get("Content-Length")
+        size = int(size) if size and size.isdigit() else None
+
+        return {
+            "size": size,
+            "ranged": r.headers.get("Accept-Ranges", "").lower() == "bytes" and bool(size),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+
+    def load_progress(self, remote):
+        if not (os.path.exists(self.part_path) and os.path.exists(self.progress_path)):
+            return None
+
+        with open(self.progress_path) as f:
+            progress = json.load(f)
+
+        if progress.get("remote") != remote:
+            logger.info(f"Remote file changed since last attempt, restarting {self.filepath}")
+            return None
+
+        return progress
+
+    def save_progress(self, progress):
+        tmp_path = f"{self.progress_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, self.progress_path)
+
+    def make_segments(self, size):
+        segment_size = -(-size // self.workers)
+        return [
+            {"start": start, "end": min(start + segment_size, size) - 1, "done": 0}
+            for start in range(0, size, segment_size)
+        ]
+
+    def fetch_segment(self, segment, progress):
+        start = segment["start"] + segment["done"]
+        if start > segment["end"]:
+            return
+
+        headers = dict(IDENTITY, Range=f"bytes={start}-{segment['end']}")
+        r = requests.get(
+            self.url, params=self.params, headers=headers, stream=True, timeout=self.timeout
+        )
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            raise DownloadError(f"Server ignored range request for {self.url}")
+
+        with open(self.part_path, "r+b") as f:
+            f.seek(start)
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    f.flush()
+                    with self.lock:
+                        segment["done"] += len(chunk)
+                        self.save_progress(progress)
+
+    def fetch_ranged(self, remote):
+        progress = self.load_progress(remote)
+
+        if progress:
+            done = sum(s["done"] for s in progress["segments"])
+            logger.info(f"Resuming {self.filepath} at {done} of {remote['size']} bytes")
+        else:
+            progress = {"remote": remote, "segments": self.make_segments(remote["size"])}
+            with open(self.part_path, "wb") as f:
+                f.truncate(remote["size"])
+            self.save_progress(progress)
+
+        with ThreadPoolExecutor(max_workers=len(progress["segments"])) as pool:
+            futures = [
+                pool.submit(self.fetch_segment, segment, progress)
+                for segment in progress["segments"]
+            ]
+            for future in futures:
+                future.result()
+
+    def resume_whole(self, remote):
+        """
+        Ask for the rest of a single stream download that was cut off.
+        If-Range makes the server send the whole file instead if it has
+        changed since, so this only works when there's an ETag or
+        Last-Modified to check against. Returns the response and how many
+        bytes of the .part file it carries on from.
+        """
+        validator = remote["etag"] or remote["last_modified"]
+        if not validator or self.load_progress(remote) is None:
+            return None, 0
+
+        done = os.path.getsize(self.part_path)
+        if not done:
+            return None, 0
+
+        headers = dict(IDENTITY, Range=f"bytes={done}-")
+        headers["If-Range"] = validator
+        r = requests.get(
+            self.url, params=self.params, headers=headers, stream=True, timeout=self.timeout
+        )
+
+        if r.status_code != 206:
+            # Ranges not honoured, the file changed, or there's nothing left
+            # to send; either way start over
+            r.close()
+            return None, 0
+
+        logger.info(f"Resuming {self.filepath} at {done} bytes")
+        return r, done
+
+    def fetch_whole(self, remote):
+        r, done = self.resume_whole(remote)
+
+        self.digest = hashlib.sha256()
+        if r is not None:
+            with open(self.part_path, "rb") as f:
+                for block in iter(lambda: f.read(self.chunk_size), b""):
+                    self.digest.update(block)
+        else:
+            r = requests.get(
+                self.url, params=self.params, headers=IDENTITY, stream=True, timeout=self.timeout
+            )
+            r.raise_for_status()
+            self.save_progress({"remote": remote})
+
+        with open(self.part_path, "ab" if done else "wb") as f:
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    self.digest.update(chunk)
+
+    def verify(self, remote):
+        if remote["size"] is not None:
+            size = os.path.getsize(self.part_path)
+            if size != remote["size"]:
+                raise DownloadError(
+                    f"{self.part_path} is {size} bytes, expected {remote['size']} bytes"
+                )
+
+        if self.digest is not None:
+            fingerprint = self.digest.hexdigest()
+        else:
+            # Ranges arrive out of order so they can't be hashed on the way in
+            fingerprint = file_fingerprint(self.part_path)
+
+        if self.sha256 and fingerprint != self.sha256:
+            raise DownloadError(f"{self.part_path} failed checksum verification")
+
+        self.fingerprint = fingerprint
+
+    def download(self):
+        remote = self.probe()
+
+        if remote["ranged"]:
+            self.fetch_ranged(remote)
+        else:
+            self.fetch_whole(remote)
+
+        try:
+            self.verify(remote)
+        except DownloadError:
+            # Don't resume from bytes we know are bad
+            for path in (self.part_path, self.progress_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+        os.replace(self.part_path, self.filepath)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+        return self.filepath
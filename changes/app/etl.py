@@ -1,14 +1,20 @@
+import csv
 import logging
 import os
+import tempfile
 import time
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 
 import psycopg2
 import requests
+from app.archive import SnapshotArchive
+from app.download import RangedDownloader, TeeReader
 from app.extensions import db
+from app.loader import RowValidator, ValidatedCopy
+from app.snapshot_diff import SnapshotDiff
 from flask import current_app
 from sqlalchemy import text
-from sqlalchemy.exc import ProgrammingError
 
 # Configure logging
 logging.basicConfig(
@@ -66,125 +72,794 @@ COLS = [
     "location",
 ]
 
+# Bookkeeping columns on every version in the dat table, ahead of COLS
+META_COLS = [
+    "row_id",
+    "start_date",
+    "end_date",
+    "current_flag",
+    "deleted_flag",
+    "deleted_on",
+    "dup_ver",
+    "source_filename",
+]
+
+# Columns that merge_rows compares
+TRACKED_COLS = [
+    "id",
+    "orig_date",
+    "iucr",
+    "primary_type",
+    "description",
+    "location_description",
+    "arrest",
+    "domestic",
+    "fbi_code",
+]
+
+# md5 over the tracked columns, kept as a uuid so that comparing two rows is
+# a single fixed width comparison. quote_nullable keeps NULLs distinct from
+# strings and the epoch keeps the timestamp immutable (its text form depends
+# on DateStyle), so this can back a generated column.
+ROW_HASH = """
+    row_hash UUID GENERATED ALWAYS AS (
+      md5({0})::uuid
+    ) STORED,
+""".format(
+    " || ',' || ".join(
+        (
+            "quote_nullable(extract(epoch FROM {0})::text)"
+            if col == "orig_date"
+            else "quote_nullable({0}::text)"
+        ).format(col)
+        for col in TRACKED_COLS
+    )
+)
+
+# The columns that differ between two versions of a record along with their
+# values on either side. {old} and {new} are the two rows; it's meant to be
+# joined LATERAL and yields NULLs when nothing differs.
+CHANGE_EVENT = """
+    SELECT
+      array_agg(o.key ORDER BY array_position(:cols, o.key)) AS changed_fields,
+      jsonb_object_agg(o.key, o.value) AS old_values,
+      jsonb_object_agg(o.key, n.value) AS new_values
+    FROM jsonb_each(to_jsonb({old})) AS o
+    JOIN jsonb_each(to_jsonb({new})) AS n
+      USING (key)
+    WHERE o.key = ANY(:cols)
+      AND o.value IS DISTINCT FROM n.value
+"""
+
+# Full rows for every version in the dat table. Versions that have been
+# replaced only keep the columns that differ from the version after them
+# (listed in delta_cols), so the rest are filled in from the nearest later
+# version that has them. Versions from before that have delta_cols NULL and
+# are complete already.
+VERSIONS_VIEW = """
+    CREATE OR REPLACE VIEW dat_chicago_crime_versions AS
+      SELECT
+        {meta},
+        v.id,
+        {cols},
+        v.index_code
+      FROM dat_chicago_crime AS v
+      CROSS JOIN LATERAL jsonb_populate_record(
+        NULL::dat_chicago_crime,
+        CASE WHEN v.delta_cols IS NOT NULL THEN
+          COALESCE((
+            SELECT jsonb_object_agg(c.key, c.value ORDER BY w.start_date DESC)
+            FROM dat_chicago_crime AS w
+            CROSS JOIN LATERAL jsonb_each(to_jsonb(w)) AS c
+            WHERE w.id = v.id
+              AND w.start_date > v.start_date
+              AND COALESCE(w.dup_ver, 1) = 1
+              AND c.key = ANY(ARRAY[{names}])
+              AND (w.delta_cols IS NULL OR c.key = ANY(w.delta_cols))
+          ), '{{}}') || COALESCE((
+            SELECT jsonb_object_agg(c.key, c.value)
+            FROM jsonb_each(to_jsonb(v)) AS c
+            WHERE c.key = ANY(v.delta_cols)
+          ), '{{}}')
+        END
+      ) AS r
+""".format(
+    meta=",".join(f"v.{col}" for col in META_COLS),
+    cols=",".join(
+        f"CASE WHEN v.delta_cols IS NULL THEN v.{col} ELSE r.{col} END AS {col}"
+        for col in COLS
+        if col != "id"
+    ),
+    names=",".join(f"'{col}'" for col in COLS if col != "id"),
+)
+
+# index_code from the IUCR reference data for the row aliased {0}. The crime
+# data pads codes to four characters and the reference data doesn't, so both
+# are matched on the padded code, which the iucr table keeps as iucr_key.
+INDEX_CODE = """
+    (SELECT i.index_code FROM iucr AS i
+     WHERE i.iucr_key = lpad({0}.iucr, 4, '0')
+     ORDER BY i.iucr
+     LIMIT 1)
+"""
+
+# Reclassifications between FBI index and non-index crimes, one row for each
+# version whose index_code differs from the version before it. The new
+# versions come from {versions}, which has to have full rows for all of them,
+# and {join} and {where} narrow down which are looked at. The version before
+# only keeps the columns that changed (see flag_changes()), so the rest of
+# its values come from the new one.
+INDEX_CODE_CHANGES = """
+    INSERT INTO index_code_changes (
+      id,
+      changed_on,
+      district,
+      from_index_code,
+      to_index_code,
+      from_iucr,
+      to_iucr,
+      from_fbi_code,
+      to_fbi_code,
+      from_description,
+      to_description
+    )
+    SELECT
+      n.id,
+      n.start_date AS changed_on,
+      n.district,
+      o.index_code AS from_index_code,
+      n.index_code AS to_index_code,
+      {iucr} AS from_iucr,
+      n.iucr AS to_iucr,
+      {fbi_code} AS from_fbi_code,
+      n.fbi_code AS to_fbi_code,
+      {primary_type} || ' - ' || {description} AS from_description,
+      n.primary_type || ' - ' || n.description AS to_description
+    FROM {{versions}} AS n
+    {{join}}
+    CROSS JOIN LATERAL (
+      SELECT * FROM dat_chicago_crime AS p
+      WHERE p.id = n.id
+        AND p.start_date < n.start_date
+        AND COALESCE(p.dup_ver, 1) = 1
+      ORDER BY p.start_date DESC
+      LIMIT 1
+    ) AS o
+    WHERE COALESCE(n.dup_ver, 1) = 1
+      AND o.index_code IN ('I', 'N')
+      AND n.index_code IN ('I', 'N')
+      AND o.index_code <> n.index_code
+      {{where}}
+    ON CONFLICT (id, changed_on) DO NOTHING
+""".format(
+    **{
+        col: f"CASE WHEN o.delta_cols IS NULL OR '{col}' = ANY(o.delta_cols) "
+        f"THEN o.{col} ELSE n.{col} END"
+        for col in ["iucr", "fbi_code", "primary_type", "description"]
+    }
+)
+
+# Add up counts of the (id, file_date, change_type, field) rows in {0} into
+# daily_changes, by the current version of each record
+ROLLUP = """
+    INSERT INTO daily_changes (
+      file_date,
+      change_type,
+      field,
+      district,
+      community_area,
+      primary_type,
+      records
+    )
+    SELECT
+      c.file_date,
+      c.change_type,
+      c.field,
+      COALESCE(d.district, ''),
+      COALESCE(d.community_area, ''),
+      COALESCE(d.primary_type, ''),
+      COUNT(*)
+    FROM ({0}) AS c
+    JOIN dat_chicago_crime AS d
+      ON d.id = c.id
+      AND d.current_flag = TRUE
+      AND COALESCE(d.dup_ver, 1) = 1
+    GROUP BY 1, 2, 3, 4, 5, 6
+    ON CONFLICT (file_date, change_type, field, district, community_area, primary_type)
+    DO UPDATE SET
+      records = daily_changes.records + EXCLUDED.records
+"""
+
+# Reclassifications by direction, for ROLLUP
+RECLASSIFIED = """
+    SELECT
+      id,
+      CAST(changed_on AS DATE) AS file_date,
+      'reclassified' AS change_type,
+      CASE WHEN to_index_code = 'I' THEN 'to-index' ELSE 'to-non-index' END AS field
+    FROM index_code_changes
+"""
+
+# When a new version starts and the old one ends. That's the time of the run
+# unless the ETL was asked to date versions by their snapshot, see
+# ETL.version_time()
+VERSION_TIME = "COALESCE(:version_time, LOCALTIMESTAMP)"
+
+PORTAL_URL = "https://data.cityofchicago.org"
+
+# How often to look at replica lag while waiting for the replicas to catch up
+REPLICA_POLL_SECONDS = 1
+
 
 class ETL(object):
-    def __init__(self, storage_dir, file_date=None):
+    def __init__(
+        self,
+        storage_dir,
+        file_date=None,
+        stream=False,
+        resume=False,
+        delta=False,
+        backdate=False,
+        verify=False,
+    ):
         self.storage_dir = os.path.abspath(storage_dir)
         self.file_date = file_date
+        self.stream = stream
+        self.resume = resume
+        self.delta = delta
+        self.backdate = backdate
+        self.verify = verify
+        self.silent_changes = None
+        self.fingerprints = {}
+        self.rejected_rows = 0
+        self.connection = None
+        self.batch = None
+        self.publish_time = None
+        self.archive = SnapshotArchive(
+            self.storage_dir,
+            compression=current_app.config["ARCHIVE_COMPRESSION"],
+            retention_days=current_app.config["ARCHIVE_RETENTION_DAYS"],
+        )
 
         if not self.file_date:
             self.file_date = datetime.now()
 
         self.table_setup()
 
+    def version_time(self):
+        """
+        Versions normally start when they're loaded. When replaying old
+        snapshots they start on the snapshot's date instead, or the history
+        would say everything changed on the day of the backfill.
+
+        A run published in batches fixes the time up front, so that every
+        batch's versions start at the same moment.
+        """
+        if self.publish_time is not None:
+            return self.publish_time
+        if self.backdate:
+            return self.file_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        return None
+
+    @contextmanager
+    def staging(self):
+        """
+        Transaction for work on the scratch tables, which nobody else reads
+        and which get rebuilt from the snapshot if we lose them, so there's
+        no point waiting for the commit to be flushed.
+        """
+        with db.engine.begin() as curs:
+            curs.execute(text("SET LOCAL synchronous_commit TO OFF"))
+            yield curs
+
+    @contextmanager
+    def publish(self):
+        """
+        Run the steps that change what the site shows in a single
+        transaction, so readers see all of a day's changes (or of a batch of
+        them, see publish_in_batches()) or none of them.
+        """
+        with db.engine.begin() as curs:
+            self.connection = curs
+            try:
+                yield curs
+            finally:
+                self.connection = None
+
+    def transaction(self):
+        """
+        The publish transaction if there is one, otherwise a new one
+        """
+        if self.connection is not None:
+            return nullcontext(self.connection)
+        return db.engine.begin()
+
+    def batch_filter(self, column="m.id"):
+        """
+        Condition limiting a publish step to the ids in the current batch,
+        or nothing when everything is published at once
+        """
+        if self.batch is None:
+            return ""
+        after, end = self.batch
+        return f"AND {column} > {int(after)} AND {column} <= {int(end)}"
+
     def table_setup(self):
+        self.make_meta_table()
         self.update_iucr_table()
         self.make_data_table()
-        self.make_meta_table()
+        self.make_event_table()
+        self.make_reject_table()
+        self.make_changed_table()
+        self.make_index_code_table()
+        self.make_rollup_table()
 
     def run(self):
         logger.info(f"Starting ETL process for date: {self.file_date.strftime('%Y-%m-%d')}")
 
-        try:
-            filename = self.download_file("chicago-crime", "ijzp-q8t2")
-            logger.info(f"Downloaded file: {filename}")
-        except requests.RequestException as e:
-            logger.error(f"Network error downloading data file: {e}")
-            raise
-        except OSError as e:
-            logger.error(f"File system error during download: {e}")
-            raise
-
-        try:
-            contents = open(os.path.join(self.storage_dir, filename), "rb")
-        except FileNotFoundError:
-            logger.error(f"Downloaded file not found: {filename}")
-            raise
-        except PermissionError:
-            logger.error(f"Permission denied accessing file: {filename}")
-            raise
+        filename = self.snapshot_filename("chicago-crime")
+        completed = self.completed_steps(filename) if self.resume else []
 
-        logger.info("Creating source table")
-        self.make_source_table()
+        if "publish" in completed:
+            logger.info(f"{filename} has already been published")
+            return
 
-        try:
-            logger.info("Loading source data")
-            start = time.time()
-            self.insert_source_data(contents)
-            duration = time.time() - start
-            logger.info(f"Data insert completed in {duration:.2f} seconds")
-            contents.close()
+        if completed:
+            logger.info(f"Resuming {filename} after the {completed[-1]} step")
+            self.rejected_rows = self.count_rejects()
             proceed = True
-        except psycopg2.DataError as e:
-            contents.close()
-            logger.error(f"Data format error during insert: {e}")
-            self.update_meta_table(filename, "failed - data format error")
-            proceed = False
-        except psycopg2.OperationalError as e:
-            contents.close()
-            logger.error(f"Database connection error: {e}")
-            self.update_meta_table(filename, "failed - database error")
-            proceed = False
-        except UnicodeDecodeError as e:
-            contents.close()
-            logger.error(f"File encoding error: {e}")
-            self.update_meta_table(filename, "failed - encoding error")
-            proceed = False
+        else:
+            self.clear_checkpoints(filename)
+            start = time.time()
+
+            if self.stream and not self.archive.has(filename):
+                logger.info("Creating source table")
+                self.make_source_table()
+
+                try:
+                    proceed = self.stream_source_data("chicago-crime", "ijzp-q8t2")
+                except requests.RequestException as e:
+                    logger.error(f"Network error streaming data file: {e}")
+                    raise
+                except OSError as e:
+                    logger.error(f"File system error during download: {e}")
+                    raise
+            else:
+                try:
+                    filename = self.download_file("chicago-crime", "ijzp-q8t2")
+                    logger.info(f"Downloaded file: {filename}")
+                except requests.RequestException as e:
+                    logger.error(f"Network error downloading data file: {e}")
+                    raise
+                except OSError as e:
+                    logger.error(f"File system error during download: {e}")
+                    raise
+
+                if self.unchanged_snapshot("chicago-crime", filename):
+                    self.update_meta_table(
+                        filename, "no-change", self.snapshot_fingerprint(filename)
+                    )
+                    return
+
+                try:
+                    contents = self.archive.open(filename)
+                except FileNotFoundError:
+                    logger.error(f"Downloaded file not found: {filename}")
+                    raise
+                except PermissionError:
+                    logger.error(f"Permission denied accessing file: {filename}")
+                    raise
+
+                logger.info("Creating source table")
+                self.make_source_table()
+
+                base = self.base_snapshot("chicago-crime", filename) if self.delta else None
+                with contents:
+                    if base:
+                        proceed = self.load_delta(base, filename)
+                    else:
+                        proceed = self.load_source_data(filename, contents)
+
+            if proceed and self.stream and self.unchanged_snapshot("chicago-crime", filename):
+                self.update_meta_table(filename, "no-change", self.snapshot_fingerprint(filename))
+                return
+
+            if proceed:
+                self.checkpoint(filename, "load", "completed", start, "src_chicago_crime")
+            else:
+                self.checkpoint(filename, "load", "failed", start)
 
         if proceed:
+            self.apply_changes(filename, completed)
+            self.archive.prune()
+            logger.info("ETL process completed successfully")
+
+    def apply_changes(self, filename, completed=()):
+        """
+        Everything after the source table is loaded: dedup, merge and
+        publish, skipping the steps in completed.
+        """
+        if "dedup" not in completed:
             logger.info("Starting deduplication process")
             start = time.time()
-            self.make_new_dup_tables()
-            self.find_dup_rows()
+            with self.checkpointed(filename, "dedup", "dup_chicago_crime"):
+                self.make_dup_table()
+                self.find_dup_rows()
             logger.info(f"Deduplication completed in {time.time() - start:.2f} seconds")
 
-            logger.info("Processing new records")
+        if "merge" not in completed:
+            logger.info("Merging incoming records with current records")
             start = time.time()
-            self.find_new_rows()
-            self.insert_new_rows(filename)
-            logger.info(f"New records processing completed in {time.time() - start:.2f} seconds")
+            with self.checkpointed(filename, "merge", "mrg_chicago_crime"):
+                self.merge_rows()
+            logger.info(f"Merge completed in {time.time() - start:.2f} seconds")
 
-            logger.info("Detecting changes")
-            start = time.time()
-            self.find_changed_rows()
-            logger.info(f"Change detection completed in {time.time() - start:.2f} seconds")
+            # A new merge is compared against whatever batches were already
+            # published, so publishing starts over from the first id
+            self.clear_checkpoints(filename, "publish")
+        else:
+            self.silent_changes = self.merged_silent_changes(filename)
 
-            logger.info("Updating change flags")
-            self.flag_changes()
+        logger.info("Publishing changes")
+        start = time.time()
+        batch_size = current_app.config["APPLY_BATCH_SIZE"]
+        if batch_size:
+            self.publish_in_batches(filename, batch_size)
+        else:
+            with self.publish(), self.checkpointed(filename, "publish"):
+                self.publish_changes(filename)
+                self.mark_published(filename)
+        logger.info(f"Changes published in {time.time() - start:.2f} seconds")
 
-            logger.info("Updating deletion flags")
-            self.flag_deletions()
+    def publish_changes(self, filename):
+        """
+        Apply the merge's results to the tables the site reads, limited to
+        the current batch if there is one
+        """
+        logger.info("Processing new records")
+        self.insert_new_rows(filename)
 
-            logger.info("Refreshing materialized views")
-            self.update_view()
+        logger.info("Updating change flags")
+        self.flag_changes()
 
-            self.update_meta_table(filename, "success")
-            logger.info("ETL process completed successfully")
+        logger.info("Updating deletion flags")
+        self.flag_deletions()
 
-    def download_file(self, download_type, fourbyfour):
+        logger.info("Updating changed records")
+        self.update_changed_records()
+
+        logger.info("Updating index code changes")
+        self.update_index_code_changes()
+
+        logger.info("Updating daily change counts")
+        self.update_daily_changes()
+
+    def mark_published(self, filename):
+        """
+        Record the run as a success along with how many rows changed_records
+        has now, which the API reports rather than counting them itself
+        """
+        with self.transaction() as curs:
+            changed_records = curs.execute(text("SELECT COUNT(*) FROM changed_records")).scalar()
+
+        self.update_meta_table(
+            filename,
+            "success",
+            self.snapshot_fingerprint(filename),
+            rejected_rows=self.rejected_rows,
+            silent_changes=self.silent_changes,
+            changed_records=changed_records,
+        )
+
+    def publish_in_batches(self, filename, batch_size):
+        """
+        Publish the merge's results batch_size records at a time in id
+        order, each batch in its own transaction. No transaction locks more
+        than a batch of records or writes more than a batch's worth of WAL,
+        so a day when most of the file changed doesn't hold up the site or
+        the replicas. With APPLY_MAX_REPLICA_LAG set, each batch waits until
+        no replica is further behind than that, so they can keep up. A fixed
+        APPLY_BATCH_PAUSE seconds between batches is available as well.
+
+        Everything for an id happens in the same batch, and each batch's
+        checkpoint commits with it, so a resumed run carries on after the
+        last id that was published with the same version time. The cost is
+        that readers can see a day that's only partly published. The run is
+        only marked a success once the last batch is in.
+        """
+        pause = current_app.config["APPLY_BATCH_PAUSE"]
+        max_lag = current_app.config["APPLY_MAX_REPLICA_LAG"]
+        start = time.time()
+        last_id, self.publish_time = self.publish_progress(filename)
+
+        remaining = """
+            SELECT COUNT(*) FROM mrg_chicago_crime
+            WHERE (action IN ('new', 'changed', 'deleted') OR restored)
+              AND id > :after
+        """
+        next_batch = """
+            SELECT MAX(id), COUNT(*) FROM (
+              SELECT id FROM mrg_chicago_crime
+              WHERE (action IN ('new', 'changed', 'deleted') OR restored)
+                AND id > :after
+              ORDER BY id
+              LIMIT :batch_size
+            ) AS b
+        """
+        with db.engine.begin() as curs:
+            total = curs.execute(text(remaining), {"after": last_id}).scalar()
+        logger.info(f"Publishing {total} records in batches of {batch_size}")
+
+        done = 0
+        try:
+            while True:
+                with db.engine.begin() as curs:
+                    end, count = curs.execute(
+                        text(next_batch), {"after": last_id, "batch_size": batch_size}
+                    ).fetchone()
+                if end is None:
+                    break
+
+                if max_lag:
+                    self.wait_for_replicas(max_lag)
+
+                self.batch = (last_id, end)
+                with self.publish():
+                    self.publish_changes(filename)
+                    self.checkpoint(filename, "publish", "partial", start, last_id=end)
+
+                last_id = end
+                done += count
+                logger.info(f"Published {done} of {total} records, up to id {end}")
+                if pause:
+                    time.sleep(pause)
+
+            self.batch = None
+            with self.publish():
+                self.mark_published(filename)
+                self.checkpoint(filename, "publish", "completed", start, last_id=last_id)
+        except Exception:
+            self.failed_checkpoint(filename, "publish", start)
+            raise
+        finally:
+            self.batch = None
+            self.publish_time = None
+
+    def replica_lag(self):
+        """
+        Seconds the replica furthest behind is from having replayed what has
+        been written here, 0 without any replicas. The database user needs
+        pg_read_all_stats (or to be a superuser) to see the lag.
+        """
+        query = """
+            SELECT COALESCE(EXTRACT(EPOCH FROM MAX(replay_lag)), 0)
+            FROM pg_stat_replication
+        """
+        with db.engine.begin() as curs:
+            return float(curs.execute(text(query)).scalar())
+
+    def wait_for_replicas(self, max_lag):
+        """
+        Hold off until every replica is within max_lag seconds
+        """
+        lag = self.replica_lag()
+        while lag > max_lag:
+            logger.info(f"Replicas are {lag:.1f} seconds behind, waiting")
+            time.sleep(REPLICA_POLL_SECONDS)
+            lag = self.replica_lag()
+
+    def publish_progress(self, filename):
+        """
+        The last id published and the version time of a run that stopped
+        part way through its batches. A new run starts before the first id
+        in the merge, at the current time.
+        """
+        progress = """
+            SELECT last_id, version_time FROM etl_steps
+            WHERE filename = :filename
+              AND step = 'publish'
+              AND last_id IS NOT NULL
+        """
+        first = """
+            SELECT
+              COALESCE(MIN(id), 0) - 1,
+              CAST({version_time} AS TIMESTAMP)
+            FROM mrg_chicago_crime
+        """.format(
+            version_time=VERSION_TIME
+        )
+        with db.engine.begin() as curs:
+            row = curs.execute(text(progress), {"filename": filename}).fetchone()
+            if row is None:
+                row = curs.execute(text(first), {"version_time": self.version_time()}).fetchone()
+            else:
+                logger.info(f"Resuming publish after id {row[0]}")
+        return row[0], row[1]
+
+    # The steps a run checkpoints, in order, and the staging table each one
+    # leaves behind for the next
+    STEPS = [
+        ("load", "src_chicago_crime"),
+        ("dedup", "dup_chicago_crime"),
+        ("merge", "mrg_chicago_crime"),
+        ("publish", None),
+    ]
+
+    def checkpoint(self, filename, step, status, start, table=None, last_id=None):
+        """
+        Record how a step went along with the number of rows in the staging
+        table it produced, which is how a resumed run knows it can trust it.
+        Publishing in batches also records the last id published and the
+        version time it used, and the merge records how many silent changes
+        it found for a resumed run that skips it to report.
+        """
+        upsert = """
+            INSERT INTO etl_steps (
+              filename, step, status, row_count, duration, last_id, version_time, silent_changes
+            )
+            VALUES (
+              :filename, :step, :status, :row_count, :duration, :last_id, :version_time,
+              :silent_changes
+            )
+            ON CONFLICT (filename, step) DO UPDATE SET
+              status = EXCLUDED.status,
+              row_count = EXCLUDED.row_count,
+              duration = EXCLUDED.duration,
+              last_id = EXCLUDED.last_id,
+              version_time = EXCLUDED.version_time,
+              silent_changes = EXCLUDED.silent_changes,
+              finished_at = NOW()
+        """
+        with self.transaction() as curs:
+            row_count = None
+            if table and status == "completed":
+                row_count = curs.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+
+            curs.execute(
+                text(upsert),
+                {
+                    "filename": filename,
+                    "step": step,
+                    "status": status,
+                    "row_count": row_count,
+                    "duration": time.time() - start,
+                    "last_id": last_id,
+                    "version_time": self.publish_time if last_id is not None else None,
+                    "silent_changes": self.silent_changes if step == "merge" else None,
+                },
+            )
+
+    @contextmanager
+    def checkpointed(self, filename, step, table=None):
+        """
+        Checkpoint a step as completed when the block finishes and as failed
+        if it raises. Inside publish() the completed checkpoint commits along
+        with everything else.
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.failed_checkpoint(filename, step, start)
+            raise
+
+        self.checkpoint(filename, step, "completed", start, table)
+
+    def failed_checkpoint(self, filename, step, start):
+        """
+        Record a step as failed. Not in the publish transaction, which is
+        about to be rolled back, and leaving any progress through the
+        batches alone.
+        """
+        upsert = """
+            INSERT INTO etl_steps (filename, step, status, duration)
+            VALUES (:filename, :step, 'failed', :duration)
+            ON CONFLICT (filename, step) DO UPDATE SET
+              status = EXCLUDED.status,
+              duration = EXCLUDED.duration,
+              finished_at = NOW()
+        """
+        with db.engine.begin() as curs:
+            curs.execute(
+                text(upsert),
+                {"filename": filename, "step": step, "duration": time.time() - start},
+            )
+
+    def completed_steps(self, filename):
+        """
+        The steps a resumed run can skip: those completed in order whose
+        staging tables are still there with the rows they had. Unlogged
+        tables come back empty after a database crash, in which case the
+        step has to run again.
+        """
+        query = """
+            SELECT step, row_count FROM etl_steps
+            WHERE filename = :filename
+              AND status = 'completed'
+        """
+        exists = "SELECT to_regclass(:table) IS NOT NULL"
+
+        with db.engine.begin() as curs:
+            checkpoints = dict(curs.execute(text(query), {"filename": filename}).fetchall())
+
+            completed = []
+            for step, table in self.STEPS:
+                if step not in checkpoints:
+                    break
+                if table:
+                    if not curs.execute(text(exists), {"table": table}).scalar():
+                        break
+                    count = curs.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                    if count != checkpoints[step]:
+                        logger.info(f"{table} doesn't match its checkpoint, redoing {step}")
+                        break
+                completed.append(step)
+
+        return completed
+
+    def merged_silent_changes(self, filename):
+        query = """
+            SELECT silent_changes FROM etl_steps
+            WHERE filename = :filename
+              AND step = 'merge'
+        """
+        with db.engine.begin() as curs:
+            return curs.execute(text(query), {"filename": filename}).scalar()
+
+    def clear_checkpoints(self, filename, step=None):
+        delete = "DELETE FROM etl_steps WHERE filename = :filename"
+        if step:
+            delete += " AND step = :step"
+        with db.engine.begin() as curs:
+            curs.execute(text(delete), {"filename": filename, "step": step})
+
+    def count_rejects(self):
+        query = "SELECT COUNT(*) FROM rej_chicago_crime WHERE file_date = :file_date"
+        with db.engine.begin() as curs:
+            return curs.execute(
+                text(query), {"file_date": self.file_date.strftime("%Y-%m-%d")}
+            ).scalar()
+
+    def snapshot_filename(self, download_type):
         filedate = self.file_date.strftime("%Y-%m-%d.csv")
-        filename = f"{download_type}-{filedate}"
+        return f"{download_type}-{filedate}"
+
+    def download_params(self, fourbyfour):
+        url = f"{PORTAL_URL}/api/views/{fourbyfour}/rows.csv"
+        params = {
+            "fourfour": fourbyfour,
+            "accessType": "DOWNLOAD",
+        }
+        return url, params
+
+    def request_download(self, fourbyfour):
+        url, params = self.download_params(fourbyfour)
+
+        r = requests.get(url, params=params, stream=True, timeout=30)
+        r.raise_for_status()
+        return r
+
+    def download_file(self, download_type, fourbyfour):
+        filename = self.snapshot_filename(download_type)
         filepath = os.path.join(self.storage_dir, filename)
 
-        if not os.path.exists(filepath):
+        if not self.archive.has(filename):
             logger.info(f"Downloading {download_type} data from Chicago Data Portal")
             start = time.time()
 
-            params = {
-                "fourfour": fourbyfour,
-                "accessType": "DOWNLOAD",
-            }
-            url = f"https://data.cityofchicago.org/api/views/{fourbyfour}/rows.csv"
+            url, params = self.download_params(fourbyfour)
+            downloader = RangedDownloader(
+                url,
+                filepath,
+                params=params,
+                workers=current_app.config["DOWNLOAD_WORKERS"],
+            )
 
             try:
-                r = requests.get(url, params=params, stream=True, timeout=30)
-                r.raise_for_status()
-
-                with open(filepath, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-                            f.flush()
+                downloader.download()
+                self.archive.add(
+                    filename, filepath, self.file_date, fingerprint=downloader.fingerprint
+                )
 
                 download_duration = time.time() - start
                 logger.info(
@@ -205,6 +880,181 @@ class ETL(object):
 
         return filename
 
+    def stream_source_data(self, download_type, fourbyfour):
+        """
+        Feed the portal download straight into COPY while archiving it, so
+        that the download and the load overlap. The snapshot is archived
+        whether or not the load succeeds.
+        """
+        filename = self.snapshot_filename(download_type)
+
+        logger.info(f"Streaming {download_type} data from Chicago Data Portal into COPY")
+        start = time.time()
+
+        r = self.request_download(fourbyfour)
+        writer = self.archive.writer(filename)
+        contents = TeeReader(r, writer)
+
+        def archive_stream():
+            if filename not in self.fingerprints:
+                contents.finish()
+                self.archive.commit(filename, writer, contents.fingerprint, self.file_date)
+                self.fingerprints[filename] = contents.fingerprint
+                logger.info(f"Archived streamed file: {filename}")
+
+        def reopen():
+            # The COPY stopped partway through the stream, so fetch the rest
+            # into the archive and validate the whole file from there
+            archive_stream()
+            return self.archive.open(filename)
+
+        try:
+            proceed = self.load_source_data(filename, contents, reopen)
+        except Exception:
+            # Keep the day's snapshot even though the load failed, unless the
+            # download itself is what broke
+            try:
+                archive_stream()
+            except (requests.RequestException, OSError):
+                writer.discard()
+            raise
+        else:
+            archive_stream()
+        finally:
+            r.close()
+
+        logger.info(f"{download_type} stream completed in {time.time() - start:.2f} seconds")
+
+        return proceed
+
+    def snapshot_fingerprint(self, filename):
+        """
+        sha256 of a snapshot's uncompressed contents
+        """
+        if filename not in self.fingerprints:
+            self.fingerprints[filename] = self.archive.fingerprint(filename)
+
+        return self.fingerprints[filename]
+
+    def unchanged_snapshot(self, download_type, filename):
+        """
+        Check whether a snapshot is byte-identical to the last one of the
+        same type that was loaded successfully.
+        """
+        query = """
+            SELECT fingerprint
+            FROM etl_tracker
+            WHERE filename LIKE :pattern
+              AND etl_status = 'success'
+            ORDER BY date_added DESC
+            LIMIT 1
+        """
+        with db.engine.begin() as curs:
+            last = curs.execute(text(query), {"pattern": f"{download_type}-%"}).first()
+
+        if last and last.fingerprint == self.snapshot_fingerprint(filename):
+            logger.info(f"{filename} is identical to the last {download_type} load, skipping")
+            return True
+
+        return False
+
+    def last_loaded(self, download_type):
+        """
+        Filename and file date of the last snapshot of a type that was loaded
+        successfully, or None.
+        """
+        query = """
+            SELECT filename, file_date
+            FROM etl_tracker
+            WHERE filename LIKE :pattern
+              AND etl_status = 'success'
+            ORDER BY date_added DESC
+            LIMIT 1
+        """
+        with db.engine.begin() as curs:
+            return curs.execute(text(query), {"pattern": f"{download_type}-%"}).first()
+
+    def base_snapshot(self, download_type, filename):
+        """
+        The last snapshot of the same type that was loaded successfully, if
+        it's still in the archive to diff against.
+        """
+        last = self.last_loaded(download_type)
+
+        if last and last.filename != filename and self.archive.has(last.filename):
+            return last.filename
+
+        return None
+
+    def load_delta(self, base, filename):
+        """
+        Diff the snapshot against the last one loaded and only load the rows
+        that differ, with the ids that have gone away in rmv_chicago_crime.
+        Returns whether the rest of the ETL should proceed, like
+        load_source_data().
+        """
+        logger.info(f"Diffing {filename} against {base}")
+        start = time.time()
+
+        diff = SnapshotDiff(COLS, TRACKED_COLS, work_dir=self.storage_dir)
+        with tempfile.TemporaryFile(dir=self.storage_dir) as delta:
+            with self.archive.open(base) as old, self.archive.open(filename) as new:
+                deleted, _ = diff.write_delta(old, new, delta)
+            logger.info(f"Diff completed in {time.time() - start:.2f} seconds")
+
+            def rewind():
+                delta.seek(0)
+                return nullcontext(delta)
+
+            delta.seek(0)
+            proceed = self.load_source_data(filename, delta, rewind)
+
+        if proceed:
+            self.make_removed_table(deleted)
+
+        return proceed
+
+    def load_source_data(self, filename, contents, reopen=None):
+        """
+        Run the COPY for the source table and record a failed run in the
+        meta table if the data can't be loaded. Returns whether the rest of
+        the ETL should proceed.
+
+        With VALIDATE_ROWS on, a file the COPY turns away is loaded again
+        from reopen() (the archived snapshot by default) through the
+        validated loader, which sets the bad rows aside.
+        """
+        if reopen is None:
+
+            def reopen():
+                return self.archive.open(filename)
+
+        try:
+            logger.info("Loading source data")
+            start = time.time()
+            try:
+                self.insert_source_data(contents)
+            except psycopg2.DataError as e:
+                if not current_app.config["VALIDATE_ROWS"]:
+                    raise
+                logger.warning(f"COPY failed, loading again with row validation: {e}")
+                with reopen() as fp:
+                    self.insert_source_data(fp, validate=True)
+            duration = time.time() - start
+            logger.info(f"Data insert completed in {duration:.2f} seconds")
+            return True
+        except psycopg2.DataError as e:
+            logger.error(f"Data format error during insert: {e}")
+            self.update_meta_table(filename, "failed - data format error")
+        except psycopg2.OperationalError as e:
+            logger.error(f"Database connection error: {e}")
+            self.update_meta_table(filename, "failed - database error")
+        except UnicodeDecodeError as e:
+            logger.error(f"File encoding error: {e}")
+            self.update_meta_table(filename, "failed - encoding error")
+
+        return False
+
     def update_iucr_table(self):
         """
         Step Zero: Make / Update IUCR table
@@ -217,9 +1067,16 @@ class ETL(object):
               primary_description VARCHAR(50),
               secondary_description VARCHAR(100),
               index_code VARCHAR(1),
-              active BOOLEAN
+              active BOOLEAN,
+              iucr_key VARCHAR(5) GENERATED ALWAYS AS (lpad(iucr, 4, '0')) STORED
             )
         """
+        # Tables from before the padded code was kept, see INDEX_CODE
+        add_key = """
+            ALTER TABLE iucr ADD COLUMN IF NOT EXISTS
+              iucr_key VARCHAR(5) GENERATED ALWAYS AS (lpad(iucr, 4, '0')) STORED
+        """
+        key_index = "CREATE INDEX IF NOT EXISTS iucr_key_index ON iucr(iucr_key)"
         drop_update = """
             DROP TABLE IF EXISTS update_iucr;
         """
@@ -234,10 +1091,18 @@ class ETL(object):
         """
         with db.engine.begin() as curs:
             curs.execute(text(create_final))
+            curs.execute(text(add_key))
+            curs.execute(text(key_index))
+
+        if self.unchanged_snapshot("iucr", filename):
+            self.update_meta_table(filename, "no-change", self.snapshot_fingerprint(filename))
+            return
+
+        with db.engine.begin() as curs:
             curs.execute(text(drop_update))
             curs.execute(text(create_update))
 
-        with open(os.path.join(self.storage_dir, filename)) as fp:
+        with self.archive.open(filename) as fp:
             copy_st = """
                 COPY update_iucr(
                   iucr,
@@ -260,8 +1125,9 @@ class ETL(object):
                         raise e
 
         update_final = """
-            INSERT INTO iucr
-            SELECT * FROM update_iucr
+            INSERT INTO iucr (iucr, primary_description, secondary_description, index_code, active)
+            SELECT iucr, primary_description, secondary_description, index_code, active
+            FROM update_iucr
             ON CONFLICT (iucr)
             DO UPDATE SET
               iucr = EXCLUDED.iucr,
@@ -273,13 +1139,131 @@ class ETL(object):
         with db.engine.begin() as curs:
             curs.execute(text(update_final))
 
+        self.resolve_index_codes()
+        self.update_meta_table(filename, "success", self.snapshot_fingerprint(filename))
+
+    def column_exists(self, table, column):
+        query = """
+            SELECT EXISTS(
+              SELECT 1 FROM information_schema.columns
+              WHERE table_schema = current_schema()
+                AND table_name = :table
+                AND column_name = :column
+            )
+        """
+        with db.engine.begin() as curs:
+            return curs.execute(text(query), {"table": table, "column": column}).scalar()
+
+    def resolve_index_codes(self):
+        """
+        Set index_code on every version from the IUCR reference data, for
+        when that changes or the column has just been added. New versions
+        get it when they're inserted. Only rows whose code comes out
+        different are written.
+
+        Replaced versions may not keep their iucr (see flag_changes()), so
+        it's resolved from the full rows in dat_chicago_crime_versions.
+        """
+        if not self.column_exists("dat_chicago_crime", "index_code"):
+            # Not set up yet, make_data_table() will call this
+            return
+
+        update_versions = """
+            UPDATE dat_chicago_crime AS d SET
+              index_code = r.index_code
+            FROM (
+              SELECT v.row_id, v.current_flag, {0} AS index_code
+              FROM dat_chicago_crime_versions AS v
+            ) AS r
+            WHERE d.row_id = r.row_id
+              AND d.current_flag = r.current_flag
+              AND d.index_code IS DISTINCT FROM r.index_code
+        """.format(
+            INDEX_CODE.format("v")
+        )
+        update_changed = """
+            UPDATE changed_records AS c SET
+              index_code = d.index_code
+            FROM dat_chicago_crime AS d
+            WHERE c.row_id = d.row_id
+              AND c.current_flag = d.current_flag
+              AND c.index_code IS DISTINCT FROM d.index_code
+        """
+        # Not there until make_changed_table() has replaced the materialized
+        # view, and it's built with index_code then
+        changed_records = self.column_exists("changed_records", "index_code")
+
+        built = "SELECT to_regclass('index_code_changes') IS NOT NULL"
+
+        with db.engine.begin() as curs:
+            resolved = curs.execute(text(update_versions)).rowcount
+            if changed_records:
+                curs.execute(text(update_changed))
+            built = curs.execute(text(built)).scalar()
+
+        # Versions that were reclassified may have gained or lost transitions
+        if resolved and built:
+            self.rebuild_index_code_changes()
+
     def make_data_table(self):
         """
-        Step One: Make the data table where the data will eventually live
+        Step One: Make the data table where the data will eventually live.
+
+        It's partitioned on current_flag so that the current version of each
+        record lives in dat_chicago_crime_current, which stays about the size
+        of one snapshot, and closed out versions move to
+        dat_chicago_crime_history as they're replaced. Everything the daily
+        run compares against only has to look at the current partition.
+        """
+        kind = "SELECT relkind FROM pg_class WHERE oid = to_regclass('dat_chicago_crime')"
+        with db.engine.begin() as curs:
+            existing = curs.execute(text(kind)).scalar()
+
+        if existing == "r":
+            self.partition_data_table()
+        else:
+            self.create_data_table("dat_chicago_crime")
+
+        flag_index = """
+            CREATE INDEX IF NOT EXISTS deleted_flag_index ON dat_chicago_crime(deleted_flag)
+        """
+        date_index = """
+            CREATE INDEX IF NOT EXISTS deleted_on_index ON dat_chicago_crime(deleted_on)
+        """
+        # Tables from before rows were hashed get the column added (and
+        # computed for every existing row) once
+        add_hash = """
+            ALTER TABLE dat_chicago_crime ADD COLUMN IF NOT EXISTS {0}
+        """.format(
+            ROW_HASH.strip().rstrip(",")
+        )
+        # Versions that have been replaced only keep the columns that changed,
+        # see flag_changes()
+        add_delta = """
+            ALTER TABLE dat_chicago_crime ADD COLUMN IF NOT EXISTS delta_cols TEXT[]
+        """
+        # Resolved from the IUCR reference data when a version is inserted,
+        # so that the site doesn't have to join to it, see INDEX_CODE
+        add_index_code = """
+            ALTER TABLE dat_chicago_crime ADD COLUMN IF NOT EXISTS index_code VARCHAR(1)
         """
+        resolved = self.column_exists("dat_chicago_crime", "index_code")
+
+        with db.engine.begin() as curs:
+            curs.execute(text(flag_index))
+            curs.execute(text(date_index))
+            curs.execute(text(add_hash))
+            curs.execute(text(add_delta))
+            curs.execute(text(add_index_code))
+            curs.execute(text(VERSIONS_VIEW))
+
+        if not resolved:
+            self.resolve_index_codes()
 
+    def create_data_table(self, name, curs=None):
+        # The partition key has to be part of every unique constraint
         create = """
-            CREATE TABLE IF NOT EXISTS dat_chicago_crime(
+            CREATE TABLE IF NOT EXISTS {1}(
               row_id SERIAL,
               start_date TIMESTAMP,
               end_date TIMESTAMP DEFAULT NULL,
@@ -289,83 +1273,324 @@ class ETL(object):
               dup_ver INTEGER,
               source_filename VARCHAR,
               {0}
-              PRIMARY KEY(row_id),
-              UNIQUE(id, start_date)
+              PRIMARY KEY(row_id, current_flag),
+              UNIQUE(id, start_date, current_flag)
+            ) PARTITION BY LIST (current_flag)
+            """.format(
+            DATA_COLS, name
+        )
+        current = """
+            CREATE TABLE IF NOT EXISTS dat_chicago_crime_current
+              PARTITION OF {0} FOR VALUES IN (TRUE)
+        """.format(
+            name
+        )
+        history = """
+            CREATE TABLE IF NOT EXISTS dat_chicago_crime_history
+              PARTITION OF {0} FOR VALUES IN (FALSE)
+        """.format(
+            name
+        )
+        if curs is None:
+            with db.engine.begin() as curs:
+                return self.create_data_table(name, curs)
+
+        curs.execute(text(create))
+        curs.execute(text(current))
+        curs.execute(text(history))
+
+    def partition_data_table(self):
+        """
+        Move a data table from before it was partitioned into a partitioned
+        one. This copies every row so it takes a while, but only once.
+
+        The changed_records materialized view from back then depends on the
+        old table, so it goes too, and make_changed_table() builds the table
+        that replaces it from the partitioned one. The versions view is put
+        back by make_data_table().
+        """
+        logger.info("Partitioning dat_chicago_crime into current and historical versions")
+        start = time.time()
+
+        # Everything but row_hash, which is generated
+        cols = ",".join(META_COLS + COLS)
+        copy = """
+            INSERT INTO dat_chicago_crime_partitioned ({0})
+            SELECT {1} FROM dat_chicago_crime
+        """.format(
+            cols, cols.replace("current_flag", "COALESCE(current_flag, FALSE)")
+        )
+        sequence = """
+            SELECT setval(
+              pg_get_serial_sequence('dat_chicago_crime_partitioned', 'row_id'),
+              COALESCE(MAX(row_id), 0) + 1,
+              false
+            )
+            FROM dat_chicago_crime_partitioned
+        """
+        is_view = "SELECT EXISTS(SELECT 1 FROM pg_matviews WHERE matviewname = 'changed_records')"
+
+        with db.engine.begin() as curs:
+            self.create_data_table("dat_chicago_crime_partitioned", curs)
+            curs.execute(text(copy))
+            curs.execute(text(sequence))
+            if curs.execute(text(is_view)).scalar():
+                curs.execute(text("DROP MATERIALIZED VIEW changed_records"))
+            curs.execute(text("DROP VIEW IF EXISTS dat_chicago_crime_versions"))
+            curs.execute(text("DROP TABLE dat_chicago_crime"))
+            curs.execute(
+                text("ALTER TABLE dat_chicago_crime_partitioned RENAME TO dat_chicago_crime")
+            )
+
+        logger.info(f"Partitioning completed in {time.time() - start:.2f} seconds")
+
+    def make_source_table(self):
+        """
+        Step Two: Make the table where we will store the incoming data. It's
+        rebuilt from the snapshot every run so there's no point paying for WAL.
+        """
+        drop = "DROP TABLE IF EXISTS src_chicago_crime"
+        # Only there when the last load was a delta
+        drop_removed = "DROP TABLE IF EXISTS rmv_chicago_crime"
+        create = """
+            CREATE UNLOGGED TABLE IF NOT EXISTS src_chicago_crime(
+              {0}
+              {1}
+              line_num SERIAL
             )
             """.format(
-            DATA_COLS
+            DATA_COLS, ROW_HASH
+        )
+        with db.engine.begin() as curs:
+            curs.execute(text(drop))
+            curs.execute(text(drop_removed))
+            curs.execute(text(create))
+
+    def make_removed_table(self, ids):
+        """
+        The ids that are in the last snapshot but not this one, when only the
+        delta between the two is loaded
+        """
+        create = """
+            CREATE UNLOGGED TABLE rmv_chicago_crime(
+              id BIGINT PRIMARY KEY
+            )
+        """
+        insert = """
+            INSERT INTO rmv_chicago_crime
+            SELECT DISTINCT unnest(CAST(:ids AS BIGINT[]))
+        """
+        with db.engine.begin() as curs:
+            curs.execute(text("DROP TABLE IF EXISTS rmv_chicago_crime"))
+            curs.execute(text(create))
+            curs.execute(text(insert), {"ids": ids})
+
+    def insert_source_data(self, fp, validate=False):
+        """
+        Step Three: Store the incoming data
+        """
+        if validate:
+            loader = ValidatedCopy(
+                current_app.config["SQLALCHEMY_DATABASE_URI"],
+                "src_chicago_crime",
+                COLS,
+                validator=RowValidator.from_columns(DATA_COLS),
+                max_rejects=current_app.config["MAX_REJECTED_ROWS"],
+            )
+            loader.load(fp)
+            self.record_rejects(loader.rejects)
+            return
+
+        copy_st = """
+            COPY src_chicago_crime({0})
+            FROM STDIN
+            WITH (FORMAT CSV, HEADER TRUE, DELIMITER',')
+        """.format(
+            ",".join(COLS)
+        )
+
+        # need the psycopg connection here so that we can use the COPY
+        # statement
+        with psycopg2.connect(current_app.config["SQLALCHEMY_DATABASE_URI"]) as conn:
+            with conn.cursor() as curs:
+                try:
+                    curs.copy_expert(copy_st, fp)
+                except psycopg2.extensions.QueryCanceledError as e:
+                    raise e
+
+        # Nothing was set aside, including by an earlier attempt at this day
+        self.record_rejects([])
+
+    def make_event_table(self):
+        """
+        One row per new version of a changed record with the columns that
+        changed and their old and new values, so that nobody has to work
+        that out again from the full versions later. Records disappearing
+        from the portal and coming back are recorded here too, as changes to
+        deleted_flag.
+        """
+        exists = "SELECT to_regclass('evt_chicago_crime') IS NOT NULL"
+        create = """
+            CREATE TABLE IF NOT EXISTS evt_chicago_crime(
+              id BIGINT,
+              file_date DATE,
+              start_date TIMESTAMP,
+              changed_fields TEXT[],
+              old_values JSONB,
+              new_values JSONB,
+              PRIMARY KEY(id, start_date)
+            )
+        """
+        with db.engine.begin() as curs:
+            existed = curs.execute(text(exists)).scalar()
+            curs.execute(text(create))
+
+        if not existed:
+            self.backfill_events()
+
+    def backfill_events(self):
+        """
+        Work out the events for history loaded before the event table
+        existed by comparing each version of a record with the one before it
+        """
+        backfill = """
+            INSERT INTO evt_chicago_crime (
+              id,
+              file_date,
+              start_date,
+              changed_fields,
+              old_values,
+              new_values
+            )
+            SELECT
+              n.id,
+              n.start_date::date AS file_date,
+              n.start_date,
+              e.changed_fields,
+              e.old_values,
+              e.new_values
+            FROM (
+              SELECT
+                d.*,
+                LAG(row_id) OVER (PARTITION BY id ORDER BY start_date) AS prev_row_id
+              FROM dat_chicago_crime_versions AS d
+            ) AS n
+            JOIN dat_chicago_crime_versions AS p
+              ON p.row_id = n.prev_row_id
+            CROSS JOIN LATERAL ({0}) AS e
+            WHERE e.changed_fields IS NOT NULL
+        """.format(
+            CHANGE_EVENT.format(old="p", new="n")
         )
-        flag_index = """
-            CREATE INDEX IF NOT EXISTS deleted_flag_index ON dat_chicago_crime(deleted_flag)
-        """
-        date_index = """
-            CREATE INDEX IF NOT EXISTS deleted_on_index ON dat_chicago_crime(deleted_on)
+
+        # Older runs overwrote deleted_on every day so this is the last date
+        # the record was seen missing, which is the best we have
+        backfill_deletions = """
+            INSERT INTO evt_chicago_crime (
+              id,
+              file_date,
+              start_date,
+              changed_fields,
+              old_values,
+              new_values
+            )
+            SELECT
+              id,
+              deleted_on::date AS file_date,
+              deleted_on AS start_date,
+              ARRAY['deleted_flag'] AS changed_fields,
+              jsonb_build_object('deleted_flag', FALSE) AS old_values,
+              jsonb_build_object('deleted_flag', TRUE) AS new_values
+            FROM dat_chicago_crime
+            WHERE current_flag = TRUE
+              AND deleted_flag = TRUE
+              AND deleted_on IS NOT NULL
+            ON CONFLICT DO NOTHING
         """
         with db.engine.begin() as curs:
-            curs.execute(text(create))
-            curs.execute(text(flag_index))
-            curs.execute(text(date_index))
+            curs.execute(text(backfill), {"cols": COLS})
+            curs.execute(text(backfill_deletions))
 
-    def make_source_table(self):
+    def make_reject_table(self):
         """
-        Step Two: Make the table where we will store the incoming data
+        Rows from the snapshot that didn't pass validation, kept around so
+        that someone can figure out what was wrong with them.
         """
-        drop = "DROP TABLE IF EXISTS src_chicago_crime"
         create = """
-            CREATE TABLE IF NOT EXISTS src_chicago_crime(
-              {0}
-              line_num SERIAL
+            CREATE TABLE IF NOT EXISTS rej_chicago_crime(
+              file_date DATE,
+              line_num INTEGER,
+              id BIGINT,
+              reason VARCHAR,
+              raw_row TEXT
             )
-            """.format(
-            DATA_COLS
-        )
+        """
+        create_index = """
+            CREATE INDEX IF NOT EXISTS rej_file_date_index ON rej_chicago_crime(file_date)
+        """
         with db.engine.begin() as curs:
-            curs.execute(text(drop))
             curs.execute(text(create))
+            curs.execute(text(create_index))
 
-    def insert_source_data(self, fp):
-        """
-        Step Three: Store the incoming data
+    def record_rejects(self, rejects):
+        delete = "DELETE FROM rej_chicago_crime WHERE file_date = :file_date"
+        insert = """
+            INSERT INTO rej_chicago_crime (file_date, line_num, id, reason, raw_row)
+            VALUES (:file_date, :line_num, :id, :reason, :raw_row)
         """
-        copy_st = """
-            COPY src_chicago_crime({0})
-            FROM STDIN
-            WITH (FORMAT CSV, HEADER TRUE, DELIMITER',')
-        """.format(
-            ",".join(COLS)
-        )
+        file_date = self.file_date.strftime("%Y-%m-%d")
 
-        # need the psycopg connection here so that we can use the COPY
-        # statement
-        with psycopg2.connect(current_app.config["SQLALCHEMY_DATABASE_URI"]) as conn:
-            with conn.cursor() as curs:
-                try:
-                    curs.copy_expert(copy_st, fp)
-                except psycopg2.extensions.QueryCanceledError as e:
-                    raise e
+        with db.engine.begin() as curs:
+            curs.execute(text(delete), {"file_date": file_date})
+            if rejects:
+                curs.execute(
+                    text(insert),
+                    [
+                        {
+                            "file_date": file_date,
+                            "line_num": line_num,
+                            "id": self.rejected_id(raw_row),
+                            "reason": reason,
+                            "raw_row": raw_row,
+                        }
+                        for line_num, reason, raw_row in rejects
+                    ],
+                )
+
+        self.rejected_rows = len(rejects)
+        if rejects:
+            logger.warning(f"Set aside {len(rejects)} rows that failed validation")
+
+    def rejected_id(self, raw_row):
+        """
+        The record a rejected row belongs to, when its id is what's usable
+        """
+        row = next(csv.reader([raw_row]), [])
+        try:
+            return int(row[COLS.index("id")])
+        except (IndexError, ValueError):
+            return None
 
-    def make_new_dup_tables(self):
+    def make_dup_table(self):
         """
-        Step Four: Make tables that we'll use to find records with the same id
-        and where we will find records that are not already in the dat table
+        Step Four: Make the table that we'll use to find records with the same id
         """
 
-        drop = "DROP TABLE IF EXISTS {0}_chicago_crime"
+        drop = "DROP TABLE IF EXISTS dup_chicago_crime"
         create = """
-            CREATE TABLE IF NOT EXISTS {0}_chicago_crime(
+            CREATE UNLOGGED TABLE IF NOT EXISTS dup_chicago_crime(
               id BIGINT,
               line_num INT,
               dup_ver INT,
               PRIMARY KEY(dup_ver, id)
             )"""
         create_index = """
-            CREATE INDEX {0}_id_ix ON {0}_chicago_crime (id)
+            CREATE INDEX dup_id_ix ON dup_chicago_crime (id)
         """
-        for table in ["new", "dup"]:
-            with db.engine.begin() as curs:
-                curs.execute(text(drop.format(table)))
-                curs.execute(text(create.format(table)))
-                curs.execute(text(create_index.format(table)))
+        with self.staging() as curs:
+            curs.execute(text(drop))
+            curs.execute(text(create))
+            curs.execute(text(create_index))
 
     def find_dup_rows(self):
         """
@@ -381,28 +1606,178 @@ class ETL(object):
               ) AS dup_ver
             FROM src_chicago_crime
         """
-        with db.engine.begin() as curs:
+        with self.staging() as curs:
             curs.execute(text(insert))
 
-    def find_new_rows(self):
+    def merge_rows(self):
         """
-        Step Six: Find records that don't already exist in the dat table
+        Step Six: Classify every id as new, changed, unchanged or deleted in
+        one pass over the deduplicated incoming data and the current rows in
+        the dat table. The steps that apply the changes all work from this.
+
+        Records that were already deleted and are still missing are
+        "missing" rather than "deleted" so that they're left alone, and
+        deleted records that turn up again are flagged as restored. Records
+        whose row was set aside by validation are still in the snapshot, so
+        they're "rejected" and left alone too.
+
+        Rows whose hashes match can't have changed, so the field by field
+        comparison only runs on the few that don't. With PREFILTER_UPDATED_ON
+        rows the portal hasn't marked as updated aren't compared at all,
+        except on the runs that check that's safe, see full_comparison().
+
+        When only the delta from the last snapshot was loaded (see
+        load_delta()) the current rows are limited to the ids in the delta,
+        since everything else is known to be unchanged.
         """
+        drop = "DROP TABLE IF EXISTS mrg_chicago_crime"
+        delta = "SELECT to_regclass('rmv_chicago_crime') IS NOT NULL"
+
+        create = """
+            CREATE UNLOGGED TABLE IF NOT EXISTS mrg_chicago_crime(
+              id BIGINT,
+              line_num INT,
+              row_id INT,
+              action VARCHAR(9),
+              restored BOOLEAN,
+              silent BOOLEAN,
+              PRIMARY KEY (id)
+            )"""
+
+        # line_num is the incoming row that won deduplication and row_id is
+        # the current version in the dat table
         insert = """
-            INSERT INTO new_chicago_crime
-            SELECT
-              id,
-              line_num,
-              dup_ver
-            FROM src_chicago_crime
-            JOIN dup_chicago_crime
-              USING (line_num, id)
-            LEFT OUTER JOIN dat_chicago_crime
-              USING(dup_ver,id)
-            WHERE row_id IS NULL
+            INSERT INTO mrg_chicago_crime
+              SELECT
+                COALESCE(s.id, d.id) AS id,
+                s.line_num,
+                d.row_id,
+                CASE
+                  WHEN d.row_id IS NULL THEN 'new'
+                  WHEN s.line_num IS NULL AND d.deleted_flag THEN 'missing'
+                  WHEN s.line_num IS NULL AND d.id IN (
+                    SELECT id FROM rej_chicago_crime
+                    WHERE file_date = :file_date
+                  ) THEN 'rejected'
+                  WHEN s.line_num IS NULL THEN 'deleted'
+                  {prefilter}
+                  WHEN s.row_hash <> d.row_hash
+                    AND (((s.id IS NOT NULL OR d.id IS NOT NULL) AND s.id <> d.id)
+                       OR ((s.orig_date IS NOT NULL OR d.orig_date IS NOT NULL) AND s.orig_date <> d.orig_date)
+                       OR ((s.iucr IS NOT NULL OR d.iucr IS NOT NULL) AND s.iucr <> d.iucr)
+                       OR ((s.primary_type IS NOT NULL OR d.primary_type IS NOT NULL) AND s.primary_type <> d.primary_type)
+                       OR ((s.description IS NOT NULL OR d.description IS NOT NULL) AND s.description <> d.description)
+                       OR ((s.location_description IS NOT NULL OR d.location_description IS NOT NULL) AND s.location_description <> d.location_description)
+                       OR ((s.arrest IS NOT NULL OR d.arrest IS NOT NULL) AND s.arrest <> d.arrest)
+                       OR ((s.domestic IS NOT NULL OR d.domestic IS NOT NULL) AND s.domestic <> d.domestic)
+                       OR ((s.fbi_code IS NOT NULL OR d.fbi_code IS NOT NULL) AND s.fbi_code <> d.fbi_code)
+                    ) THEN 'changed'
+                  ELSE 'unchanged'
+                END AS action,
+                s.line_num IS NOT NULL AND d.deleted_flag IS TRUE AS restored,
+                s.updated_on IS NOT DISTINCT FROM d.updated_on AS silent
+              FROM (
+                SELECT s.*
+                FROM src_chicago_crime AS s
+                JOIN dup_chicago_crime AS u
+                  USING (line_num, id)
+                WHERE u.dup_ver = 1
+              ) AS s
+              FULL OUTER JOIN (
+                SELECT *
+                FROM dat_chicago_crime
+                WHERE current_flag = TRUE
+                  AND COALESCE(dup_ver, 1) = 1
+                  {0}
+              ) AS d
+                USING (id)
+        """
+        in_delta = """
+                  AND id IN (
+                    SELECT id FROM src_chicago_crime
+                    UNION ALL
+                    SELECT id FROM rmv_chicago_crime
+                  )
+        """
+
+        prefilter = """
+                  WHEN s.updated_on IS NOT DISTINCT FROM d.updated_on THEN 'unchanged'
+        """
+
+        counts = """
+            SELECT action, COUNT(*) AS count
+            FROM mrg_chicago_crime
+            GROUP BY action
+            UNION ALL
+            SELECT 'restored', COUNT(*)
+            FROM mrg_chicago_crime
+            WHERE restored
+        """
+
+        # Changes the portal made without bumping updated_on, which the
+        # prefilter would have missed
+        silent = """
+            SELECT id FROM mrg_chicago_crime
+            WHERE action = 'changed'
+              AND silent
+            ORDER BY id
+        """
+
+        full = self.full_comparison()
+
+        with self.staging() as curs:
+            curs.execute(text(drop))
+            curs.execute(text(create))
+            in_delta = in_delta if curs.execute(text(delta)).scalar() else ""
+            curs.execute(
+                text(insert.format(in_delta, prefilter="" if full else prefilter)),
+                {"file_date": self.file_date.strftime("%Y-%m-%d")},
+            )
+            counts = dict(curs.execute(text(counts)).fetchall())
+            silent_ids = [r.id for r in curs.execute(text(silent))] if full else None
+
+        logger.info(
+            ", ".join(
+                f"{counts.get(action, 0)} {action}"
+                for action in ("new", "changed", "unchanged", "deleted", "restored")
+            )
+        )
+
+        self.silent_changes = None
+        if silent_ids is not None:
+            self.silent_changes = len(silent_ids)
+            if silent_ids:
+                logger.warning(
+                    f"{len(silent_ids)} records changed without updated_on changing, "
+                    f"e.g. {', '.join(str(i) for i in silent_ids[:10])}"
+                )
+
+        return counts
+
+    def full_comparison(self):
+        """
+        Whether this run compares every row rather than only the ones with a
+        new updated_on. That's always the case unless PREFILTER_UPDATED_ON is
+        on, and even then it's done when asked for (verify) or when it's
+        been VERIFY_EVERY_DAYS since the last run that did, to catch edits
+        the portal made without touching updated_on.
+        """
+        if not current_app.config["PREFILTER_UPDATED_ON"] or self.verify:
+            return True
+
+        # Runs that compared everything record how many silent changes they
+        # found, even if it's none
+        query = """
+            SELECT MAX(file_date) AS file_date
+            FROM etl_tracker
+            WHERE etl_status = 'success'
+              AND silent_changes IS NOT NULL
         """
         with db.engine.begin() as curs:
-            curs.execute(text(insert))
+            last = curs.execute(text(query)).scalar()
+
+        every = current_app.config["VERIFY_EVERY_DAYS"]
+        return last is None or (self.file_date.date() - last).days >= every
 
     def insert_new_rows(self, filename):
         """
@@ -413,133 +1788,537 @@ class ETL(object):
               start_date,
               dup_ver,
               source_filename,
+              index_code,
               {0}
             )
             SELECT
-              NOW() AS start_date,
-              n.dup_ver,
+              {version_time} AS start_date,
+              1 AS dup_ver,
               :filename AS source_filename,
+              {index_code} AS index_code,
               {0}
             FROM src_chicago_crime AS s
-            JOIN new_chicago_crime AS n
-              USING(id)
+            JOIN mrg_chicago_crime AS m
+              USING(line_num, id)
+            WHERE m.action = 'new'
+              {batch}
         """.format(
-            ",".join(COLS)
+            ",".join(COLS),
+            version_time=VERSION_TIME,
+            index_code=INDEX_CODE.format("s"),
+            batch=self.batch_filter(),
         )
-        with db.engine.begin() as curs:
-            curs.execute(text(insert), {"filename": filename})
-
-    def find_changed_rows(self):
-        """
-        Step Eight: Compare incoming data to data already in dat table to find
-        rows that have changed.
-        """
-        drop = "DROP TABLE IF EXISTS chg_chicago_crime"
-
-        create = """
-            CREATE TABLE IF NOT EXISTS chg_chicago_crime(
-              id INTEGER,
-              PRIMARY KEY (id)
-            )"""
-
-        with db.engine.begin() as curs:
-            curs.execute(text(drop))
-            curs.execute(text(create))
-
-        insert = """
-            INSERT INTO chg_chicago_crime
-              SELECT d.id
-              FROM src_chicago_crime AS s
-              JOIN dat_chicago_crime AS d
-                USING (id)
-              WHERE d.current_flag = TRUE
-                AND (((s.id IS NOT NULL OR d.id IS NOT NULL) AND s.id <> d.id)
-                   OR ((s.orig_date IS NOT NULL OR d.orig_date IS NOT NULL) AND s.orig_date <> d.orig_date)
-                   OR ((s.iucr IS NOT NULL OR d.iucr IS NOT NULL) AND s.iucr <> d.iucr)
-                   OR ((s.primary_type IS NOT NULL OR d.primary_type IS NOT NULL) AND s.primary_type <> d.primary_type)
-                   OR ((s.description IS NOT NULL OR d.description IS NOT NULL) AND s.description <> d.description)
-                   OR ((s.location_description IS NOT NULL OR d.location_description IS NOT NULL) AND s.location_description <> d.location_description)
-                   OR ((s.arrest IS NOT NULL OR d.arrest IS NOT NULL) AND s.arrest <> d.arrest)
-                   OR ((s.domestic IS NOT NULL OR d.domestic IS NOT NULL) AND s.domestic <> d.domestic)
-                   OR ((s.fbi_code IS NOT NULL OR d.fbi_code IS NOT NULL) AND s.fbi_code <> d.fbi_code)
-                )
-        """
-
-        with db.engine.begin() as curs:
-            curs.execute(text(insert))
+        with self.transaction() as curs:
+            curs.execute(text(insert), {"filename": filename, "version_time": self.version_time()})
 
     def flag_changes(self):
-        # Update existing records to no longer be current
+        # Record what changed between the current version and the incoming one
+        record_events = """
+            INSERT INTO evt_chicago_crime (
+              id,
+              file_date,
+              start_date,
+              changed_fields,
+              old_values,
+              new_values
+            )
+            SELECT
+              d.id,
+              :file_date AS file_date,
+              {version_time} AS start_date,
+              e.changed_fields,
+              e.old_values,
+              e.new_values
+            FROM mrg_chicago_crime AS m
+            JOIN dat_chicago_crime AS d
+              USING (row_id)
+            JOIN src_chicago_crime AS s
+              ON s.line_num = m.line_num
+            CROSS JOIN LATERAL ({0}) AS e
+            WHERE m.action = 'changed'
+              AND d.current_flag = TRUE
+              AND e.changed_fields IS NOT NULL
+              {batch}
+        """.format(
+            CHANGE_EVENT.format(old="d", new="s"),
+            version_time=VERSION_TIME,
+            batch=self.batch_filter(),
+        )
+
+        # Update existing records to no longer be current, keeping only the
+        # columns that differ from the new version. The rest can be filled
+        # back in from it, see VERSIONS_VIEW.
         update = """
             UPDATE dat_chicago_crime AS d SET
-              end_date = NOW(),
-              current_flag = FALSE
-            FROM chg_chicago_crime AS c
-            WHERE d.id = c.id
+              end_date = {version_time},
+              current_flag = FALSE,
+              delta_cols = x.delta_cols,
+              {sparse}
+            FROM (
+              SELECT
+                m.row_id,
+                COALESCE(e.changed_fields, '{{}}') AS delta_cols
+              FROM mrg_chicago_crime AS m
+              JOIN dat_chicago_crime AS o
+                USING (row_id)
+              JOIN src_chicago_crime AS s
+                ON s.line_num = m.line_num
+              CROSS JOIN LATERAL ({0}) AS e
+              WHERE m.action = 'changed'
+                AND o.current_flag = TRUE
+                {batch}
+            ) AS x
+            WHERE d.row_id = x.row_id
               AND d.current_flag = TRUE
-        """
+        """.format(
+            CHANGE_EVENT.format(old="o", new="s"),
+            version_time=VERSION_TIME,
+            batch=self.batch_filter(),
+            sparse=",".join(
+                f"{col} = CASE WHEN '{col}' = ANY(x.delta_cols) THEN d.{col} END"
+                for col in COLS
+                if col != "id"
+            ),
+        )
 
         # Insert new version
         insert = """
             INSERT INTO dat_chicago_crime (
               start_date,
+              index_code,
               {0}
             )
             SELECT
-              NOW() AS start_date,
+              {version_time} AS start_date,
+              {index_code} AS index_code,
               {0}
             FROM src_chicago_crime AS s
-            JOIN chg_chicago_crime AS c
-              USING(id)
+            JOIN mrg_chicago_crime AS m
+              USING(line_num, id)
+            WHERE m.action = 'changed'
+              {batch}
         """.format(
-            ",".join(COLS)
+            ",".join(COLS),
+            version_time=VERSION_TIME,
+            index_code=INDEX_CODE.format("s"),
+            batch=self.batch_filter(),
+        )
+
+        # One transaction so that the time is the same for the event, the end
+        # of the old version and the start of the new one
+        params = {"version_time": self.version_time()}
+        with self.transaction() as curs:
+            curs.execute(
+                text(record_events),
+                dict(params, file_date=self.file_date.strftime("%Y-%m-%d"), cols=COLS),
+            )
+            curs.execute(text(update), dict(params, cols=COLS))
+            curs.execute(text(insert), params)
+
+    def flag_deletions(self):
+        """
+        Flag records that have newly disappeared from the portal and unflag
+        the ones that have come back, recording an event for each. Records
+        that were already flagged on an earlier run aren't touched, so
+        deleted_on stays the date they first went missing.
+        """
+        # A restored record that also changed already has an event for this
+        # run when it's published in one transaction, so add to that one
+        record_events = """
+            INSERT INTO evt_chicago_crime (
+              id,
+              file_date,
+              start_date,
+              changed_fields,
+              old_values,
+              new_values
+            )
+            SELECT
+              id,
+              :file_date AS file_date,
+              {version_time} AS start_date,
+              ARRAY['deleted_flag'] AS changed_fields,
+              jsonb_build_object('deleted_flag', restored) AS old_values,
+              jsonb_build_object('deleted_flag', NOT restored) AS new_values
+            FROM mrg_chicago_crime
+            WHERE (action = 'deleted' OR restored)
+              {batch}
+            ON CONFLICT (id, start_date) DO UPDATE SET
+              changed_fields = evt_chicago_crime.changed_fields || EXCLUDED.changed_fields,
+              old_values = evt_chicago_crime.old_values || EXCLUDED.old_values,
+              new_values = evt_chicago_crime.new_values || EXCLUDED.new_values
+        """.format(
+            version_time=VERSION_TIME, batch=self.batch_filter("id")
+        )
+
+        # Every version of the record gets flagged so that its whole history
+        # shows up on the deleted records page
+        delete = """
+            UPDATE dat_chicago_crime AS d SET
+              deleted_flag = TRUE,
+              deleted_on = :file_date
+            FROM mrg_chicago_crime AS m
+            WHERE d.id = m.id
+              AND m.action = 'deleted'
+              AND d.deleted_flag IS NOT TRUE
+              {batch}
+        """.format(
+            batch=self.batch_filter()
+        )
+
+        restore = """
+            UPDATE dat_chicago_crime AS d SET
+              deleted_flag = FALSE,
+              deleted_on = NULL
+            FROM mrg_chicago_crime AS m
+            WHERE d.id = m.id
+              AND m.restored
+              AND d.deleted_flag
+              {batch}
+        """.format(
+            batch=self.batch_filter()
         )
 
+        params = {"file_date": self.file_date.strftime("%Y-%m-%d")}
+        with self.transaction() as curs:
+            curs.execute(text(record_events), dict(params, version_time=self.version_time()))
+            curs.execute(text(delete), params)
+            curs.execute(text(restore))
+
+    def make_changed_table(self):
+        """
+        Every version of the records that have more than one, which is what
+        the site browses. It's kept up to date by update_changed_records()
+        rather than being rebuilt from the whole dat table on every run.
+
+        This used to be a materialized view, which gets replaced by the table
+        the first time this runs against it.
+        """
+        is_table = """
+            SELECT EXISTS(
+              SELECT 1 FROM pg_tables
+              WHERE schemaname = current_schema() AND tablename = 'changed_records'
+            )
+        """
+        with db.engine.begin() as curs:
+            table_exists = curs.execute(text(is_table)).scalar()
+
+        if not table_exists:
+            self.rebuild_changed_records()
+
+    def rebuild_changed_records(self):
+        """
+        Build changed_records from scratch off to the side and swap it in, so
+        that the site keeps serving the old one until the new one is ready.
+        The swap only holds a lock for as long as it takes to rename a table.
+        """
+        is_view = "SELECT EXISTS(SELECT 1 FROM pg_matviews WHERE matviewname = 'changed_records')"
+
+        drop_shadow = "DROP TABLE IF EXISTS changed_records_new"
+        create = """
+            CREATE TABLE changed_records_new (LIKE dat_chicago_crime)
+        """
+        build = """
+            INSERT INTO changed_records_new ({0})
+            SELECT {0} FROM dat_chicago_crime_versions AS d
+            JOIN (
+                SELECT id FROM dat_chicago_crime
+                GROUP BY id
+                HAVING(COUNT(*) > 1)
+            ) AS s
+                USING (id)
+        """.format(
+            ",".join(META_COLS + COLS + ["index_code"])
+        )
+        create_index = """
+            CREATE UNIQUE INDEX changed_records_new_id_start_date_index
+              ON changed_records_new(id, start_date)
+        """
         with db.engine.begin() as curs:
-            curs.execute(text(update))
+            curs.execute(text(drop_shadow))
+            curs.execute(text(create))
+            curs.execute(text(build))
+            curs.execute(text(create_index))
 
         with db.engine.begin() as curs:
+            if curs.execute(text(is_view)).scalar():
+                logger.info("Replacing the changed_records materialized view with a table")
+                curs.execute(text("DROP MATERIALIZED VIEW changed_records"))
+            else:
+                curs.execute(text("DROP TABLE IF EXISTS changed_records"))
+
+            curs.execute(text("ALTER TABLE changed_records_new RENAME TO changed_records"))
+            curs.execute(
+                text(
+                    """
+                ALTER INDEX changed_records_new_id_start_date_index
+                  RENAME TO changed_records_id_start_date_index
+            """
+                )
+            )
+
+    def update_changed_records(self):
+        """
+        Replace the rows in changed_records for just the records that got a
+        new version, or were deleted or restored, in this run. New records
+        only have the one version so they can't be in there yet.
+
+        It all happens in one transaction, so readers see either the old rows
+        or the new ones and never wait on the ETL.
+        """
+        touched = """
+            CREATE TEMPORARY TABLE touched_ids ON COMMIT DROP AS
+              SELECT id FROM mrg_chicago_crime
+              WHERE (action IN ('changed', 'deleted') OR restored)
+                {batch}
+        """.format(
+            batch=self.batch_filter("id")
+        )
+        delete = """
+            DELETE FROM changed_records AS c
+            USING touched_ids AS t
+            WHERE c.id = t.id
+        """
+        insert = """
+            INSERT INTO changed_records ({0})
+            SELECT {0} FROM dat_chicago_crime_versions AS d
+            JOIN (
+                SELECT id FROM dat_chicago_crime
+                JOIN touched_ids USING (id)
+                GROUP BY id
+                HAVING(COUNT(*) > 1)
+            ) AS s
+                USING (id)
+        """.format(
+            ",".join(META_COLS + COLS + ["index_code"])
+        )
+        with self.transaction() as curs:
+            curs.execute(text(touched))
+            curs.execute(text(delete))
             curs.execute(text(insert))
 
-    def flag_deletions(self):
-        update = """
-            UPDATE dat_chicago_crime SET
-              deleted_flag = TRUE,
-              deleted_on = :deleted_on
-            FROM (
-              SELECT
-                d.id,
-                d.updated_on AS updated_on
-              FROM dat_chicago_crime AS d
-              LEFT JOIN src_chicago_crime AS s
-                USING(id)
-              WHERE s.id IS NULL
-            ) AS subq
-            WHERE subq.id = dat_chicago_crime.id
+    def make_index_code_table(self):
+        """
+        Every reclassification of a record between FBI index and non-index,
+        which is what the index code changes page and API list. Built from
+        the whole dat table the first time, then added to by each run.
+        """
+        create = """
+            CREATE TABLE IF NOT EXISTS index_code_changes(
+              id BIGINT,
+              changed_on TIMESTAMP,
+              district VARCHAR(5),
+              from_index_code VARCHAR(1),
+              to_index_code VARCHAR(1),
+              from_iucr VARCHAR(10),
+              to_iucr VARCHAR(10),
+              from_fbi_code VARCHAR(10),
+              to_fbi_code VARCHAR(10),
+              from_description VARCHAR(203),
+              to_description VARCHAR(203),
+              PRIMARY KEY(id, changed_on)
+            )
+        """
+        # Pages are newest first, optionally for one district or direction
+        indexes = [
+            """
+            CREATE INDEX IF NOT EXISTS index_code_changes_changed_on_index
+              ON index_code_changes(changed_on, id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS index_code_changes_district_index
+              ON index_code_changes(district, changed_on, id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS index_code_changes_direction_index
+              ON index_code_changes(to_index_code, changed_on, id)
+            """,
+        ]
+        exists = "SELECT to_regclass('index_code_changes') IS NOT NULL"
+
+        with db.engine.begin() as curs:
+            built = curs.execute(text(exists)).scalar()
+            curs.execute(text(create))
+            for index in indexes:
+                curs.execute(text(index))
+
+        if not built:
+            self.rebuild_index_code_changes()
+
+    def rebuild_index_code_changes(self):
+        """
+        Work out every reclassification from scratch, for when the table is
+        new or the IUCR reference data has changed the index code of
+        existing versions. Done in one transaction so that readers keep
+        seeing the old rows until it's finished. Versions that have since
+        been replaced are sparse, so the new side is read from the versions
+        view.
         """
+        rollup = "SELECT to_regclass('daily_changes') IS NOT NULL"
+
         with db.engine.begin() as curs:
-            curs.execute(text(update), {"deleted_on": self.file_date.strftime("%Y-%m-%d")})
+            curs.execute(text("DELETE FROM index_code_changes"))
+            curs.execute(
+                text(
+                    INDEX_CODE_CHANGES.format(
+                        versions="dat_chicago_crime_versions", join="", where=""
+                    )
+                )
+            )
+
+            # The daily counts of them have to match
+            if curs.execute(text(rollup)).scalar():
+                curs.execute(text("DELETE FROM daily_changes WHERE change_type = 'reclassified'"))
+                curs.execute(text(ROLLUP.format(RECLASSIFIED)))
+
+    def update_index_code_changes(self):
+        """
+        Add the reclassifications in the versions this run added. Only
+        changed records get a new version that can have one, and that's the
+        current version, which is always complete.
+        """
+        insert = INDEX_CODE_CHANGES.format(
+            versions="dat_chicago_crime",
+            join="JOIN mrg_chicago_crime AS m ON m.id = n.id",
+            where=f"AND n.current_flag = TRUE AND m.action = 'changed' {self.batch_filter()}",
+        )
+        with self.transaction() as curs:
+            curs.execute(text(insert))
 
-    def update_view(self):
+    def make_rollup_table(self):
+        """
+        Counts of the records that were new, changed, deleted, restored or
+        reclassified on each file date, broken down by the district,
+        community area and primary type of their current version. Changed
+        records are also counted per changed field and reclassified ones
+        per direction, in field. Counts of whole records have field ''.
+
+        Each run adds its own counts, so the stats API can read a range of
+        days off the primary key rather than grouping the whole history.
+        """
+        exists = "SELECT to_regclass('daily_changes') IS NOT NULL"
         create = """
-            CREATE MATERIALIZED VIEW changed_records AS (
-                SELECT d.* FROM dat_chicago_crime AS d
-                JOIN (
-                    SELECT id FROM dat_chicago_crime
-                    GROUP BY id
-                    HAVING(COUNT(*) > 1)
-                ) AS s
-                    ON d.id = s.id
+            CREATE TABLE IF NOT EXISTS daily_changes(
+              file_date DATE,
+              change_type VARCHAR(12),
+              field VARCHAR(30),
+              district VARCHAR(5),
+              community_area VARCHAR(10),
+              primary_type VARCHAR(100),
+              records INTEGER,
+              PRIMARY KEY(file_date, change_type, field, district, community_area, primary_type)
             )
         """
-        with db.engine.connect() as curs:
-            try:
-                curs.execute(text("REFRESH MATERIALIZED VIEW changed_records"))
-                curs.commit()
-            except ProgrammingError:
-                curs.rollback()
-                curs.execute(text(create))
-                curs.commit()
+        indexes = [
+            "CREATE INDEX IF NOT EXISTS daily_changes_{0}_index ON daily_changes({0}, file_date)".format(
+                col
+            )
+            for col in ["district", "community_area", "primary_type"]
+        ]
+        with db.engine.begin() as curs:
+            existed = curs.execute(text(exists)).scalar()
+            curs.execute(text(create))
+            for index in indexes:
+                curs.execute(text(index))
+
+        if not existed:
+            self.backfill_daily_changes()
+
+    def update_daily_changes(self):
+        """
+        Add this run's counts, after everything else has been published so
+        that the current versions are the new ones. Events from this run
+        carry its file date, and its reclassifications are the ones that
+        happened on the record's current version.
+        """
+        changes = """
+            SELECT
+              id,
+              CAST(:file_date AS DATE) AS file_date,
+              action AS change_type,
+              '' AS field
+            FROM mrg_chicago_crime AS m
+            WHERE action IN ('new', 'changed', 'deleted')
+              {batch}
+            UNION ALL
+            SELECT id, CAST(:file_date AS DATE), 'restored', ''
+            FROM mrg_chicago_crime AS m
+            WHERE restored
+              {batch}
+            UNION ALL
+            SELECT e.id, CAST(:file_date AS DATE), 'changed', f.field
+            FROM evt_chicago_crime AS e
+            JOIN mrg_chicago_crime AS m
+              USING (id)
+            CROSS JOIN LATERAL unnest(e.changed_fields) AS f(field)
+            WHERE m.action = 'changed'
+              AND e.file_date = CAST(:file_date AS DATE)
+              AND f.field <> 'deleted_flag'
+              {batch}
+            UNION ALL
+            SELECT
+              i.id,
+              CAST(:file_date AS DATE),
+              'reclassified',
+              CASE WHEN i.to_index_code = 'I' THEN 'to-index' ELSE 'to-non-index' END
+            FROM index_code_changes AS i
+            JOIN mrg_chicago_crime AS m
+              USING (id)
+            JOIN dat_chicago_crime AS d
+              ON d.id = i.id
+              AND d.start_date = i.changed_on
+              AND d.current_flag = TRUE
+            WHERE m.action = 'changed'
+              {batch}
+        """.format(
+            batch=self.batch_filter()
+        )
+        with self.transaction() as curs:
+            curs.execute(
+                text(ROLLUP.format(changes)),
+                {"file_date": self.file_date.strftime("%Y-%m-%d")},
+            )
+
+    def backfill_daily_changes(self):
+        """
+        Work out the counts for history published before the rollup table
+        existed from the change events and index code changes. Records that
+        were new on a day are the first versions that started on it.
+        """
+        changes = """
+            SELECT
+              id,
+              CAST(MIN(start_date) AS DATE) AS file_date,
+              'new' AS change_type,
+              '' AS field
+            FROM dat_chicago_crime
+            WHERE COALESCE(dup_ver, 1) = 1
+            GROUP BY id
+            UNION ALL
+            SELECT id, file_date, 'changed', ''
+            FROM evt_chicago_crime
+            WHERE changed_fields <> ARRAY['deleted_flag']
+            UNION ALL
+            SELECT
+              id,
+              file_date,
+              CASE WHEN new_values->>'deleted_flag' = 'true' THEN 'deleted' ELSE 'restored' END,
+              ''
+            FROM evt_chicago_crime
+            WHERE 'deleted_flag' = ANY(changed_fields)
+            UNION ALL
+            SELECT e.id, e.file_date, 'changed', f.field
+            FROM evt_chicago_crime AS e
+            CROSS JOIN LATERAL unnest(e.changed_fields) AS f(field)
+            WHERE f.field <> 'deleted_flag'
+            UNION ALL
+            {0}
+        """.format(
+            RECLASSIFIED
+        )
+        with db.engine.begin() as curs:
+            curs.execute(text("DELETE FROM daily_changes"))
+            curs.execute(text(ROLLUP.format(changes)))
 
     def make_meta_table(self):
         create = """
@@ -547,25 +2326,82 @@ class ETL(object):
                 filename VARCHAR,
                 date_added TIMESTAMP DEFAULT NOW(),
                 etl_status VARCHAR,
-                file_date DATE
+                file_date DATE,
+                fingerprint VARCHAR,
+                rejected_rows INTEGER,
+                silent_changes INTEGER,
+                changed_records BIGINT
+            )
+        """
+        # Trackers created before these columns were added
+        add_columns = """
+            ALTER TABLE etl_tracker
+              ADD COLUMN IF NOT EXISTS fingerprint VARCHAR,
+              ADD COLUMN IF NOT EXISTS rejected_rows INTEGER,
+              ADD COLUMN IF NOT EXISTS silent_changes INTEGER,
+              ADD COLUMN IF NOT EXISTS changed_records BIGINT
+        """
+        # One row per step of each run, see checkpoint()
+        create_steps = """
+            CREATE TABLE IF NOT EXISTS etl_steps(
+                filename VARCHAR,
+                step VARCHAR,
+                status VARCHAR,
+                row_count BIGINT,
+                duration FLOAT8,
+                finished_at TIMESTAMP DEFAULT NOW(),
+                last_id BIGINT,
+                version_time TIMESTAMP,
+                silent_changes INTEGER,
+                PRIMARY KEY(filename, step)
             )
         """
         with db.engine.begin() as curs:
             curs.execute(text(create))
+            curs.execute(text(add_columns))
+            curs.execute(text(create_steps))
 
-    def update_meta_table(self, filename, status):
+    def update_meta_table(
+        self,
+        filename,
+        status,
+        fingerprint=None,
+        rejected_rows=None,
+        silent_changes=None,
+        changed_records=None,
+    ):
 
         insert = """
-            INSERT INTO etl_tracker (filename, etl_status, file_date)
-            VALUES (:filename, :status, :file_date)
+            INSERT INTO etl_tracker (
+              filename,
+              etl_status,
+              file_date,
+              fingerprint,
+              rejected_rows,
+              silent_changes,
+              changed_records
+            )
+            VALUES (
+              :filename,
+              :status,
+              :file_date,
+              :fingerprint,
+              :rejected_rows,
+              :silent_changes,
+              :changed_records
+            )
         """
-        with db.engine.begin() as curs:
+        with self.transaction() as curs:
             curs.execute(
                 text(insert),
                 {
                     "filename": filename,
                     "status": status,
                     "file_date": self.file_date.strftime("%Y-%m-%d"),
+                    "fingerprint": fingerprint,
+                    "rejected_rows": rejected_rows,
+                    "silent_changes": silent_changes,
+                    "changed_records": changed_records,
                 },
             )
 
@@ -0,0 +1,232 @@
+import csv
+import io
+import logging
+import re
+from datetime import datetime
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# The portal writes timestamps like "01/31/2024 11:59:00 PM"
+PORTAL_TIMESTAMP = re.compile(r"^(\d{2})/(\d{2})/(\d{4}) (\d{2}):(\d{2}):(\d{2}) ([AP]M)$")
+
+TIMESTAMP_FORMATS = [
+    "%m/%d/%Y %I:%M:%S %p",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+]
+
+# Everything PostgreSQL will take as a boolean, lowercased
+BOOLEANS = {"t", "true", "y", "yes", "on", "1", "f", "false", "n", "no", "off", "0"}
+
+
+class TooManyRejects(psycopg2.DataError):
+    """
+    Raised when so many rows fail validation that the file itself is
+    probably broken (or the portal changed its format) rather than a few
+    lines in it.
+    """
+
+
+def check_integer(bits):
+    limit = 2 ** (bits - 1)
+
+    def check(value):
+        if not -limit <= int(value) < limit:
+            raise ValueError("out of range")
+
+    return check
+
+
+def check_varchar(length):
+    def check(value):
+        if len(value) > length:
+            raise ValueError(f"longer than {length} characters")
+
+    return check
+
+
+def check_float(value):
+    float(value)
+
+
+def check_boolean(value):
+    if value.strip().lower() not in BOOLEANS:
+        raise ValueError("not a boolean")
+
+
+def check_timestamp(value):
+    match = PORTAL_TIMESTAMP.match(value)
+    if match:
+        # Quicker than strptime, which adds up at two timestamps a row, but
+        # datetime() still turns away days the month doesn't have
+        month, day, year, hour, minute, second = [int(g) for g in match.groups()[:6]]
+        if not 1 <= hour <= 12:
+            raise ValueError("not a valid timestamp")
+        datetime(year, month, day, hour % 12, minute, second)
+        return
+
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            datetime.strptime(value, fmt)
+            return
+        except ValueError:
+            pass
+
+    raise ValueError("not a valid timestamp")
+
+
+class RowValidator(object):
+    """
+    Check parsed CSV rows against the column types of the table they're
+    headed for, so that a bad row can be set aside instead of failing the
+    whole COPY. Empty fields are NULLs and always pass.
+    """
+
+    CHECKS = {
+        "BIGINT": lambda args: check_integer(64),
+        "INTEGER": lambda args: check_integer(32),
+        "VARCHAR": lambda args: check_varchar(int(args)),
+        "FLOAT8": lambda args: check_float,
+        "BOOLEAN": lambda args: check_boolean,
+        "TIMESTAMP": lambda args: check_timestamp,
+    }
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_columns(cls, data_cols):
+        """
+        Build a validator from a column definition string like DATA_COLS
+        """
+        columns = []
+        for definition in data_cols.split(","):
+            definition = definition.strip()
+            if not definition:
+                continue
+            name, column_type = definition.split(None, 1)
+            column_type, _, args = column_type.partition("(")
+            check = cls.CHECKS[column_type.strip()](args.rstrip(")"))
+            columns.append((name, column_type.strip(), check))
+        return cls(columns)
+
+    def validate(self, row):
+        """
+        Returns the reason a row is bad, or None if it's good
+        """
+        if len(row) != len(self.columns):
+            return f"expected {len(self.columns)} columns, found {len(row)}"
+
+        for value, (name, column_type, check) in zip(row, self.columns):
+            if value == "":
+                continue
+            try:
+                check(value)
+            except ValueError as e:
+                return f"{name}: invalid {column_type} {value!r} ({e})"
+
+        return None
+
+
+class ValidatedCopy(object):
+    """
+    Load a CSV into a table, leaving out the rows that fail validation.
+
+    The file is parsed in Python so that each row can be checked before it's
+    loaded, and the rows that pass are COPYed in batches over a single
+    connection in one transaction. Rows are split on real row boundaries (the
+    portal file has quoted fields with newlines in them) and the row number
+    is written to line_num explicitly. That keeps line_num identical to what
+    a single COPY of the whole file into a SERIAL column would have produced,
+    rejects and all, which the "last line wins" dedup step relies on.
+
+    Parsing in Python makes this several times slower than letting the
+    server parse the file in a single COPY.
+
+    Given a RowValidator, rows that fail validation are left out of the load
+    and collected in rejects as (line_num, reason, raw row) instead. More than
+    max_rejects of them fails the load with TooManyRejects.
+    """
+
+    def __init__(
+        self,
+        dsn,
+        table,
+        columns,
+        batch_rows=50000,
+        validator=None,
+        max_rejects=1000,
+    ):
+        self.dsn = dsn
+        self.table = table
+        self.columns = columns
+        self.batch_rows = batch_rows
+        self.validator = validator
+        self.max_rejects = max_rejects
+        self.rejects = []
+
+    def batches(self, fp):
+        """
+        Yield CSV text for batch_rows rows at a time from a binary file-like
+        object, skipping the header and appending each row's line number.
+        """
+        reader = csv.reader(io.TextIOWrapper(fp, encoding="utf-8", newline=""))
+        next(reader, None)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        count = 0
+
+        for line_num, row in enumerate(reader, start=1):
+            if self.validator:
+                reason = self.validator.validate(row)
+                if reason:
+                    self.reject(line_num, reason, row)
+                    continue
+
+            writer.writerow(row + [line_num])
+            count += 1
+
+            if count == self.batch_rows:
+                yield buffer.getvalue()
+                buffer = io.StringIO()
+                writer = csv.writer(buffer, lineterminator="\n")
+                count = 0
+
+        if count:
+            yield buffer.getvalue()
+
+    def reject(self, line_num, reason, row):
+        raw = io.StringIO()
+        csv.writer(raw, lineterminator="").writerow(row)
+        self.rejects.append((line_num, reason, raw.getvalue()))
+
+        if len(self.rejects) > self.max_rejects:
+            raise TooManyRejects(
+                f"More than {self.max_rejects} rows failed validation, last at line {line_num}: {reason}"
+            )
+
+    def copy_statement(self):
+        return """
+            COPY {0}({1}, line_num)
+            FROM STDIN
+            WITH (FORMAT CSV, DELIMITER',')
+        """.format(
+            self.table, ",".join(self.columns)
+        )
+
+    def load(self, fp):
+        copy_st = self.copy_statement()
+        conn = psycopg2.connect(self.dsn)
+        try:
+            with conn, conn.cursor() as curs:
+                for batch in self.batches(fp):
+                    curs.copy_expert(copy_st, io.StringIO(batch))
+        finally:
+            conn.close()
@@ -0,0 +1,160 @@
+import csv
+import heapq
+import io
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotDiff(object):
+    """
+    Work out which rows differ between two snapshots of the portal file
+    without loading either of them into the database.
+
+    Each snapshot is deduplicated the same way the ETL does it, keeping the
+    last line for each id, by sorting it on (id, line number descending) in
+    runs of at most run_rows rows that are spilled to temporary files and
+    merged back together. Memory use is bounded by run_rows no matter how
+    big the snapshots are. The two sorted snapshots are then walked side by
+    side and only rows that are new, have a tracked column that changed, or
+    have gone away are emitted.
+
+    Tracked columns are compared as the text in the file, which is a little
+    stricter than comparing the loaded values. A row that only looks
+    different here is loaded and then found to be unchanged by merge_rows(),
+    so the worst case is loading a few rows we didn't have to.
+    """
+
+    def __init__(self, columns, tracked, key="id", run_rows=500000, work_dir=None):
+        self.columns = columns
+        self.key_index = columns.index(key)
+        self.tracked = [columns.index(col) for col in tracked]
+        self.run_rows = run_rows
+        self.work_dir = work_dir
+
+    def row_key(self, row):
+        try:
+            return int(row[self.key_index])
+        except (IndexError, ValueError):
+            return None
+
+    def spill(self, rows):
+        rows.sort(key=lambda r: (r[0], -r[1]))
+        run = tempfile.TemporaryFile(mode="w+", newline="", dir=self.work_dir)
+        csv.writer(run).writerows(rows)
+        run.seek(0)
+        return run
+
+    def read_run(self, run):
+        for record in csv.reader(run):
+            yield int(record[0]), int(record[1]), record[2:]
+
+    def sorted_rows(self, fp, unkeyed):
+        """
+        The header of a binary file-like object and an iterator of (id, row)
+        for the last line with each id in it, in id order. Rows without a
+        usable id can't be matched up so they're collected in unkeyed to be
+        passed along as they are.
+        """
+        reader = csv.reader(io.TextIOWrapper(fp, encoding="utf-8", newline=""))
+        header = next(reader, None)
+        return header, self.last_lines(reader, unkeyed)
+
+    def last_lines(self, reader, unkeyed):
+        runs = []
+        rows = []
+        try:
+            for line_num, row in enumerate(reader, start=1):
+                key = self.row_key(row)
+                if key is None:
+                    unkeyed.append(row)
+                    continue
+
+                rows.append((key, line_num, row))
+                if len(rows) == self.run_rows:
+                    runs.append(self.spill([(k, n, *r) for k, n, r in rows]))
+                    rows = []
+
+            if runs:
+                if rows:
+                    runs.append(self.spill([(k, n, *r) for k, n, r in rows]))
+                merged = heapq.merge(
+                    *(self.read_run(run) for run in runs), key=lambda r: (r[0], -r[1])
+                )
+            else:
+                # Everything fit in one run, no need to touch the disk
+                rows.sort(key=lambda r: (r[0], -r[1]))
+                merged = iter(rows)
+
+            previous = None
+            for key, _, row in merged:
+                if key != previous:
+                    yield key, row
+                    previous = key
+        finally:
+            for run in runs:
+                run.close()
+
+    def diff(self, old_fp, new_fp):
+        """
+        Yield ("new", row), ("changed", row) and ("deleted", id) for the
+        differences between two snapshots, in id order.
+        """
+        unkeyed = []
+        _, old_rows = self.sorted_rows(old_fp, [])
+        _, new_rows = self.sorted_rows(new_fp, unkeyed)
+        return self.compare(old_rows, new_rows, unkeyed)
+
+    def compare(self, old_rows, new_rows, unkeyed):
+        old = next(old_rows, None)
+        new = next(new_rows, None)
+
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                yield "deleted", old[0]
+                old = next(old_rows, None)
+            elif old is None or new[0] < old[0]:
+                yield "new", new[1]
+                new = next(new_rows, None)
+            else:
+                if [old[1][i] for i in self.tracked] != [new[1][i] for i in self.tracked]:
+                    yield "changed", new[1]
+                old = next(old_rows, None)
+                new = next(new_rows, None)
+
+        # Loaded so that validation can reject them, like a full load would
+        for row in unkeyed:
+            yield "new", row
+
+    def write_delta(self, old_fp, new_fp, out):
+        """
+        Write the new and changed rows, with the new snapshot's header, as
+        CSV to a binary file-like object. Returns the deleted ids and counts
+        of each kind of difference.
+        """
+        unkeyed = []
+        _, old_rows = self.sorted_rows(old_fp, [])
+        header, new_rows = self.sorted_rows(new_fp, unkeyed)
+
+        writer = io.TextIOWrapper(out, encoding="utf-8", newline="", write_through=True)
+        csv_writer = csv.writer(writer)
+        csv_writer.writerow(header or self.columns)
+
+        deleted = []
+        counts = {"new": 0, "changed": 0, "deleted": 0}
+
+        for action, value in self.compare(old_rows, new_rows, unkeyed):
+            counts[action] += 1
+            if action == "deleted":
+                deleted.append(value)
+            else:
+                csv_writer.writerow(value)
+
+        writer.flush()
+        writer.detach()
+
+        logger.info(
+            f"{counts['new']} new, {counts['changed']} changed, {counts['deleted']} deleted rows"
+        )
+        return deleted, counts
@@ -1,13 +1,47 @@
 import itertools
-import math
 from collections import OrderedDict
 
 from app.extensions import db
 from app.views import views
-from flask import current_app, render_template, request
+from flask import current_app, render_template, request, url_for
+from helpers import changedFields, indexCodeChanges, indexCodeFilters, keysetPage, keysetQuery
 from sqlalchemy import text
 from sqlalchemy.exc import OperationalError, ProgrammingError
 
+# Column names as they're labeled in the views
+FIELD_LABELS = OrderedDict(
+    [
+        ("id", "Record ID"),
+        ("case_number", "Case Number"),
+        ("orig_date", "Report Date"),
+        ("block", "Block"),
+        ("iucr", "IUCR Code"),
+        ("primary_type", "Primary Classification"),
+        ("description", "Secondary Classification"),
+        ("location_description", "Location Description"),
+        ("arrest", "Arrest"),
+        ("domestic", "Domestic"),
+        ("beat", "Beat"),
+        ("district", "District"),
+        ("ward", "Ward"),
+        ("community_area", "Community Area"),
+        ("fbi_code", "FBI Code"),
+        ("x_coordinate", "X Coordinate"),
+        ("y_coordinate", "Y Coordinate"),
+        ("year", "Year"),
+        ("updated_on", "Last Update"),
+        ("latitude", "Latitude"),
+        ("longitude", "Longitude"),
+    ]
+)
+
+
+def diffLabels(changed_fields):
+    """
+    View labels for changed columns, in the order they're displayed
+    """
+    return [label for field, label in FIELD_LABELS.items() if field in changed_fields]
+
 
 @views.route("/")
 def index():
@@ -38,10 +72,12 @@ def change_list():
     # Input validation and sanitization
     try:
         limit = min(int(request.args.get("limit", 100)), 1000)  # Cap at 1000
-        offset = int(request.args.get("offset", 0))
     except (ValueError, TypeError):
         limit = 100
-        offset = 0
+
+    # Each version is a row, so pages are keyed on the unique (id, start_date)
+    cursor = request.args.get("cursor")
+    condition, order_by, query_params, direction = keysetQuery(["id", "start_date"], cursor)
 
     records = """
         SELECT
@@ -65,11 +101,15 @@ def change_list():
           year AS "Year",
           updated_on AS "Last Update",
           latitude AS "Latitude",
-          longitude AS "Longitude"
+          longitude AS "Longitude",
+          start_date
         FROM changed_records
-        ORDER by ID
-        LIMIT :limit OFFSET :offset
-    """
+        WHERE {0}
+        ORDER BY {1}
+        LIMIT :limit
+    """.format(
+        condition, order_by
+    )
     display_fields = [
         "Record ID",
         "Case Number",
@@ -82,15 +122,7 @@ def change_list():
         "Last Update",
     ]
 
-    query_params = {"limit": limit, "offset": offset}
-
-    if request.args.get("page"):
-        try:
-            page = int(request.args["page"])
-            offset = max(0, (page - 1) * 100)  # Ensure non-negative
-            query_params["offset"] = offset
-        except (ValueError, TypeError):
-            pass  # Use default offset
+    query_params["limit"] = limit + 1
 
     try:
         records = db.session.execute(text(records), query_params)
@@ -101,7 +133,8 @@ def change_list():
             "change_list.html",
             grouped_records=[],
             display_fields=display_fields,
-            page_count=0,
+            prev_cursor=None,
+            next_cursor=None,
             fields=set(),
             message="Database not ready - run ETL first",
         )
@@ -109,57 +142,44 @@ def change_list():
     grouped_records = []
     fields = set()
 
-    results = [dict(zip(records.keys(), r)) for r in records]
+    results, prev_cursor, next_cursor = keysetPage(
+        records, direction, limit, lambda r: [r._mapping["Record ID"], r.start_date]
+    )
+    results = [dict(zip(r._fields, r)) for r in results]
+
+    changed_fields = changedFields({r["Record ID"] for r in results})
 
     for record_id, group in itertools.groupby(results, key=lambda x: x["Record ID"]):
 
         group = list(group)
-        grouped_by_field = {}
-        for record in group:
-            for field in record.keys():
-                try:
-                    grouped_by_field[field].append(record[field])
-                except KeyError:
-                    grouped_by_field[field] = [record[field]]
-
-        diff_fields = []
         output_record = OrderedDict()
 
-        for field, values in grouped_by_field.items():
-            if len(set(values)) > 1:
-                diff_fields.append(field)
-
+        for field in group[0].keys():
             if field in display_fields:
                 fields.add(field)
-                output_record[field] = max(t for t in grouped_by_field[field] if t is not None)
+                values = [record[field] for record in group if record[field] is not None]
+                output_record[field] = max(values) if values else None
 
-        output_record["diff_fields"] = diff_fields
+        output_record["diff_fields"] = diffLabels(changed_fields.get(record_id, []))
         output_record["Change Count"] = len(group)
         grouped_records.append(output_record)
 
-    try:
-        record_count = db.session.execute(text("SELECT COUNT(*) FROM changed_records")).first()[0]
-        page_count = math.ceil((record_count / 100))
-
-        if record_count == 0:
-            message = "No changed records found. This means either no data has been loaded yet, or no records have changed between ETL runs."
-        else:
-            message = None
-
-    except (OperationalError, ProgrammingError):
-        page_count = 0
-        message = "Changed records view not available. Run the ETL process to load data first."
+    if not results and not cursor:
+        message = "No changed records found. This means either no data has been loaded yet, or no records have changed between ETL runs."
+    else:
+        message = None
 
     return render_template(
         "change_list.html",
         grouped_records=grouped_records,
-        page_count=page_count,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         fields=fields,
         message=message,
     )
 
 
-@views.route("/detail/<record_id>/")
+@views.route("/detail/<int:record_id>/")
 def detail(record_id):
     record_set = """
         SELECT
@@ -189,9 +209,6 @@ def detail(record_id):
           latitude AS "Latitude",
           longitude AS "Longitude"
         FROM changed_records AS c
-        JOIN iucr AS i
-          ON c.iucr = i.iucr
-          OR c.iucr = lpad(i.iucr, 4, '0')
         WHERE id = :record_id
         ORDER BY updated_on
     """
@@ -208,11 +225,13 @@ def detail(record_id):
             except KeyError:
                 grouped_by_field[field] = [record.get(field)]
 
-    diff_fields = []
+    diff_fields = diffLabels(changedFields([record_id]).get(record_id, []))
+
+    # Whether it's an index crime comes from the IUCR code rather than a
+    # column of its own
+    if len(set(grouped_by_field.get("Index crime?", []))) > 1:
+        diff_fields.append("Index crime?")
 
-    for field, values in grouped_by_field.items():
-        if len(set(values)) > 1:
-            diff_fields.append(field)
     return render_template(
         "detail.html", grouped_by_field=grouped_by_field, diff_fields=diff_fields
     )
@@ -220,16 +239,21 @@ def detail(record_id):
 
 @views.route("/deleted/")
 def deleted():
-    limit = request.args.get("limit", 100)
-    offset = request.args.get("offset", 0)
+    try:
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except (ValueError, TypeError):
+        limit = 100
+
+    condition, order_by, params, direction = keysetQuery(["id"], request.args.get("cursor"))
 
     query = """
       SELECT
         id,
-        json_agg(row_to_json(s.*)) AS data
+        json_agg(row_to_json(s.*) ORDER BY start_date) AS data
       FROM (
         SELECT
           id,
+          start_date,
           c.iucr,
           c.primary_type || ' - ' || c.description AS description,
           c.fbi_code,
@@ -237,82 +261,47 @@ def deleted():
           orig_date,
           deleted_on
         FROM changed_records AS c
-        JOIN iucr AS i
-          ON c.iucr = i.iucr
-          OR c.iucr = lpad(i.iucr, 4, '0')
         WHERE c.deleted_flag = TRUE
-        ORDER BY id
+          AND {0}
       ) AS s
       GROUP BY id
+      ORDER BY {1}
       LIMIT :limit
-    """
-
-    if request.args.get("page"):
-        page = int(request.args["page"])
-        offset = (page - 1) * 100
-        query = "{0} OFFSET {1}".format(query, offset)
-
-    records = db.session.execute(text(query), dict(limit=limit, offset=offset))
+    """.format(
+        condition, order_by
+    )
 
-    page_count = math.ceil((records.rowcount / 100))
+    records = db.session.execute(text(query), dict(params, limit=limit + 1))
+    records, prev_cursor, next_cursor = keysetPage(records, direction, limit, lambda r: [r.id])
 
-    return render_template("deleted.html", records=records, page_count=page_count)
+    return render_template(
+        "deleted.html", records=records, prev_cursor=prev_cursor, next_cursor=next_cursor
+    )
 
 
 @views.route("/index-code-changes/")
 def index_code_change():
+    filters = indexCodeFilters(request.args)
 
-    limit = request.args.get("limit", 100)
-    offset = request.args.get("offset", 0)
-
-    subquery = """
-      SELECT
-        id,
-        c.iucr,
-        c.primary_type || ' - ' || c.description AS description,
-        c.fbi_code,
-        index_code,
-        updated_on
-      FROM changed_records AS c
-      JOIN iucr AS i
-        ON c.iucr = i.iucr
-        OR c.iucr = lpad(i.iucr, 4, '0')
-      JOIN (
-        SELECT
-          id,
-          array_agg(index_code)
-        FROM changed_records AS c
-        JOIN iucr AS i
-          ON c.iucr = i.iucr
-          OR c.iucr = lpad(i.iucr, 4, '0')
-        GROUP BY id
-        HAVING(
-          array_length(array_agg(DISTINCT index_code), 1) > 1
-            AND array_agg(index_code) && ARRAY['I', 'N']::VARCHAR[]
+    try:
+        changes, _, prev_cursor, next_cursor = indexCodeChanges(
+            limit=100, cursor=request.args.get("cursor"), **filters
         )
-      ) AS s
-        USING(id)
-      ORDER BY id, updated_on
-    """
+    except (OperationalError, ProgrammingError) as e:
+        current_app.logger.error(f"Database error in index_code_change: {e}")
+        changes, prev_cursor, next_cursor = [], None, None
 
-    query = """
-      SELECT
-        id,
-        json_agg(row_to_json(s.*)) AS data
-      FROM ({}) AS s
-      GROUP BY id
-      LIMIT :limit
-    """.format(
-        subquery
+    # Keep the filters when paging
+    url_base = url_for(
+        "views.index_code_change",
+        **{arg: request.args[arg] for arg in filters if request.args.get(arg)},
     )
 
-    if request.args.get("page"):
-        page = int(request.args["page"])
-        offset = (page - 1) * 100
-        query = "{0} OFFSET {1}".format(query, offset)
-
-    records = db.session.execute(text(query), dict(limit=limit, offset=offset))
-
-    page_count = math.ceil((records.rowcount / 100))
-
-    return render_template("index_code_change.html", records=records, page_count=page_count)
+    return render_template(
+        "index_code_change.html",
+        changes=changes,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        filters=request.args,
+        url_base=url_base,
+    )
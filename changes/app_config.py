@@ -23,3 +23,39 @@ class Config:
 
     # Application settings
     DEBUG = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
+
+    # ETL settings
+    DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+
+    # When the COPY turns a file away, load it again checking each row
+    # against the column types. Rows that fail are kept in rej_chicago_crime
+    # instead of failing the run, unless there are more than
+    # MAX_REJECTED_ROWS of them. Off, a bad row fails the run.
+    VALIDATE_ROWS = os.environ.get("VALIDATE_ROWS", "True").lower() == "true"
+    MAX_REJECTED_ROWS = int(os.environ.get("MAX_REJECTED_ROWS", 1000))
+
+    # Snapshot archive in the storage directory: "gzip" or "zstd" (needs the
+    # zstandard package). Snapshots older than the retention window are
+    # removed after each successful run; leave it unset to keep everything.
+    ARCHIVE_COMPRESSION = os.environ.get("ARCHIVE_COMPRESSION", "gzip")
+    ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", 0)) or None
+
+    # Processes used to diff archived snapshots ahead of the day being applied
+    # when backfilling
+    BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 4))
+
+    # Only compare rows whose updated_on differs from the current version.
+    # Every VERIFY_EVERY_DAYS days (or with run-etl --verify) a run compares
+    # everything anyway and reports records that changed without updated_on
+    # changing.
+    PREFILTER_UPDATED_ON = os.environ.get("PREFILTER_UPDATED_ON", "False").lower() == "true"
+    VERIFY_EVERY_DAYS = int(os.environ.get("VERIFY_EVERY_DAYS", 7))
+
+    # Publish a run's changes this many records at a time, each batch in its
+    # own transaction. 0 publishes everything in one transaction. Before each
+    # batch, wait while a replica is more than APPLY_MAX_REPLICA_LAG seconds
+    # behind (0 doesn't check), and APPLY_BATCH_PAUSE seconds between batches
+    # regardless.
+    APPLY_BATCH_SIZE = int(os.environ.get("APPLY_BATCH_SIZE", 0))
+    APPLY_MAX_REPLICA_LAG = float(os.environ.get("APPLY_MAX_REPLICA_LAG", 0))
+    APPLY_BATCH_PAUSE = float(os.environ.get("APPLY_BATCH_PAUSE", 0))
@@ -1,12 +1,149 @@
+import base64
+import json
+from datetime import datetime
+
 from app.extensions import db
-from sqlalchemy import Table, func
+from sqlalchemy import Table, func, text
+
+
+def encodeCursor(direction, key):
+    """
+    Opaque cursor for the page "next" after or "prev" before the row with
+    the sort key key
+    """
+    payload = json.dumps([direction, key], default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decodeCursor(cursor):
+    """
+    (direction, key) from a cursor, or (None, None) for the first page or a
+    cursor that doesn't decode
+    """
+    if not cursor:
+        return None, None
+
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, key = json.loads(payload)
+    except (ValueError, TypeError):
+        return None, None
+
+    if direction not in ("next", "prev") or not isinstance(key, list):
+        return None, None
+
+    return direction, key
+
 
+# Largest value a BIGINT id can hold
+MAX_ID = 2**63 - 1
 
-def groupedChanges(order_by="id", sort_order="asc", limit=500, offset=0):
 
-    view = Table("changed_records", db.metadata, autoload_with=db.engine)
+def keysetValue(column, value):
+    """
+    A cursor key value as the type of the column it pages on. Raises
+    ValueError when it isn't one, since cursors come from the request.
+    """
+    if column == "id":
+        if isinstance(value, bool) or not isinstance(value, int) or abs(value) > MAX_ID:
+            raise ValueError(f"invalid id {value!r}")
+        return value
+
+    # The dates, start_date and changed_on, are encoded as strings
+    if not isinstance(value, str):
+        raise ValueError(f"invalid {column} {value!r}")
+    return datetime.fromisoformat(value)
+
+
+def keysetQuery(columns, cursor, descending=False):
+    """
+    WHERE condition, ORDER BY and parameters for the page after (or
+    before) a cursor on columns, which have to be unique together and
+    indexed. It's a range scan on the index however deep the page is,
+    where OFFSET has to step over every row before it.
+
+    A previous page is read backwards from the cursor, keysetPage() puts
+    it back in order, which is why the direction is returned too. A cursor
+    whose key doesn't fit the columns is treated as no cursor at all.
+    """
+    direction, key = decodeCursor(cursor)
+    try:
+        if key is None or len(key) != len(columns):
+            raise ValueError("cursor is for a different sort key")
+        key = [keysetValue(col, value) for col, value in zip(columns, key)]
+    except ValueError:
+        # A cursor that's been tampered with gets the first page
+        direction, key = None, None
+
+    order = "DESC" if descending != (direction == "prev") else "ASC"
+    order_by = ", ".join(f"{col} {order}" for col in columns)
+
+    if key is None:
+        return "TRUE", order_by, {}, direction
+
+    params = {f"cursor_{i}": value for i, value in enumerate(key)}
+    condition = "({0}) {1} ({2})".format(
+        ", ".join(columns), "<" if order == "DESC" else ">", ", ".join(f":{p}" for p in params)
+    )
+    return condition, order_by, params, direction
+
 
-    order_by_clause = getattr(getattr(view.c, order_by), sort_order)()
+def keysetPage(rows, direction, limit, key):
+    """
+    The page of rows from a query made with keysetQuery() and a LIMIT of
+    limit + 1, along with the cursors for the pages before and after it.
+    key gives the sort key of a row.
+    """
+    rows = list(rows)
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if direction == "prev":
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = direction == "next", more
+
+    prev_cursor = encodeCursor("prev", key(rows[0])) if rows and has_prev else None
+    next_cursor = encodeCursor("next", key(rows[-1])) if rows and has_next else None
+
+    return rows, prev_cursor, next_cursor
+
+
+def reflectedTable(name):
+    """
+    A table as it is in the database. It's only reflected the first time,
+    after that it comes from the metadata, so a process has to be restarted
+    to pick up columns the ETL adds.
+    """
+    if name not in db.metadata.tables:
+        Table(name, db.metadata, autoload_with=db.engine)
+    return db.metadata.tables[name]
+
+
+def changedRecordsCount():
+    """
+    Rows in changed_records as of the last successful ETL run, which records
+    it when it publishes. Until a run has, it's Postgres's estimate.
+    """
+    recorded = """
+        SELECT changed_records FROM etl_tracker
+        WHERE etl_status = 'success'
+          AND changed_records IS NOT NULL
+        ORDER BY date_added DESC, file_date DESC
+        LIMIT 1
+    """
+    estimate = "SELECT reltuples::BIGINT FROM pg_class WHERE oid = to_regclass('changed_records')"
+
+    count = db.session.execute(text(recorded)).scalar()
+    if count is None:
+        count = max(db.session.execute(text(estimate)).scalar() or 0, 0)
+    return count
+
+
+def groupedChanges(sort_order="asc", limit=500, cursor=None):
+
+    view = reflectedTable("changed_records")
 
     skip_columns = [
         "id",
@@ -15,27 +152,231 @@ def groupedChanges(order_by="id", sort_order="asc", limit=500, offset=0):
         "current_flag",
         "dup_ver",
         "source_filename",
+        "row_hash",
+        "delta_cols",
+        "index_code",
     ]
     select_columns = [view.c.id]
     for column in view.columns:
         if column.name not in skip_columns:
             select_columns.append(func.array_agg(column).label(column.name))
 
+    condition, order_by, params, direction = keysetQuery(
+        ["id"], cursor, descending=sort_order == "desc"
+    )
+
     changed_records = db.session.execute(
         db.select(*select_columns)
+        .where(text(condition))
         .group_by(view.c.id)
-        .order_by(order_by_clause)
-        .limit(limit)
-        .offset(offset)
+        .order_by(text(order_by))
+        .limit(limit + 1),
+        params,
+    )
+    changed_records, prev_cursor, next_cursor = keysetPage(
+        changed_records, direction, limit, lambda r: [r.id]
     )
 
-    count = db.session.execute(db.select(view)).rowcount
+    count = changedRecordsCount()
 
     query = {
-        "order_by": order_by,
         "sort_order": sort_order,
         "limit": limit,
-        "offset": offset,
+        "prev": prev_cursor,
+        "next": next_cursor,
     }
 
     return changed_records, query, count
+
+
+def changedFields(record_ids):
+    """
+    The columns that have changed at some point in each record's history,
+    keyed by record id, looked up from the change events the ETL records.
+    """
+    if not record_ids:
+        return {}
+
+    query = """
+        SELECT
+          id,
+          array_agg(DISTINCT field) AS changed_fields
+        FROM evt_chicago_crime
+        CROSS JOIN LATERAL unnest(changed_fields) AS field
+        WHERE id = ANY(:ids)
+        GROUP BY id
+    """
+    events = db.session.execute(text(query), {"ids": list(record_ids)})
+
+    return {event.id: event.changed_fields for event in events}
+
+
+# Values of the direction filter for index code changes and the index code
+# the records were reclassified to
+INDEX_CODE_DIRECTIONS = {"to-index": "I", "to-non-index": "N"}
+
+
+def indexCodeFilters(args):
+    """
+    The index code change filters in a request's arguments. Ones that don't
+    parse are left out rather than failing the request.
+    """
+    filters = {}
+    for arg in ["start_date", "end_date"]:
+        try:
+            filters[arg] = datetime.strptime(args[arg], "%Y-%m-%d")
+        except (KeyError, ValueError):
+            pass
+
+    if args.get("district"):
+        filters["district"] = args["district"]
+
+    if args.get("direction") in INDEX_CODE_DIRECTIONS:
+        filters["direction"] = args["direction"]
+
+    return filters
+
+
+def indexCodeChanges(
+    limit=100,
+    cursor=None,
+    start_date=None,
+    end_date=None,
+    district=None,
+    direction=None,
+    count=False,
+):
+    """
+    Reclassifications between index and non-index crimes, newest first,
+    from the table the ETL keeps. Returns the page of them, how many there
+    are in all and the cursors for the pages either side. Counting them
+    all takes a scan of every match, so the total is None unless count is
+    set.
+    """
+    conditions = []
+    params = {}
+
+    if start_date:
+        conditions.append("changed_on >= :start_date")
+        params["start_date"] = start_date
+    if end_date:
+        conditions.append("changed_on < :end_date + INTERVAL '1 day'")
+        params["end_date"] = end_date
+    if district:
+        conditions.append("district = :district")
+        params["district"] = district
+    if direction:
+        conditions.append("to_index_code = :to_index_code")
+        params["to_index_code"] = INDEX_CODE_DIRECTIONS[direction]
+
+    where = "WHERE {}".format(" AND ".join(conditions)) if conditions else ""
+    count_query = "SELECT COUNT(*) FROM index_code_changes {0}".format(where)
+
+    condition, order_by, keyset, page_direction = keysetQuery(
+        ["changed_on", "id"], cursor, descending=True
+    )
+    conditions.append(condition)
+
+    query = """
+        SELECT
+          id,
+          changed_on,
+          district,
+          from_index_code,
+          to_index_code,
+          from_iucr,
+          to_iucr,
+          from_fbi_code,
+          to_fbi_code,
+          from_description,
+          to_description
+        FROM index_code_changes
+        WHERE {0}
+        ORDER BY {1}
+        LIMIT :limit
+    """.format(
+        " AND ".join(conditions), order_by
+    )
+
+    changes = db.session.execute(text(query), dict(params, limit=limit + 1, **keyset))
+    changes, prev_cursor, next_cursor = keysetPage(
+        changes, page_direction, limit, lambda c: [c.changed_on, c.id]
+    )
+    total = db.session.execute(text(count_query), params).scalar() if count else None
+
+    return changes, total, prev_cursor, next_cursor
+
+
+# What the daily change counts can be filtered and grouped by
+STATS_DIMENSIONS = [
+    "file_date",
+    "change_type",
+    "field",
+    "district",
+    "community_area",
+    "primary_type",
+]
+
+
+def statsFilters(args):
+    """
+    The daily change count filters and grouping in a request's arguments.
+    Ones that don't parse are left out rather than failing the request.
+    """
+    filters = {}
+    for arg in ["start_date", "end_date"]:
+        try:
+            filters[arg] = datetime.strptime(args[arg], "%Y-%m-%d").date()
+        except (KeyError, ValueError):
+            pass
+
+    for arg in STATS_DIMENSIONS[1:]:
+        if args.get(arg) is not None:
+            filters[arg] = args[arg]
+
+    group_by = [col for col in args.get("group_by", "").split(",") if col in STATS_DIMENSIONS]
+    filters["group_by"] = group_by or ["file_date", "change_type"]
+
+    return filters
+
+
+def changeStats(group_by=("file_date", "change_type"), start_date=None, end_date=None, **filters):
+    """
+    Numbers of new, changed, deleted, restored and reclassified records,
+    summed from the daily counts the ETL keeps and grouped by group_by.
+    Changed records are also counted once for each field that changed, so
+    unless field is filtered or grouped on only whole records are counted.
+    Reclassifications only have a count per direction.
+    """
+    conditions = []
+    params = {}
+
+    if start_date:
+        conditions.append("file_date >= :start_date")
+        params["start_date"] = start_date
+    if end_date:
+        conditions.append("file_date <= :end_date")
+        params["end_date"] = end_date
+
+    for col, value in filters.items():
+        conditions.append(f"{col} = :{col}")
+        params[col] = value
+
+    if "field" not in filters and "field" not in group_by:
+        conditions.append("(field = '' OR change_type = 'reclassified')")
+
+    where = "WHERE {}".format(" AND ".join(conditions)) if conditions else ""
+
+    query = """
+        SELECT
+          {0},
+          CAST(SUM(records) AS BIGINT) AS records
+        FROM daily_changes
+        {1}
+        GROUP BY {0}
+        ORDER BY {0}
+    """.format(
+        ", ".join(group_by), where
+    )
+
+    return db.session.execute(text(query), params).fetchall()
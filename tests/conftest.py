@@ -1,4 +1,6 @@
 import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 
@@ -22,11 +24,16 @@ def app():
 
         try:
             db.session.execute(text("DROP TABLE IF EXISTS etl_tracker CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS etl_steps CASCADE"))
             db.session.execute(text("DROP TABLE IF EXISTS dat_chicago_crime CASCADE"))
             db.session.execute(text("DROP TABLE IF EXISTS src_chicago_crime CASCADE"))
             db.session.execute(text("DROP TABLE IF EXISTS dup_chicago_crime CASCADE"))
-            db.session.execute(text("DROP TABLE IF EXISTS chg_chicago_crime CASCADE"))
-            db.session.execute(text("DROP MATERIALIZED VIEW IF EXISTS changed_records CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS mrg_chicago_crime CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS rej_chicago_crime CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS evt_chicago_crime CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS changed_records CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS index_code_changes CASCADE"))
+            db.session.execute(text("DROP TABLE IF EXISTS daily_changes CASCADE"))
             db.session.commit()
         except Exception:
             db.session.rollback()
@@ -75,32 +82,18 @@ def dat_chicago_crime_table(app):
         )
         db.session.commit()
 
+        etl.backfill_events()
+
         yield
 
 
 @pytest.fixture
 def changed_records_view(app, dat_chicago_crime_table):
-    """Create the changed_records materialized view for tests."""
+    """Build the changed_records table for tests."""
     with app.app_context():
-        from sqlalchemy import text
+        from app.etl import ETL
 
-        # Create the materialized view
-        db.session.execute(
-            text(
-                """
-            CREATE MATERIALIZED VIEW IF NOT EXISTS changed_records AS (
-                SELECT d.* FROM dat_chicago_crime AS d
-                JOIN (
-                    SELECT id FROM dat_chicago_crime
-                    GROUP BY id
-                    HAVING(COUNT(*) > 1)
-                ) AS s
-                    ON d.id = s.id
-            )
-        """
-            )
-        )
-        db.session.commit()
+        ETL("").rebuild_changed_records()
 
         yield
 
@@ -115,3 +108,76 @@ def cleanup_db():
         db.session.close()
     except Exception:
         pass
+
+
+@pytest.fixture
+def portal_server():
+    """Serve a CSV body from a local HTTP server standing in for the data portal."""
+
+    class PortalHandler(BaseHTTPRequestHandler):
+        body = b""
+        ranged = False
+        # Honour ranges without advertising them or the length up front
+        unadvertised_ranges = False
+        etag = None
+        # Close the connection after this many bytes of each response
+        truncate_at = None
+        requests = []
+
+        def send_headers(self):
+            start, end = 0, len(self.body) - 1
+            range_header = self.headers.get("Range")
+            if_range = self.headers.get("If-Range")
+
+            if (
+                (self.ranged or self.unadvertised_ranges)
+                and range_header
+                and if_range in (None, self.etag)
+            ):
+                first, last = range_header.split("=")[1].split("-")
+                start, end = int(first), int(last) if last else end
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.body)}")
+            else:
+                self.send_response(200)
+
+            if self.ranged:
+                self.send_header("Accept-Ranges", "bytes")
+            if self.etag:
+                self.send_header("ETag", self.etag)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            return start, end
+
+        def do_HEAD(self):
+            if self.unadvertised_ranges:
+                self.send_response(200)
+                self.send_header("ETag", self.etag)
+                self.end_headers()
+                return
+            self.send_headers()
+
+        def do_GET(self):
+            self.requests.append(self.headers.get("Range"))
+            start, end = self.send_headers()
+            end += 1
+            payload = self.body[start:end]
+            if self.truncate_at is not None:
+                payload = payload[: self.truncate_at]
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PortalHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    server.handler = PortalHandler
+    server.url = f"http://127.0.0.1:{server.server_port}"
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
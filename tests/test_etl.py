@@ -1,4 +1,17 @@
-from app.etl import ETL
+import csv
+import hashlib
+import io
+import os
+from datetime import datetime
+
+import pytest
+import requests
+from app.archive import SnapshotArchive
+from app.backfill import Backfill, archived_snapshots, prepare_delta
+from app.download import RangedDownloader, TeeReader
+from app.etl import COLS, DATA_COLS, ETL, TRACKED_COLS
+from app.loader import RowValidator, TooManyRejects, ValidatedCopy
+from app.snapshot_diff import SnapshotDiff
 
 
 class TestETLChangeDetection:
@@ -11,7 +24,7 @@ class TestETLChangeDetection:
 
             # Mock source data with duplicates
             etl.make_source_table()
-            etl.make_new_dup_tables()
+            etl.make_dup_table()
 
             # Insert test data with same ID, different line numbers
             from app.extensions import db
@@ -77,18 +90,16 @@ class TestETLChangeDetection:
             )
             db.session.commit()
 
-            etl.find_changed_rows()
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
 
             # Should detect the change
             result = db.session.execute(
-                text(
-                    """
-                SELECT COUNT(*) as count FROM chg_chicago_crime WHERE id = 456
-            """
-                )
+                text("SELECT action FROM mrg_chicago_crime WHERE id = 456")
             ).first()
 
-            assert result.count == 1
+            assert result.action == "changed"
 
     def test_change_detection_fbi_code(self, app):
         """Test detection of FBI code changes (index/non-index)."""
@@ -124,18 +135,16 @@ class TestETLChangeDetection:
             )
             db.session.commit()
 
-            etl.find_changed_rows()
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
 
             # Should detect the change
             result = db.session.execute(
-                text(
-                    """
-                SELECT COUNT(*) as count FROM chg_chicago_crime WHERE id = 789
-            """
-                )
+                text("SELECT action FROM mrg_chicago_crime WHERE id = 789")
             ).first()
 
-            assert result.count == 1
+            assert result.action == "changed"
 
     def test_no_change_detection(self, app):
         """Test that identical records don't trigger changes."""
@@ -171,16 +180,1677 @@ class TestETLChangeDetection:
             db.session.commit()
 
             # Create change detection table and run detection
-            etl.make_new_dup_tables()
-            etl.find_changed_rows()
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
 
             # Should NOT detect any changes since records are identical
             result = db.session.execute(
+                text("SELECT action FROM mrg_chicago_crime WHERE id = 999")
+            ).first()
+
+            assert result.action == "unchanged"
+
+    def test_row_hash_ignores_untracked_columns(self, app):
+        """Test that rows differing only in untracked columns hash the same."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("")
+            etl.make_source_table()
+            etl.make_data_table()
+
+            db.session.execute(
                 text(
                     """
-                SELECT COUNT(*) as count FROM chg_chicago_crime WHERE id = 999
+                INSERT INTO dat_chicago_crime
+                (id, block, arrest, orig_date, current_flag, start_date) VALUES
+                (555, '100 BLOCK OF MAIN ST', false, '2024-01-01 10:00', true, NOW()),
+                (556, '100 BLOCK OF MAIN ST', false, '2024-01-01 10:00', true, NOW())
             """
                 )
-            ).first()
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime
+                (id, block, arrest, orig_date) VALUES
+                (555, '200 BLOCK OF ELM ST', false, '2024-01-01 10:00'),
+                (556, '100 BLOCK OF MAIN ST', true, '2024-01-01 10:00')
+            """
+                )
+            )
+            db.session.commit()
+
+            result = db.session.execute(
+                text(
+                    """
+                SELECT id, s.row_hash = d.row_hash AS same_hash
+                FROM src_chicago_crime AS s
+                JOIN dat_chicago_crime AS d USING (id)
+                ORDER BY id
+            """
+                )
+            ).fetchall()
+
+            assert [r.same_hash for r in result] == [True, False]
+
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
+
+            changed = db.session.execute(
+                text("SELECT id FROM mrg_chicago_crime WHERE action = 'changed'")
+            ).fetchall()
+            assert [r.id for r in changed] == [556]
+
+    def test_flag_changes_records_event(self, app):
+        """Test that a new version records which fields changed and how."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, case_number, arrest, fbi_code, current_flag, start_date) VALUES
+                (456, 'CASE456', false, '06', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime
+                (id, case_number, arrest, fbi_code) VALUES (456, 'CASE456', true, '06')
+            """
+                )
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.flag_changes()
+
+            event = db.session.execute(text("SELECT * FROM evt_chicago_crime WHERE id = 456")).one()
+
+            assert event.changed_fields == ["arrest"]
+            assert event.old_values == {"arrest": False}
+            assert event.new_values == {"arrest": True}
+            assert event.file_date.isoformat() == "2024-01-02"
+
+            current = db.session.execute(
+                text("SELECT start_date FROM dat_chicago_crime WHERE id = 456 AND current_flag")
+            ).one()
+            assert current.start_date == event.start_date
+
+    def test_merge_classifies_new_and_deleted(self, app):
+        """Test that one merge finds new, deleted, rejected and duplicated rows."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_data_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, current_flag, start_date) VALUES
+                (100, false, true, '2024-01-01'),
+                (200, false, true, '2024-01-01'),
+                (400, false, true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime (id, arrest, line_num) VALUES
+                (100, true, 1),
+                (100, false, 2),
+                (300, true, 3)
+            """
+                )
+            )
+            db.session.commit()
+
+            # 400 is in the snapshot, but its row failed validation
+            raw_row = ",".join("400" if col == "id" else "" for col in COLS)
+            etl.record_rejects([(4, "updated_on: invalid TIMESTAMP", raw_row)])
+
+            etl.find_dup_rows()
+            counts = etl.merge_rows()
+
+            result = db.session.execute(
+                text("SELECT id, line_num, action FROM mrg_chicago_crime ORDER BY id")
+            ).fetchall()
+
+            # The last line for id 100 matches what we have, so it's unchanged
+            assert [tuple(r) for r in result] == [
+                (100, 2, "unchanged"),
+                (200, None, "deleted"),
+                (300, 3, "new"),
+                (400, None, "rejected"),
+            ]
+            assert counts == {
+                "unchanged": 1,
+                "deleted": 1,
+                "new": 1,
+                "rejected": 1,
+                "restored": 0,
+            }
+
+            etl.insert_new_rows("chicago-crime-2024-01-02.csv")
+            etl.flag_deletions()
+
+            deleted = db.session.execute(
+                text("SELECT deleted_flag, deleted_on FROM dat_chicago_crime WHERE id = 200")
+            ).one()
+            assert deleted.deleted_flag
+            assert deleted.deleted_on.date().isoformat() == "2024-01-02"
+
+            rejected = db.session.execute(
+                text("SELECT deleted_flag FROM dat_chicago_crime WHERE id = 400")
+            ).scalar()
+            assert not rejected
+
+            new = db.session.execute(
+                text("SELECT dup_ver, arrest FROM dat_chicago_crime WHERE id = 300")
+            ).one()
+            assert (new.dup_ver, new.arrest) == (1, True)
+
+    def test_deletion_recorded_once_and_restored(self, app):
+        """Test that a deletion keeps its first date and is undone when the record returns."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_data_table()
+            etl.make_event_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, current_flag, start_date) VALUES
+                (200, false, true, '2024-01-01')
+            """
+                )
+            )
+            db.session.commit()
+
+            def run(file_date, rows):
+                etl.file_date = file_date
+                db.session.execute(text("TRUNCATE src_chicago_crime"))
+                for row in rows:
+                    db.session.execute(
+                        text("INSERT INTO src_chicago_crime (id, arrest) VALUES (:id, false)"),
+                        {"id": row},
+                    )
+                db.session.commit()
+                etl.make_dup_table()
+                etl.find_dup_rows()
+                counts = etl.merge_rows()
+                etl.flag_deletions()
+                return counts
+
+            assert run(datetime(2024, 1, 2), [])["deleted"] == 1
+            assert run(datetime(2024, 1, 3), []).get("deleted", 0) == 0
+
+            row = db.session.execute(
+                text("SELECT deleted_flag, deleted_on FROM dat_chicago_crime WHERE id = 200")
+            ).one()
+            assert row.deleted_flag
+            assert row.deleted_on.date().isoformat() == "2024-01-02"
+
+            counts = run(datetime(2024, 1, 4), [200])
+            assert (counts["restored"], counts.get("unchanged")) == (1, 1)
+
+            row = db.session.execute(
+                text("SELECT deleted_flag, deleted_on FROM dat_chicago_crime WHERE id = 200")
+            ).one()
+            assert (row.deleted_flag, row.deleted_on) == (False, None)
+
+            events = db.session.execute(
+                text(
+                    """
+                SELECT file_date, new_values FROM evt_chicago_crime
+                WHERE id = 200 ORDER BY start_date
+            """
+                )
+            ).fetchall()
+            assert [(e.file_date.isoformat(), e.new_values) for e in events] == [
+                ("2024-01-02", {"deleted_flag": True}),
+                ("2024-01-04", {"deleted_flag": False}),
+            ]
+
+    def test_changed_records_updated_incrementally(self, app):
+        """Test that changed_records replaces the old view and picks up a run's new versions."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_data_table()
+            etl.make_event_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, current_flag, start_date) VALUES
+                (456, false, true, '2024-01-01'),
+                (789, false, true, '2024-01-01')
+            """
+                )
+            )
+            # ETL() has already made the changed_records table, put the old
+            # view back in its place
+            db.session.execute(text("DROP TABLE changed_records"))
+            db.session.execute(
+                text("CREATE MATERIALIZED VIEW changed_records AS SELECT * FROM dat_chicago_crime")
+            )
+            db.session.commit()
+
+            etl.make_changed_table()
+
+            count = db.session.execute(text("SELECT COUNT(*) FROM changed_records")).scalar()
+            assert count == 0
+
+            index = db.session.execute(
+                text(
+                    """
+                SELECT indexdef FROM pg_indexes
+                WHERE indexname = 'changed_records_id_start_date_index'
+            """
+                )
+            ).scalar()
+            assert "UNIQUE" in index
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime (id, arrest) VALUES
+                (456, true),
+                (789, false)
+            """
+                )
+            )
+            db.session.commit()
+
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.flag_changes()
+            etl.update_changed_records()
+
+            result = db.session.execute(
+                text("SELECT id, arrest FROM changed_records ORDER BY start_date")
+            ).fetchall()
+            assert [tuple(r) for r in result] == [(456, False), (456, True)]
+
+    def test_publish_merges_restore_and_change_events(self, app):
+        """Test that a record that comes back changed gets one event when published together."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 3))
+            etl.make_source_table()
+            etl.make_data_table()
+            etl.make_event_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, current_flag, deleted_flag, deleted_on, start_date) VALUES
+                (200, false, true, true, '2024-01-02', '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text("INSERT INTO src_chicago_crime (id, arrest) VALUES (200, true)")
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+
+            with etl.publish():
+                etl.flag_changes()
+                etl.flag_deletions()
+
+            event = db.session.execute(text("SELECT * FROM evt_chicago_crime WHERE id = 200")).one()
+            assert event.changed_fields == ["arrest", "deleted_flag"]
+            assert event.new_values == {"arrest": True, "deleted_flag": False}
+
+            versions = db.session.execute(
+                text(
+                    """
+                SELECT arrest, current_flag, deleted_flag FROM dat_chicago_crime
+                WHERE id = 200 ORDER BY start_date
+            """
+                )
+            ).fetchall()
+            assert [tuple(v) for v in versions] == [(False, False, False), (True, True, False)]
+
+    def test_versions_move_to_history_partition(self, app):
+        """Test that an unpartitioned data table is migrated and closed out versions move."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            db.session.execute(
+                text(
+                    """
+                CREATE TABLE dat_chicago_crime(
+                  row_id SERIAL,
+                  start_date TIMESTAMP,
+                  end_date TIMESTAMP DEFAULT NULL,
+                  current_flag BOOLEAN DEFAULT TRUE,
+                  deleted_flag BOOLEAN DEFAULT FALSE,
+                  deleted_on TIMESTAMP,
+                  dup_ver INTEGER,
+                  source_filename VARCHAR,
+                  {0}
+                  PRIMARY KEY(row_id),
+                  UNIQUE(id, start_date)
+                )
+            """.format(
+                        DATA_COLS
+                    )
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, current_flag, start_date) VALUES
+                (456, false, true, '2024-01-01'),
+                (789, false, false, '2024-01-01'),
+                (789, true, true, '2024-01-02')
+            """
+                )
+            )
+            # changed_records was a materialized view over the table then
+            db.session.execute(
+                text(
+                    """
+                CREATE MATERIALIZED VIEW changed_records AS (
+                    SELECT d.* FROM dat_chicago_crime AS d
+                    JOIN (
+                        SELECT id FROM dat_chicago_crime
+                        GROUP BY id
+                        HAVING(COUNT(*) > 1)
+                    ) AS s
+                        ON d.id = s.id
+                )
+            """
+                )
+            )
+            db.session.commit()
+
+            etl = ETL("", file_date=datetime(2024, 1, 3))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            def partition_counts():
+                return db.session.execute(
+                    text(
+                        """
+                    SELECT
+                      (SELECT COUNT(*) FROM dat_chicago_crime_current) AS current,
+                      (SELECT COUNT(*) FROM dat_chicago_crime_history) AS history
+                """
+                    )
+                ).one()
+
+            assert tuple(partition_counts()) == (2, 1)
+
+            # and gets rebuilt as a table from the partitioned one
+            changed = db.session.execute(
+                text("SELECT id, start_date FROM changed_records ORDER BY start_date")
+            ).fetchall()
+            assert [c.id for c in changed] == [789, 789]
+
+            db.session.execute(
+                text("INSERT INTO src_chicago_crime (id, arrest) VALUES (456, true)")
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.flag_changes()
+
+            assert tuple(partition_counts()) == (2, 2)
+
+            # New rows keep getting row_ids after the ones that were copied over
+            row_ids = db.session.execute(
+                text("SELECT row_id FROM dat_chicago_crime ORDER BY row_id")
+            ).fetchall()
+            assert [r.row_id for r in row_ids] == [1, 2, 3, 4]
+
+    def test_replaced_versions_only_keep_changes(self, app):
+        """Test that replaced versions are stored sparse and rebuilt in full by the view."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, block, arrest, fbi_code, current_flag, start_date) VALUES
+                (456, '100 BLOCK OF MAIN ST', false, '06', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.commit()
+
+            for arrest, fbi_code in (("true", "06"), ("true", "26")):
+                db.session.execute(text("TRUNCATE src_chicago_crime"))
+                db.session.execute(
+                    text(
+                        """
+                    INSERT INTO src_chicago_crime (id, block, arrest, fbi_code)
+                    VALUES (456, '100 BLOCK OF MAIN ST', :arrest, :fbi_code)
+                """
+                    ),
+                    {"arrest": arrest, "fbi_code": fbi_code},
+                )
+                db.session.commit()
+
+                etl.make_dup_table()
+                etl.find_dup_rows()
+                etl.merge_rows()
+                etl.flag_changes()
+
+            stored = db.session.execute(
+                text(
+                    """
+                SELECT block, arrest, fbi_code, delta_cols FROM dat_chicago_crime
+                WHERE id = 456 ORDER BY start_date
+            """
+                )
+            ).fetchall()
+            assert [tuple(r) for r in stored] == [
+                (None, False, None, ["arrest"]),
+                (None, None, "06", ["fbi_code"]),
+                ("100 BLOCK OF MAIN ST", True, "26", None),
+            ]
+
+            versions = db.session.execute(
+                text(
+                    """
+                SELECT block, arrest, fbi_code FROM dat_chicago_crime_versions
+                WHERE id = 456 ORDER BY start_date
+            """
+                )
+            ).fetchall()
+            assert [tuple(r) for r in versions] == [
+                ("100 BLOCK OF MAIN ST", False, "06"),
+                ("100 BLOCK OF MAIN ST", True, "06"),
+                ("100 BLOCK OF MAIN ST", True, "26"),
+            ]
+
+    def test_updated_on_prefilter_and_verification(self, app):
+        """Test that the prefilter skips untouched rows and verification reports them."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            app.config["PREFILTER_UPDATED_ON"] = True
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            # A successful run that compared everything the day before
+            etl.update_meta_table("chicago-crime-2024-01-01.csv", "success", silent_changes=0)
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, updated_on, current_flag, start_date) VALUES
+                (456, false, '2024-01-01', true, '2024-01-01'),
+                (789, false, '2024-01-01', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime (id, arrest, updated_on) VALUES
+                (456, true, '2024-01-02'),
+                (789, true, '2024-01-01')
+            """
+                )
+            )
+            db.session.commit()
+            etl.find_dup_rows()
+
+            assert etl.merge_rows()["changed"] == 1
+            assert etl.silent_changes is None
+
+            etl.verify = True
+            assert etl.merge_rows()["changed"] == 2
+            assert etl.silent_changes == 1
+
+            app.config["PREFILTER_UPDATED_ON"] = False
+
+    def test_index_code_resolved_from_iucr(self, app):
+        """Test that versions carry the index code of their padded IUCR code."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO iucr (iucr, index_code) VALUES ('T1', 'I')
+                ON CONFLICT (iucr) DO UPDATE SET index_code = EXCLUDED.index_code
+            """
+                )
+            )
+            db.session.execute(
+                text("INSERT INTO src_chicago_crime (id, iucr) VALUES (123, '00T1')")
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.insert_new_rows("test.csv")
+
+            def index_code():
+                return db.session.execute(
+                    text("SELECT index_code FROM dat_chicago_crime WHERE id = 123")
+                ).scalar()
+
+            assert index_code() == "I"
+
+            # Reclassifying the code in the reference data carries over
+            db.session.execute(text("UPDATE iucr SET index_code = 'N' WHERE iucr = 'T1'"))
+            db.session.commit()
+            etl.resolve_index_codes()
+            assert index_code() == "N"
+
+            db.session.execute(text("DELETE FROM iucr WHERE iucr = 'T1'"))
+            db.session.commit()
+
+    def test_index_code_changes(self, app):
+        """Test that a reclassification from index to non-index is recorded."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO iucr (iucr, index_code) VALUES ('T1', 'I'), ('T2', 'N')
+                ON CONFLICT (iucr) DO UPDATE SET index_code = EXCLUDED.index_code
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, iucr, fbi_code, index_code, current_flag, start_date) VALUES
+                (10, '00T1', '01A', 'I', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text("INSERT INTO src_chicago_crime (id, iucr, fbi_code) VALUES (10, '00T2', '26')")
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.flag_changes()
+            etl.update_index_code_changes()
+
+            changes = db.session.execute(
+                text(
+                    """
+                SELECT id, from_index_code, to_index_code, from_iucr, to_iucr,
+                  from_fbi_code, to_fbi_code
+                FROM index_code_changes
+            """
+                )
+            ).fetchall()
+            assert [tuple(c) for c in changes] == [(10, "I", "N", "00T1", "00T2", "01A", "26")]
+
+            db.session.execute(text("DELETE FROM iucr WHERE iucr IN ('T1', 'T2')"))
+            db.session.commit()
+
+    def test_index_code_changes_rebuilt_from_replaced_versions(self, app):
+        """Test that a rebuild reads full rows for versions that have been replaced since."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO iucr (iucr, index_code) VALUES ('T1', 'I'), ('T2', 'N')
+                ON CONFLICT (iucr) DO UPDATE SET index_code = EXCLUDED.index_code
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, iucr, fbi_code, district, arrest, index_code, current_flag, start_date)
+                VALUES (10, '00T1', '01A', '011', false, 'I', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.commit()
+
+            def run(file_date, arrest):
+                etl.file_date = file_date
+                db.session.execute(text("TRUNCATE src_chicago_crime"))
+                db.session.execute(
+                    text(
+                        """
+                    INSERT INTO src_chicago_crime (id, iucr, fbi_code, district, arrest)
+                    VALUES (10, '00T2', '26', '011', :arrest)
+                """
+                    ),
+                    {"arrest": arrest},
+                )
+                db.session.commit()
+                etl.make_dup_table()
+                etl.find_dup_rows()
+                etl.merge_rows()
+                etl.flag_changes()
+
+            # Reclassified, then only the arrest changes, which leaves the
+            # reclassified version with nothing but arrest
+            run(datetime(2024, 1, 2), False)
+            run(datetime(2024, 1, 3), True)
+
+            etl.rebuild_index_code_changes()
+
+            changes = db.session.execute(
+                text(
+                    """
+                SELECT id, district, from_index_code, to_index_code, from_iucr, to_iucr,
+                  from_fbi_code, to_fbi_code
+                FROM index_code_changes
+            """
+                )
+            ).fetchall()
+            assert [tuple(c) for c in changes] == [
+                (10, "011", "I", "N", "00T1", "00T2", "01A", "26")
+            ]
+
+            db.session.execute(text("DELETE FROM iucr WHERE iucr IN ('T1', 'T2')"))
+            db.session.commit()
+
+    def test_daily_changes(self, app):
+        """Test that each run adds its counts to the daily rollups."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime
+                (id, arrest, district, current_flag, start_date) VALUES
+                (1, false, '011', true, '2024-01-01'),
+                (2, false, '011', true, '2024-01-01'),
+                (3, false, '011', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime (id, arrest, district) VALUES
+                (1, true, '011'), (2, false, '011'), (4, false, '002')
+            """
+                )
+            )
+            db.session.commit()
+
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.insert_new_rows("test.csv")
+            etl.flag_changes()
+            etl.flag_deletions()
+            etl.update_daily_changes()
+
+            counts = db.session.execute(
+                text(
+                    """
+                SELECT change_type, field, district, records FROM daily_changes
+                WHERE file_date = '2024-01-02'
+                ORDER BY change_type, field
+            """
+                )
+            ).fetchall()
+            assert [tuple(c) for c in counts] == [
+                ("changed", "", "011", 1),
+                ("changed", "arrest", "011", 1),
+                ("deleted", "", "011", 1),
+                ("new", "", "002", 1),
+            ]
+
+
+class TestCheckpoints:
+    """Test the per-step checkpoints a resumed run picks up from."""
+
+    def test_completed_steps_checks_staging_tables(self, app):
+        """Test that a step only counts as done while its staging table still matches."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2), resume=True)
+            filename = etl.snapshot_filename("chicago-crime")
+            etl.make_source_table()
+            etl.make_dup_table()
+
+            db.session.execute(text("INSERT INTO src_chicago_crime (id) VALUES (1), (2)"))
+            db.session.commit()
+
+            start = datetime.now().timestamp()
+            etl.checkpoint(filename, "load", "completed", start, "src_chicago_crime")
+            with etl.checkpointed(filename, "dedup", "dup_chicago_crime"):
+                etl.find_dup_rows()
+
+            with pytest.raises(RuntimeError):
+                with etl.checkpointed(filename, "merge", "mrg_chicago_crime"):
+                    raise RuntimeError("boom")
+
+            steps = db.session.execute(
+                text("SELECT step, status, row_count FROM etl_steps ORDER BY finished_at")
+            ).fetchall()
+            assert [tuple(s) for s in steps] == [
+                ("load", "completed", 2),
+                ("dedup", "completed", 2),
+                ("merge", "failed", None),
+            ]
+            assert etl.completed_steps(filename) == ["load", "dedup"]
+
+            # An unlogged table emptied by a crash has to be reloaded
+            db.session.execute(text("TRUNCATE dup_chicago_crime"))
+            db.session.commit()
+            assert etl.completed_steps(filename) == ["load"]
+
+    def test_wait_for_replicas(self, app, monkeypatch):
+        """Test that a batch waits for the replicas to come within the allowed lag."""
+        with app.app_context():
+            etl = ETL("")
+            assert etl.replica_lag() == 0
+
+            lags = [30.0, 12.5, 4.0]
+            sleeps = []
+            monkeypatch.setattr(etl, "replica_lag", lambda: lags.pop(0))
+            monkeypatch.setattr("app.etl.time.sleep", sleeps.append)
+
+            etl.wait_for_replicas(5)
+
+            assert lags == []
+            assert len(sleeps) == 2
+
+    def test_resume_keeps_silent_changes(self, app):
+        """Test that a run resumed after the merge still records its silent changes."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            filename = etl.snapshot_filename("chicago-crime")
+            etl.make_source_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime (id, arrest, updated_on, current_flag, start_date)
+                VALUES (1, false, '2024-01-01', true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    "INSERT INTO src_chicago_crime (id, arrest, updated_on) VALUES (1, true, '2024-01-01')"
+                )
+            )
+            db.session.commit()
+
+            etl.checkpoint(
+                filename, "load", "completed", datetime.now().timestamp(), "src_chicago_crime"
+            )
+            with etl.checkpointed(filename, "dedup", "dup_chicago_crime"):
+                etl.make_dup_table()
+                etl.find_dup_rows()
+            with etl.checkpointed(filename, "merge", "mrg_chicago_crime"):
+                etl.merge_rows()
+            assert etl.silent_changes == 1
+
+            resumed = ETL("", file_date=datetime(2024, 1, 2), resume=True)
+            resumed.fingerprints[filename] = "fingerprint"
+            completed = resumed.completed_steps(filename)
+            assert completed == ["load", "dedup", "merge"]
+            resumed.apply_changes(filename, completed)
+
+            silent_changes = db.session.execute(
+                text("SELECT silent_changes FROM etl_tracker WHERE filename = :filename"),
+                {"filename": filename},
+            ).scalar()
+            assert silent_changes == 1
+
+    def test_publish_in_batches(self, app):
+        """Test that a batched publish applies every id with one version time and checkpoints."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            app.config["APPLY_BATCH_SIZE"] = 1
+            etl = ETL("", file_date=datetime(2024, 1, 2))
+            filename = etl.snapshot_filename("chicago-crime")
+            etl.fingerprints[filename] = "fingerprint"
+            etl.make_source_table()
+
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO dat_chicago_crime (id, arrest, current_flag, start_date) VALUES
+                (1, false, true, '2024-01-01'),
+                (2, false, true, '2024-01-01'),
+                (3, false, true, '2024-01-01')
+            """
+                )
+            )
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO src_chicago_crime (id, arrest) VALUES
+                (1, true), (2, false), (3, true), (4, false)
+            """
+                )
+            )
+            db.session.commit()
+
+            etl.make_dup_table()
+            etl.find_dup_rows()
+            etl.merge_rows()
+            etl.apply_changes(filename, ["load", "dedup", "merge"])
+            app.config["APPLY_BATCH_SIZE"] = 0
+
+            current = db.session.execute(
+                text(
+                    """
+                SELECT id, arrest, start_date FROM dat_chicago_crime
+                WHERE current_flag ORDER BY id
+            """
+                )
+            ).fetchall()
+            assert [(r.id, r.arrest) for r in current] == [
+                (1, True),
+                (2, False),
+                (3, True),
+                (4, False),
+            ]
+            # Every batch's versions start at the same time
+            assert current[0].start_date == current[2].start_date == current[3].start_date
+
+            step = db.session.execute(
+                text("SELECT status, last_id FROM etl_steps WHERE step = 'publish'")
+            ).first()
+            assert tuple(step) == ("completed", 4)
+
+            status = db.session.execute(
+                text(
+                    "SELECT etl_status, changed_records FROM etl_tracker "
+                    "WHERE filename = :filename"
+                ),
+                {"filename": filename},
+            ).first()
+            assert tuple(status) == ("success", 4)
+
+
+class TestStreamingDownload:
+    """Test feeding the portal download to COPY while archiving it."""
+
+    def test_tee_reader_archives_everything_read(self, portal_server, tmp_path):
+        """Test that the archive matches the response once the stream is finished."""
+        rows = ["{0},CASE{0},THEFT".format(i) for i in range(50000)]
+        portal_server.handler.body = ("id,case_number,primary_type\n" + "\n".join(rows)).encode()
+
+        archive = SnapshotArchive(str(tmp_path))
+        writer = archive.writer("chicago-crime-2024-01-01.csv")
+        r = requests.get(f"{portal_server.url}/rows.csv", stream=True, timeout=30)
+        contents = TeeReader(r, writer, chunk_size=4096)
+
+        # COPY reads in fixed size blocks; the snapshot isn't archived until it's finished
+        read = b"".join(iter(lambda: contents.read(8192), b""))
+        assert not archive.has("chicago-crime-2024-01-01.csv")
+
+        contents.finish()
+        archive.commit(
+            "chicago-crime-2024-01-01.csv", writer, contents.fingerprint, datetime(2024, 1, 1)
+        )
+
+        assert read == portal_server.handler.body
+        assert contents.fingerprint == hashlib.sha256(portal_server.handler.body).hexdigest()
+        with archive.open("chicago-crime-2024-01-01.csv") as f:
+            assert f.read() == portal_server.handler.body
+
+    def test_discarded_stream_leaves_nothing_behind(self, portal_server, tmp_path):
+        """Test that an aborted stream doesn't leave a truncated snapshot behind."""
+        portal_server.handler.body = b"id,case_number\n1,CASE1\n2,CASE2\n"
+
+        archive = SnapshotArchive(str(tmp_path))
+        writer = archive.writer("chicago-crime-2024-01-01.csv")
+        r = requests.get(f"{portal_server.url}/rows.csv", stream=True, timeout=30)
+        contents = TeeReader(r, writer)
+        contents.read(4)
+        writer.discard()
+
+        assert not archive.has("chicago-crime-2024-01-01.csv")
+        assert os.listdir(archive.objects_dir) == []
+
+    def test_run_streams_into_copy(self, app, portal_server, tmp_path, monkeypatch):
+        """Test that a streamed run loads the rows it read and archives the snapshot."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            monkeypatch.setattr("app.etl.PORTAL_URL", portal_server.url)
+
+            # Setting up the tables downloads the IUCR codes
+            portal_server.handler.body = (
+                b"IUCR,PRIMARY DESCRIPTION,SECONDARY DESCRIPTION,INDEX CODE,ACTIVE\n"
+                b"0820,THEFT,$500 AND UNDER,I,true\n"
+            )
+            etl = ETL(str(tmp_path), file_date=datetime(2024, 1, 2), stream=True)
+            filename = etl.snapshot_filename("chicago-crime")
+
+            rows = [dict.fromkeys(COLS, "") for _ in range(3)]
+            for i, row in enumerate(rows, start=1):
+                row.update(id=str(i), case_number=f"JA10000{i}", iucr="0820", arrest="false")
+            rows[1]["location_description"] = "STREET\nCORNER"
+
+            body = io.StringIO()
+            csv.writer(body).writerows([COLS] + [[row[col] for col in COLS] for row in rows])
+            portal_server.handler.body = body.getvalue().encode()
+
+            etl.run()
+
+            loaded = db.session.execute(
+                text(
+                    """
+                SELECT id, case_number, location_description, index_code
+                FROM dat_chicago_crime
+                WHERE current_flag
+                ORDER BY id
+            """
+                )
+            ).fetchall()
+            assert [tuple(r) for r in loaded] == [
+                (1, "JA100001", None, "I"),
+                (2, "JA100002", "STREET\nCORNER", "I"),
+                (3, "JA100003", None, "I"),
+            ]
+
+            assert etl.archive.has(filename)
+            with etl.archive.open(filename) as f:
+                assert f.read() == portal_server.handler.body
+            assert (
+                etl.snapshot_fingerprint(filename)
+                == hashlib.sha256(portal_server.handler.body).hexdigest()
+            )
+
+            status = db.session.execute(
+                text("SELECT etl_status FROM etl_tracker WHERE filename = :filename"),
+                {"filename": filename},
+            ).scalar()
+            assert status == "success"
+
+    def test_failed_load_keeps_the_snapshot(self, app, portal_server, tmp_path, monkeypatch):
+        """Test that a stream is still archived and closed when the load blows up."""
+        with app.app_context():
+            monkeypatch.setattr("app.etl.PORTAL_URL", portal_server.url)
+
+            portal_server.handler.body = (
+                b"IUCR,PRIMARY DESCRIPTION,SECONDARY DESCRIPTION,INDEX CODE,ACTIVE\n"
+                b"0820,THEFT,$500 AND UNDER,I,true\n"
+            )
+            etl = ETL(str(tmp_path), file_date=datetime(2024, 1, 2), stream=True)
+            filename = etl.snapshot_filename("chicago-crime")
+
+            rows = ["{0},CASE{0},THEFT".format(i) for i in range(50000)]
+            portal_server.handler.body = (
+                "id,case_number,primary_type\n" + "\n".join(rows)
+            ).encode()
+
+            responses = []
+            request_download = etl.request_download
+
+            def tracked(fourbyfour):
+                responses.append(request_download(fourbyfour))
+                return responses[-1]
+
+            def insert_source_data(fp, validate=False):
+                fp.read(8192)
+                raise RuntimeError("lost the database")
+
+            monkeypatch.setattr(etl, "request_download", tracked)
+            monkeypatch.setattr(etl, "insert_source_data", insert_source_data)
+
+            with pytest.raises(RuntimeError):
+                etl.stream_source_data("chicago-crime", "ijzp-q8t2")
+
+            with etl.archive.open(filename) as f:
+                assert f.read() == portal_server.handler.body
+            assert responses[0].raw.closed
+
+
+class TestRangedDownload:
+    """Test resumable, parallel ranged downloads."""
+
+    def make_body(self, rows=20000):
+        rows = ["{0},CASE{0},THEFT".format(i) for i in range(rows)]
+        return ("id,case_number,primary_type\n" + "\n".join(rows)).encode()
+
+    def test_parallel_ranges(self, portal_server, tmp_path):
+        """Test that a ranged download reassembles the file from several ranges."""
+        portal_server.handler.body = self.make_body()
+        portal_server.handler.ranged = True
+
+        filepath = os.path.join(tmp_path, "chicago-crime-2024-01-01.csv")
+        downloader = RangedDownloader(f"{portal_server.url}/rows.csv", filepath, workers=4)
+        downloader.download()
+
+        with open(filepath, "rb") as f:
+            assert f.read() == portal_server.handler.body
+        assert downloader.fingerprint == hashlib.sha256(portal_server.handler.body).hexdigest()
+        assert len(portal_server.handler.requests) == 4
+        assert not os.path.exists(f"{filepath}.part")
+        assert not os.path.exists(f"{filepath}.part.json")
+
+    def test_resume_after_dropped_connection(self, portal_server, tmp_path):
+        """Test that a dropped download isn't promoted and resumes from the .part file."""
+        portal_server.handler.body = self.make_body()
+        portal_server.handler.ranged = True
+        portal_server.handler.truncate_at = 1000
+
+        filepath = os.path.join(tmp_path, "chicago-crime-2024-01-01.csv")
+        url = f"{portal_server.url}/rows.csv"
+
+        with pytest.raises(requests.RequestException):
+            RangedDownloader(url, filepath, workers=2, chunk_size=256).download()
+
+        assert not os.path.exists(filepath)
+        assert os.path.exists(f"{filepath}.part")
+
+        portal_server.handler.truncate_at = None
+        portal_server.handler.requests.clear()
+        RangedDownloader(url, filepath, workers=2).download()
+
+        with open(filepath, "rb") as f:
+            assert f.read() == portal_server.handler.body
+        # Both ranges pick up after the bytes that made it the first time
+        assert not any(r.startswith("bytes=0-") for r in portal_server.handler.requests)
+
+    def test_resume_single_stream(self, portal_server, tmp_path):
+        """Test that a download without advertised ranges resumes from the .part length."""
+        portal_server.handler.body = self.make_body()
+        portal_server.handler.unadvertised_ranges = True
+        portal_server.handler.etag = '"v1"'
+        portal_server.handler.truncate_at = 1000
+
+        filepath = os.path.join(tmp_path, "chicago-crime-2024-01-01.csv")
+        url = f"{portal_server.url}/rows.csv"
+
+        with pytest.raises(requests.RequestException):
+            RangedDownloader(url, filepath, chunk_size=256).download()
+
+        portal_server.handler.truncate_at = None
+        portal_server.handler.requests.clear()
+        downloader = RangedDownloader(url, filepath)
+        downloader.download()
+
+        with open(filepath, "rb") as f:
+            assert f.read() == portal_server.handler.body
+        assert downloader.fingerprint == hashlib.sha256(portal_server.handler.body).hexdigest()
+        # One request for the rest, after the bytes that made it the first time
+        [resumed] = portal_server.handler.requests
+        assert resumed.startswith("bytes=") and not resumed.startswith("bytes=0-")
+
+    def test_truncated_download_without_ranges(self, portal_server, tmp_path):
+        """Test that a truncated single stream download never becomes the snapshot."""
+        portal_server.handler.body = self.make_body()
+        portal_server.handler.truncate_at = 1000
+
+        filepath = os.path.join(tmp_path, "chicago-crime-2024-01-01.csv")
+
+        with pytest.raises(requests.RequestException):
+            RangedDownloader(f"{portal_server.url}/rows.csv", filepath).download()
+
+        assert not os.path.exists(filepath)
+
+        # Without ranges the next attempt starts over
+        portal_server.handler.truncate_at = None
+        RangedDownloader(f"{portal_server.url}/rows.csv", filepath).download()
+
+        with open(filepath, "rb") as f:
+            assert f.read() == portal_server.handler.body
+
+
+class TestSnapshotArchive:
+    """Test the compressed, content-addressed snapshot archive."""
+
+    def write_snapshot(self, tmp_path, filename, body):
+        filepath = os.path.join(tmp_path, filename)
+        with open(filepath, "wb") as f:
+            f.write(body)
+        return filepath
+
+    def test_add_compresses_and_removes_original(self, tmp_path):
+        """Test that snapshots are stored compressed and read back transparently."""
+        body = b"id,case_number\n" + b"".join(b"%d,CASE%d\n" % (i, i) for i in range(10000))
+        archive = SnapshotArchive(str(tmp_path))
+
+        filepath = self.write_snapshot(tmp_path, "chicago-crime-2024-01-01.csv", body)
+        archive.add("chicago-crime-2024-01-01.csv", filepath, datetime(2024, 1, 1))
+
+        assert not os.path.exists(filepath)
+        [stored] = os.listdir(archive.objects_dir)
+        assert stored.endswith(".csv.gz")
+        assert os.path.getsize(os.path.join(archive.objects_dir, stored)) < len(body)
+
+        with archive.open("chicago-crime-2024-01-01.csv") as f:
+            assert f.read() == body
+        assert (
+            archive.fingerprint("chicago-crime-2024-01-01.csv") == hashlib.sha256(body).hexdigest()
+        )
+
+    def test_identical_snapshots_stored_once(self, tmp_path):
+        """Test that snapshots with the same contents share one object."""
+        archive = SnapshotArchive(str(tmp_path))
+
+        for day in (1, 2):
+            filename = f"chicago-crime-2024-01-0{day}.csv"
+            filepath = self.write_snapshot(tmp_path, filename, b"id\n1\n")
+            archive.add(filename, filepath, datetime(2024, 1, day))
+
+        assert len(os.listdir(archive.objects_dir)) == 1
+        assert archive.has("chicago-crime-2024-01-01.csv")
+        assert archive.has("chicago-crime-2024-01-02.csv")
+
+        # The manifest survives a new archive instance
+        assert SnapshotArchive(str(tmp_path)).has("chicago-crime-2024-01-02.csv")
+
+    def test_retention(self, tmp_path):
+        """Test that expired snapshots and their unreferenced objects are removed."""
+        archive = SnapshotArchive(str(tmp_path), retention_days=30)
+
+        for day, body in ((1, b"id\n1\n"), (2, b"id\n1\n2\n"), (20, b"id\n1\n")):
+            filename = f"chicago-crime-2024-01-{day:02d}.csv"
+            filepath = self.write_snapshot(tmp_path, filename, body)
+            archive.add(filename, filepath, datetime(2024, 1, day))
+
+        archive.prune(today=datetime(2024, 2, 10))
+
+        assert not archive.has("chicago-crime-2024-01-01.csv")
+        assert not archive.has("chicago-crime-2024-01-02.csv")
+        assert archive.has("chicago-crime-2024-01-20.csv")
+        # Day one's contents are still referenced by day twenty
+        assert len(os.listdir(archive.objects_dir)) == 1
+
+    def test_reads_legacy_uncompressed_snapshots(self, tmp_path):
+        """Test that snapshots saved before the archive existed are still used."""
+        self.write_snapshot(tmp_path, "chicago-crime-2024-01-01.csv", b"id\n1\n")
+        archive = SnapshotArchive(str(tmp_path))
+
+        assert archive.has("chicago-crime-2024-01-01.csv")
+        with archive.open("chicago-crime-2024-01-01.csv") as f:
+            assert f.read() == b"id\n1\n"
+
+
+class TestValidatedCopy:
+    """Test loading the source table one parsed row at a time."""
+
+    def make_csv(self):
+        header = ",".join(COLS)
+        rows = ['{0},CASE{0},,,,,"MULTI\nLINE",,,,,,,,,,,,,,,'.format(i % 5) for i in range(1, 21)]
+        return ("\n".join([header] + rows) + "\n").encode()
+
+    def test_batches_split_on_row_boundaries(self):
+        """Test that batching keeps quoted newlines together and numbers rows in order."""
+        loader = ValidatedCopy("", "src_chicago_crime", COLS, batch_rows=3)
+
+        batches = list(loader.batches(io.BytesIO(self.make_csv())))
+        rows = [row for batch in batches for row in csv.reader(io.StringIO(batch))]
+
+        assert len(batches) == 7
+        assert [int(row[-1]) for row in rows] == list(range(1, 21))
+        assert all(row[6] == "MULTI\nLINE" for row in rows)
+
+    def test_load_line_numbers(self, app):
+        """Test that a batched load produces the same line_num as a single COPY."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            etl = ETL("")
+            etl.make_source_table()
+
+            loader = ValidatedCopy(
+                app.config["SQLALCHEMY_DATABASE_URI"],
+                "src_chicago_crime",
+                COLS,
+                batch_rows=2,
+            )
+            loader.load(io.BytesIO(self.make_csv()))
+
+            result = db.session.execute(
+                text("SELECT id, line_num FROM src_chicago_crime ORDER BY line_num")
+            ).fetchall()
+
+            assert [r.line_num for r in result] == list(range(1, 21))
+            assert [r.id for r in result] == [i % 5 for i in range(1, 21)]
+
+
+class TestRowValidation:
+    """Test setting aside malformed rows instead of failing the load."""
+
+    def make_row(self, **overrides):
+        row = dict.fromkeys(COLS, "")
+        row.update(
+            id="1",
+            case_number="JA100001",
+            orig_date="01/31/2024 11:59:00 PM",
+            arrest="false",
+            ward="42",
+            updated_on="02/01/2024 03:40:00 PM",
+            latitude="41.88",
+        )
+        row.update(overrides)
+        return [row[col] for col in COLS]
+
+    def test_validate(self):
+        """Test that each column is checked against its type."""
+        validator = RowValidator.from_columns(DATA_COLS)
+
+        assert validator.validate(self.make_row()) is None
+        assert validator.validate(self.make_row(orig_date="")) is None
+        assert "orig_date" in validator.validate(self.make_row(orig_date="13/45/2024 1:00"))
+        for impossible in ["02/30/2024 10:00:00 PM", "04/31/2023 10:00:00 PM", "02/29/2023"]:
+            assert "orig_date" in validator.validate(self.make_row(orig_date=impossible))
+        assert validator.validate(self.make_row(orig_date="02/29/2024 12:00:00 AM")) is None
+        assert "orig_date" in validator.validate(self.make_row(orig_date="01/31/2024 13:00:00 PM"))
+        assert "arrest" in validator.validate(self.make_row(arrest="maybe"))
+        assert "ward" in validator.validate(self.make_row(ward="4.2"))
+        assert "case_number" in validator.validate(self.make_row(case_number="X" * 11))
+        assert "columns" in validator.validate(self.make_row()[:-1])
+
+    def test_rejects_are_left_out_of_the_load(self):
+        """Test that bad rows are collected with their line numbers and good ones continue."""
+        rows = [self.make_row(id=str(i)) for i in range(1, 6)]
+        rows[2] = self.make_row(id="3", updated_on="yesterday")
+
+        body = io.StringIO()
+        csv.writer(body).writerows([COLS] + rows)
+
+        validator = RowValidator.from_columns(DATA_COLS)
+        loader = ValidatedCopy("", "src_chicago_crime", COLS, validator=validator)
+        batches = list(loader.batches(io.BytesIO(body.getvalue().encode())))
+        loaded = [row for batch in batches for row in csv.reader(io.StringIO(batch))]
+
+        assert [row[-1] for row in loaded] == ["1", "2", "4", "5"]
+        [(line_num, reason, raw_row)] = loader.rejects
+        assert line_num == 3
+        assert "updated_on" in reason
+        assert "yesterday" in raw_row
+
+    def test_too_many_rejects(self):
+        """Test that a file full of bad rows still fails the run."""
+        rows = [self.make_row(id="not a number") for _ in range(5)]
+
+        body = io.StringIO()
+        csv.writer(body).writerows([COLS] + rows)
+
+        validator = RowValidator.from_columns(DATA_COLS)
+        loader = ValidatedCopy("", "src_chicago_crime", COLS, validator=validator, max_rejects=2)
+
+        with pytest.raises(TooManyRejects):
+            list(loader.batches(io.BytesIO(body.getvalue().encode())))
+
+    def test_run_sets_aside_rows_the_copy_turns_away(
+        self, app, portal_server, tmp_path, monkeypatch
+    ):
+        """Test that a streamed run falls back to validating the archived file."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            monkeypatch.setattr("app.etl.PORTAL_URL", portal_server.url)
+            portal_server.handler.body = (
+                b"IUCR,PRIMARY DESCRIPTION,SECONDARY DESCRIPTION,INDEX CODE,ACTIVE\n"
+                b"0820,THEFT,$500 AND UNDER,I,true\n"
+            )
+            etl = ETL(str(tmp_path), file_date=datetime(2024, 1, 2), stream=True)
+            filename = etl.snapshot_filename("chicago-crime")
+
+            rows = [self.make_row(id=str(i), iucr="0820") for i in range(1, 4)]
+            rows[1] = self.make_row(id="2", iucr="0820", orig_date="02/30/2024 10:00:00 PM")
+
+            body = io.StringIO()
+            csv.writer(body).writerows([COLS] + rows)
+            portal_server.handler.body = body.getvalue().encode()
+
+            etl.run()
+
+            loaded = db.session.execute(
+                text("SELECT id FROM dat_chicago_crime WHERE current_flag ORDER BY id")
+            ).scalars()
+            assert list(loaded) == [1, 3]
+
+            rejected = db.session.execute(
+                text("SELECT line_num, id, reason FROM rej_chicago_crime")
+            ).fetchall()
+            assert [(r.line_num, r.id) for r in rejected] == [(2, 2)]
+            assert "orig_date" in rejected[0].reason
+
+            tracked = db.session.execute(
+                text(
+                    "SELECT etl_status, rejected_rows FROM etl_tracker WHERE filename = :filename"
+                ),
+                {"filename": filename},
+            ).first()
+            assert tuple(tracked) == ("success", 1)
+
+            with etl.archive.open(filename) as f:
+                assert f.read() == portal_server.handler.body
+
+
+class TestSnapshotFingerprint:
+    """Test skipping snapshots identical to the last successful load."""
+
+    def test_unchanged_snapshot(self, app, tmp_path):
+        """Test that a snapshot matching the last successful load is detected."""
+        with app.app_context():
+            etl = ETL(str(tmp_path), file_date=datetime(2024, 1, 2))
+
+            filename = etl.snapshot_filename("chicago-crime")
+            with open(os.path.join(tmp_path, filename), "w") as f:
+                f.write("id,case_number\n1,CASE1\n")
+
+            assert not etl.unchanged_snapshot("chicago-crime", filename)
+
+            etl.update_meta_table(filename, "failed - data format error")
+            assert not etl.unchanged_snapshot("chicago-crime", filename)
+
+            etl.update_meta_table(filename, "success", etl.snapshot_fingerprint(filename))
+            assert etl.unchanged_snapshot("chicago-crime", filename)
+
+
+class TestSnapshotDiff:
+    """Test diffing two snapshots outside the database."""
+
+    def snapshot(self, rows):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(COLS)
+        for row in rows:
+            writer.writerow(row)
+        return io.BytesIO(out.getvalue().encode("utf-8"))
+
+    def row(self, id, arrest="false", block="100 BLOCK OF MAIN ST"):
+        row = [""] * len(COLS)
+        row[COLS.index("id")] = str(id)
+        row[COLS.index("arrest")] = arrest
+        row[COLS.index("block")] = block
+        return row
+
+    def test_diff_last_line_wins(self):
+        """Test that duplicates are resolved by the last line before comparing."""
+        old = self.snapshot([self.row(1), self.row(2), self.row(3), self.row(4)])
+        new = self.snapshot(
+            [
+                self.row(4, block="200 BLOCK OF ELM ST"),
+                self.row(2, arrest="true"),
+                self.row(1, arrest="true"),
+                self.row(1),
+                self.row(5),
+                self.row("not an id"),
+            ]
+        )
+
+        diff = SnapshotDiff(COLS, TRACKED_COLS, run_rows=2)
+        result = [
+            (action, value if action == "deleted" else value[0])
+            for action, value in diff.diff(old, new)
+        ]
+
+        # 1 is back to what it was, 3 is gone, 4 only changed an untracked column
+        assert result == [
+            ("changed", "2"),
+            ("deleted", 3),
+            ("new", "5"),
+            ("new", "not an id"),
+        ]
+
+    def test_write_delta(self):
+        """Test that the delta is a loadable CSV of just the rows that differ."""
+        old = self.snapshot([self.row(i) for i in range(100)])
+        new = self.snapshot(
+            [self.row(i, arrest="true" if i == 50 else "false") for i in range(1, 101)]
+        )
+
+        out = io.BytesIO()
+        deleted, counts = SnapshotDiff(COLS, TRACKED_COLS, run_rows=7).write_delta(old, new, out)
+
+        rows = list(csv.reader(io.StringIO(out.getvalue().decode("utf-8"))))
+        assert rows[0] == COLS
+        assert [r[0] for r in rows[1:]] == ["50", "100"]
+        assert deleted == [0]
+        assert counts == {"new": 1, "changed": 1, "deleted": 1}
+
+    def test_prepare_delta_from_archive(self, tmp_path):
+        """Test that a backfill worker diffs two archived snapshots into a delta file."""
+        archive = SnapshotArchive(str(tmp_path))
+        for day, rows in ((1, [self.row(1), self.row(2)]), (2, [self.row(2, arrest="true")])):
+            filepath = os.path.join(tmp_path, f"chicago-crime-2024-01-0{day}.csv")
+            with open(filepath, "wb") as f:
+                f.write(self.snapshot(rows).getvalue())
+            archive.add(os.path.basename(filepath), filepath, datetime(2024, 1, day))
+
+        assert archived_snapshots(archive, start=datetime(2024, 1, 2)) == [
+            (datetime(2024, 1, 2), "chicago-crime-2024-01-02.csv")
+        ]
+
+        out_path = os.path.join(tmp_path, "delta.csv")
+        deleted, counts = prepare_delta(
+            str(tmp_path),
+            "gzip",
+            COLS,
+            TRACKED_COLS,
+            "chicago-crime-2024-01-01.csv",
+            "chicago-crime-2024-01-02.csv",
+            out_path,
+        )
+
+        assert deleted == [1]
+        assert counts == {"new": 0, "changed": 1, "deleted": 1}
+        with open(out_path) as f:
+            assert len(list(csv.reader(f))) == 2
+
+    def test_delta_run_matches_full_run(self, app, tmp_path):
+        """Test that loading only the delta ends up with the same history as a full load."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            iucr = b"IUCR,PRIMARY DESCRIPTION,SECONDARY DESCRIPTION,INDEX CODE,ACTIVE\n"
+            snapshots = {
+                1: [self.row(1), self.row(2), self.row(3), self.row(4)],
+                # 1 changed, 3 is gone, 4 only changed an untracked column, 5 is new
+                2: [
+                    self.row(2),
+                    self.row(1),
+                    self.row(1, arrest="true"),
+                    self.row(4, block="200 BLOCK OF ELM ST"),
+                    self.row(5),
+                ],
+            }
+
+            def history(delta):
+                storage_dir = tmp_path / ("delta" if delta else "full")
+                archive = SnapshotArchive(str(storage_dir))
+                for day, rows in snapshots.items():
+                    for name, body in [
+                        ("chicago-crime", self.snapshot(rows).getvalue()),
+                        ("iucr", iucr),
+                    ]:
+                        filepath = storage_dir / f"{name}-2024-01-0{day}.csv"
+                        filepath.write_bytes(body)
+                        archive.add(filepath.name, str(filepath), datetime(2024, 1, day))
+
+                for day in snapshots:
+                    ETL(
+                        str(storage_dir),
+                        file_date=datetime(2024, 1, day),
+                        delta=delta,
+                        backdate=True,
+                    ).run()
+
+                versions = db.session.execute(
+                    text(
+                        """
+                    SELECT id, arrest, block, start_date, end_date, current_flag, deleted_flag
+                    FROM dat_chicago_crime_versions
+                    ORDER BY id, start_date
+                """
+                    )
+                ).fetchall()
+                events = db.session.execute(
+                    text(
+                        """
+                    SELECT id, start_date, changed_fields, old_values, new_values
+                    FROM evt_chicago_crime
+                    ORDER BY id, start_date
+                """
+                    )
+                ).fetchall()
+                db.session.commit()
+
+                for table in [
+                    "etl_tracker",
+                    "etl_steps",
+                    "dat_chicago_crime",
+                    "evt_chicago_crime",
+                    "rej_chicago_crime",
+                    "changed_records",
+                    "index_code_changes",
+                    "daily_changes",
+                ]:
+                    db.session.execute(text(f"DROP TABLE IF EXISTS {table} CASCADE"))
+                db.session.commit()
+
+                return [tuple(v) for v in versions], [tuple(e) for e in events]
+
+            delta_versions, delta_events = history(delta=True)
+            full_versions, full_events = history(delta=False)
+
+            assert delta_versions == full_versions
+            assert delta_events == full_events
+            assert [v[0] for v in delta_versions if v[6]] == [3]
+            assert [v[0] for v in delta_versions if v[3] == datetime(2024, 1, 2)] == [1, 5]
+            assert [e[0] for e in delta_events if e[1] == datetime(2024, 1, 2)] == [1, 3]
+
+    def test_backfill(self, app, tmp_path):
+        """Test that replaying archived snapshots builds the history they describe."""
+        with app.app_context():
+            from app.extensions import db
+            from sqlalchemy import text
+
+            snapshots = {
+                1: [self.row(1), self.row(2), self.row(3)],
+                2: [self.row(1, arrest="true"), self.row(2), self.row(3)],
+                3: [self.row(1, arrest="true"), self.row(2, arrest="true"), self.row(4)],
+            }
+
+            archive = SnapshotArchive(str(tmp_path))
+            iucr = tmp_path / "iucr-2024-01-01.csv"
+            iucr.write_bytes(b"IUCR,PRIMARY DESCRIPTION,SECONDARY DESCRIPTION,INDEX CODE,ACTIVE\n")
+            archive.add(iucr.name, str(iucr), datetime(2024, 1, 1))
+            for day, rows in snapshots.items():
+                filepath = tmp_path / f"chicago-crime-2024-01-0{day}.csv"
+                filepath.write_bytes(self.snapshot(rows).getvalue())
+                archive.add(filepath.name, str(filepath), datetime(2024, 1, day))
+
+            etl = ETL(str(tmp_path), file_date=datetime(2024, 1, 1), backdate=True)
+            Backfill(etl, archived_snapshots(etl.archive), workers=2).run()
+
+            versions = db.session.execute(
+                text(
+                    """
+                SELECT id, arrest, start_date, end_date, current_flag, deleted_flag
+                FROM dat_chicago_crime_versions
+                ORDER BY id, start_date
+            """
+                )
+            ).fetchall()
+            day1, day2, day3 = [datetime(2024, 1, day) for day in snapshots]
+            assert [tuple(v) for v in versions] == [
+                (1, False, day1, day2, False, False),
+                (1, True, day2, None, True, False),
+                (2, False, day1, day3, False, False),
+                (2, True, day3, None, True, False),
+                (3, False, day1, None, True, True),
+                (4, False, day3, None, True, False),
+            ]
+
+            events = db.session.execute(
+                text("SELECT id, start_date, changed_fields FROM evt_chicago_crime ORDER BY id")
+            ).fetchall()
+            assert [tuple(e) for e in events] == [
+                (1, day2, ["arrest"]),
+                (2, day3, ["arrest"]),
+                (3, day3, ["deleted_flag"]),
+            ]
 
-            assert result.count == 0
+            loaded = etl.last_loaded("chicago-crime")
+            assert loaded.filename == "chicago-crime-2024-01-03.csv"
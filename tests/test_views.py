@@ -1,4 +1,5 @@
 from app.extensions import db
+from helpers import changedFields, encodeCursor
 from sqlalchemy import text
 
 
@@ -74,3 +75,153 @@ class TestViews:
         # Test excessive limit (should be capped)
         response = client.get("/change-list/?limit=99999")
         assert response.status_code == 200
+
+    def test_changed_fields_from_events(self, app, changed_records_view):
+        """Test that diffs come from the change events rather than the versions."""
+        with app.app_context():
+            changed = changedFields([1, 3])
+
+            assert sorted(changed[1]) == ["arrest", "updated_on"]
+            assert changed[3] == ["updated_on"]
+
+    def test_index_code_changes(self, client, app):
+        """Test the index code changes page and API read the transition table."""
+        with app.app_context():
+            from app.etl import ETL
+
+            ETL("")
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO index_code_changes
+                (id, changed_on, district, from_index_code, to_index_code, from_iucr, to_iucr) VALUES
+                (10, '2024-01-02', '001', 'I', 'N', '0110', '0142'),
+                (11, '2024-01-03', '002', 'N', 'I', '0142', '0110')
+            """
+                )
+            )
+            db.session.commit()
+
+            response = client.get("/index-code-changes/?district=001")
+            assert response.status_code == 200
+            assert b"0142" in response.data
+
+            response = client.get("/api/index-code-changes/?direction=to-index")
+            assert response.status_code == 200
+            assert response.json["meta"]["total_count"] == 1
+            assert response.json["records"][0]["id"] == 11
+
+    def test_stats(self, client, app):
+        """Test the stats API sums the daily change counts it's asked for."""
+        with app.app_context():
+            from app.etl import ETL
+
+            ETL("")
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO daily_changes
+                (file_date, change_type, field, district, community_area, primary_type, records)
+                VALUES
+                ('2024-01-02', 'changed', '', '011', '25', 'THEFT', 3),
+                ('2024-01-02', 'changed', 'arrest', '011', '25', 'THEFT', 2),
+                ('2024-01-02', 'changed', '', '001', '32', 'THEFT', 4),
+                ('2024-01-03', 'changed', '', '011', '25', 'BATTERY', 1)
+            """
+                )
+            )
+            db.session.commit()
+
+            response = client.get("/api/stats/?district=011&start_date=2024-01-01")
+            assert response.status_code == 200
+            assert response.json["counts"] == [
+                {"file_date": "2024-01-02", "change_type": "changed", "records": 3},
+                {"file_date": "2024-01-03", "change_type": "changed", "records": 1},
+            ]
+
+            response = client.get("/api/stats/?group_by=field&field=arrest")
+            assert response.json["counts"] == [{"field": "arrest", "records": 2}]
+
+    def test_api_cursor_pagination(self, client, changed_records_view):
+        """Test that the API pages through records with its next and prev cursors."""
+        response = client.get("/api/?limit=1")
+        assert response.status_code == 200
+        assert [list(r) for r in response.json["records"]] == [["1"]]
+        assert response.json["meta"]["prev"] is None
+
+        response = client.get(f"/api/?limit=1&cursor={response.json['meta']['next']}")
+        assert [list(r) for r in response.json["records"]] == [["3"]]
+        assert response.json["meta"]["next"] is None
+
+        response = client.get(f"/api/?limit=1&cursor={response.json['meta']['prev']}")
+        assert [list(r) for r in response.json["records"]] == [["1"]]
+
+        # A cursor that doesn't decode is the first page
+        response = client.get("/api/?limit=1&cursor=garbage")
+        assert [list(r) for r in response.json["records"]] == [["1"]]
+
+    def test_cursor_with_wrong_key_types(self, client, app, changed_records_view):
+        """Test that a cursor whose key doesn't fit the sort columns is the first page."""
+        with app.app_context():
+            from app.etl import ETL
+
+            ETL("")
+            db.session.execute(
+                text(
+                    """
+                UPDATE changed_records
+                SET deleted_flag = TRUE, deleted_on = '2024-01-03', iucr = to_char(start_date, 'MMDD')
+            """
+                )
+            )
+            db.session.commit()
+
+            cursors = [
+                encodeCursor("next", ["abc"]),
+                encodeCursor("next", [1, "notadate"]),
+                encodeCursor("next", ["notadate", 1]),
+                encodeCursor("next", [True]),
+                encodeCursor("next", [2**70]),
+            ]
+            for path in [
+                "/api/",
+                "/deleted/",
+                "/change-list/",
+                "/index-code-changes/",
+                "/api/index-code-changes/",
+            ]:
+                for cursor in cursors:
+                    response = client.get(f"{path}?cursor={cursor}")
+                    assert response.status_code == 200, (path, cursor)
+
+            response = client.get(f"/api/?limit=1&cursor={cursors[0]}")
+            assert [list(r) for r in response.json["records"]] == [["1"]]
+
+            # Each deleted record's versions are listed oldest first
+            response = client.get("/deleted/")
+            assert response.data.index(b"0101") < response.data.index(b"0102")
+
+    def test_api_order_by(self, client, changed_records_view):
+        """Test that the API turns away the order_by it no longer supports."""
+        assert client.get("/api/?order_by=id").status_code == 200
+
+        response = client.get("/api/?order_by=case_number")
+        assert response.status_code == 400
+        assert response.json["status"] == "error"
+
+    def test_api_total_from_tracker(self, client, app, changed_records_view):
+        """Test that the API reports the total the last ETL run recorded."""
+        with app.app_context():
+            db.session.execute(
+                text(
+                    """
+                INSERT INTO etl_tracker (filename, etl_status, file_date, changed_records) VALUES
+                ('chicago-crime-2024-01-01.csv', 'success', '2024-01-01', 40),
+                ('chicago-crime-2024-01-02.csv', 'success', '2024-01-02', 42)
+            """
+                )
+            )
+            db.session.commit()
+
+            response = client.get("/api/")
+            assert response.json["meta"]["total_count"] == 42